@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark toaster's archive extraction against tarfile/zipfile's extractall
+
+Usage: python benchmarks/bench_extract.py [number of files]
+"""
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'src', 'toaster'))
+
+from extract import extract_tar  # noqa: E402
+from extract import extract_zip  # noqa: E402
+
+
+def make_archives(tmp, count):
+    """Make a tar.gz and a zip with `count` small files spread over 100 directories"""
+    tar_loc = os.path.join(tmp, 'files.tar.gz')
+    zip_loc = os.path.join(tmp, 'files.zip')
+
+    with tarfile.open(tar_loc, 'w:gz') as tar, zipfile.ZipFile(zip_loc, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i in range(count):
+            name = f'pkg-1.0/dir{i % 100}/file{i}.txt'
+            data = f'file {i}\n'.encode() * 8
+
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+            z.writestr(name, data)
+
+    return tar_loc, zip_loc
+
+
+def timed(name, func, dest):
+    shutil.rmtree(dest, ignore_errors=True)
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {elapsed:8.2f}s')
+    shutil.rmtree(dest, ignore_errors=True)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'Making archives with {count} files...')
+        tar_loc, zip_loc = make_archives(tmp, count)
+        dest = os.path.join(tmp, 'out')
+
+        def tarfile_extractall():
+            with tarfile.open(tar_loc) as tar:
+                tar.extractall(dest)
+
+        def zipfile_extractall():
+            with zipfile.ZipFile(zip_loc) as z:
+                z.extractall(dest)
+
+        def stream_tar():
+            with open(tar_loc, 'rb') as f:
+                extract_tar(dest, fileobj=f)
+
+        timed('tarfile extractall', tarfile_extractall, dest)
+        timed('toaster extract_tar', lambda: extract_tar(dest, tar_loc), dest)
+        timed('toaster extract_tar (stream)', stream_tar, dest)
+        timed('zipfile extractall', zipfile_extractall, dest)
+        timed('toaster extract_zip', lambda: extract_zip(dest, zip_loc), dest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Benchmark toaster's package operations against synthetic bakeries
+
+Every scenario gets a fresh toaster home with a generated bakery of `size` packages in a local git
+repo, and archives served from a local HTTP server, so results only depend on this machine.
+Chains of `depth` packages which depend on each other measure dependency resolution.
+
+Each scenario runs `--repeat` times from scratch and the median of every operation is kept.
+Results are written as JSON. If a baseline is given, any operation which got slower than the
+tolerance allows is reported and the benchmark exits with status 1.
+
+Usage: python benchmarks/bench_packages.py [--sizes 100,1000] [--depths 1,16] [--repeat 3] [--output results.json]
+                                           [--baseline baseline.json] [--save-baseline] [--tolerance 0.25]
+"""
+import argparse
+import functools
+import http.server
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from bench_startup import make_home
+
+TOASTER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'src', 'toaster')
+
+BASELINE = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'baseline.json')
+
+# How many packages of each kind are installed, their times are the median of each install
+BINARY_INSTALLS = 5
+BUILD_INSTALLS = 3
+# Lookups are fast, so they are averaged over many calls
+LOOKUPS = 200
+
+# Differences smaller than this are noise, however big they are relatively
+NOISE = 0.005
+
+
+def git(cwd, *args):
+    subprocess.run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', *args],
+                   cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_archive(loc):
+    """Make the archive every binary package downloads"""
+    data = b'#!/bin/sh\necho tool\n'
+
+    with tarfile.open(loc, 'w:gz') as tar:
+        info = tarfile.TarInfo('tool-1.0/bin/tool')
+        info.size = len(data)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(data))
+
+
+def make_source(loc):
+    """Make the git repo every build package builds from"""
+    os.makedirs(loc)
+
+    with open(os.path.join(loc, 'tool.sh'), 'w') as f:
+        f.write('#!/bin/sh\necho tool\n')
+
+    git(loc, 'init', '-q', '-b', 'master')
+    git(loc, 'add', '.')
+    git(loc, 'commit', '-qm', 'Source')
+
+
+def package_toml(name, kind, url, source, version='1.0', dependencies=()):
+    deps = ', '.join(f'"{d}"' for d in dependencies)
+
+    if kind == 'binary':
+        # The query makes every package its own download, the server ignores it
+        section = f'[binary]\ntype = "tar"\nurl = "{url}?{name}"\n'
+    else:
+        section = (f'[build]\nrepo = "{source}"\nformat_scripts = true\n'
+                   f'scripts = [["sh", "-c", "mkdir -p {{prefix}}/bin && cp tool.sh {{prefix}}/bin/{name}"]]\n')
+
+    return (f'name = "{name}"\ndesc = "Synthetic {kind} package"\nversion = "{version}"\n'
+            f'types = ["{kind}"]\ndependencies = [{deps}]\n{section}')
+
+
+def write_package(bakery_dir, name, toml):
+    os.makedirs(os.path.join(bakery_dir, name), exist_ok=True)
+
+    with open(os.path.join(bakery_dir, name, f'{name}.toml'), 'w') as f:
+        f.write(toml)
+
+
+def make_bakery(loc, size, depth, url, source):
+    """Make a bakery repo with `size` packages, returns the names of each kind of package
+
+    Most packages are binaries, every tenth is built, and the last `depth` form a dependency chain."""
+    os.makedirs(loc)
+
+    with open(os.path.join(loc, '_toaster.toml'), 'w') as f:
+        f.write("name = 'bench'\nmaintainer = 'bench'\ndescription = 'Synthetic bakery'\n")
+
+    names = {'binary': [], 'build': [], 'chain': []}
+
+    for i in range(size - depth):
+        kind = 'build' if i % 10 == 0 else 'binary'
+        name = f'{kind}{i}'
+        names[kind].append(name)
+        write_package(loc, name, package_toml(name, kind, url, source))
+
+    for i in range(depth):
+        name = f'chain{i}'
+        dependencies = [f'chain{i + 1}'] if i + 1 < depth else []
+        names['chain'].append(name)
+        write_package(loc, name, package_toml(
+            name, 'binary', url, source, dependencies=dependencies))
+
+    git(loc, 'init', '-q', '-b', 'master')
+    git(loc, 'add', '.')
+    git(loc, 'commit', '-qm', 'Packages')
+
+    return names
+
+
+def serve(directory):
+    """Serve a directory over HTTP on a free port, returns its URL"""
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def worker(size, depth, tmp):
+    """Run one scenario, in its own process since toaster finds its home when it is imported"""
+    www = os.path.join(tmp, 'www')
+    os.makedirs(www)
+    make_archive(os.path.join(www, 'tool-1.0.tar.gz'))
+    source = os.path.join(tmp, 'source')
+    make_source(source)
+    bakery_dir = os.path.join(tmp, 'bakery-src')
+
+    url = serve(www) + '/tool-1.0.tar.gz'
+    names = make_bakery(bakery_dir, size, depth, url, source)
+
+    sys.path.insert(0, TOASTER)
+
+    from bakery import add_bakery
+    from bakery import refresh_bakeries
+    from catalog import search_packages
+    from packages import get_dependants
+    from packages import get_info
+    from packages import install_package
+    from packages import remove_package
+    from packages import update_all_packages
+
+    results = {}
+
+    add_bakery('bench', bakery_dir)
+    results['refresh_bakeries (clone)'] = timed(refresh_bakeries)
+
+    # Change one package, so only it is scanned again
+    changed = names['binary'][0]
+    write_package(bakery_dir, changed, package_toml(
+        changed, 'binary', url, source, version='1.1'))
+    git(bakery_dir, 'commit', '-qam', 'Update one package')
+    results['refresh_bakeries (one changed)'] = timed(refresh_bakeries)
+
+    sample = (names['binary'] + names['build'])[:LOOKUPS]
+    results['get_info'] = timed(lambda: [get_info(name, from_installed=False)
+                                         for name in sample]) / len(sample)
+
+    # A name, a prefix of names, a word every package has and a misspelling of it
+    queries = [names['build'][-1], 'chai', 'synthetic', 'sinthetic package']
+    results['search_packages'] = timed(lambda: [search_packages(query)
+                                                for _ in range(LOOKUPS // len(queries)) for query in queries]) / LOOKUPS
+
+    binaries = names['binary'][1:BINARY_INSTALLS + 1]
+    builds = names['build'][:BUILD_INSTALLS]
+
+    results['install_package (binary)'] = statistics.median(
+        timed(install_package, name) for name in binaries)
+    results['install_package (build)'] = statistics.median(
+        timed(install_package, name) for name in builds)
+    results[f'install_package (chain of {depth})'] = timed(
+        install_package, names['chain'][0])
+
+    last = names['chain'][-1]
+    results['get_dependants'] = timed(lambda: [get_dependants(last)
+                                               for _ in range(LOOKUPS)]) / LOOKUPS
+
+    # Only build packages can be updated
+    for name in builds:
+        write_package(bakery_dir, name, package_toml(
+            name, 'build', url, source, version='2.0'))
+
+    git(bakery_dir, 'commit', '-qam', 'Update build packages')
+    refresh_bakeries()
+    results['update_all_packages'] = timed(update_all_packages)
+
+    results['remove_package'] = statistics.median(
+        timed(remove_package, name) for name in binaries + builds)
+    results[f'remove_package (chain of {depth})'] = timed(
+        lambda: [remove_package(name) for name in names['chain']])
+
+    return results
+
+
+def run_scenario(size, depth):
+    """Run a scenario in a fresh toaster home"""
+    with tempfile.TemporaryDirectory() as tmp:
+        home = os.path.join(tmp, 'home')
+        make_home(home)
+        output = os.path.join(tmp, 'results.json')
+
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', str(size), str(depth), output],
+                                env={**os.environ, 'HOME': home}, cwd=tmp,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+        if result.returncode:
+            sys.exit(f'Scenario size={size}, depth={depth} failed:\n{result.stderr}')
+
+        with open(output) as f:
+            return json.load(f)
+
+
+def compare(results, baseline, tolerance):
+    """Returns the operations which are slower than the baseline allows"""
+    regressions = []
+
+    for name, elapsed in results.items():
+        base = baseline.get(name)
+
+        if base is not None and elapsed > base * (1 + tolerance) and elapsed - base > NOISE:
+            regressions.append((name, base, elapsed))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000',
+                        help='Comma separated numbers of packages in the bakery')
+    parser.add_argument('--depths', default='1,16',
+                        help='Comma separated lengths of the dependency chain')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How many times to run each scenario')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Compare against results saved in this JSON file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='How much slower than the baseline an operation may get, 0.25 is 25%%')
+    parser.add_argument('--worker', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        size, depth, output = args.worker
+
+        with tempfile.TemporaryDirectory() as tmp:
+            results = worker(int(size), int(depth), tmp)
+
+        with open(output, 'w') as f:
+            json.dump(results, f)
+
+        return
+
+    results = {}
+
+    for size in map(int, args.sizes.split(',')):
+        for depth in map(int, args.depths.split(',')):
+            runs = [run_scenario(size, depth) for _ in range(args.repeat)]
+
+            for name in runs[0]:
+                key = f'{name} [size={size}, depth={depth}]'
+                elapsed = results[key] = statistics.median(run[name] for run in runs)
+                print(f'{key:<64} {elapsed * 1000:10.2f}ms', flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        print(f'Saved baseline to {args.baseline}')
+        return
+
+    if not os.path.exists(args.baseline):
+        return
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+
+    for name, base, elapsed in regressions:
+        print(f'REGRESSION {name}: {base * 1000:.2f}ms -> {elapsed * 1000:.2f}ms '
+              f'({(elapsed / base - 1) * 100:+.0f}%)', file=sys.stderr)
+
+    if regressions:
+        sys.exit(1)
+
+    print(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
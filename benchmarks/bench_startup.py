@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark how long toaster takes to start for each subcommand
+
+Every run is a fresh interpreter with an empty toaster home, so this measures cold start: imports,
+argument parsing and whatever the command does before it has anything to work on.
+
+Usage: python benchmarks/bench_startup.py [runs] [--cli path/to/cli.py] [--imports]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   '..', 'src', 'toaster', 'cli.py')
+
+# Commands which finish quickly without a network or installed packages
+COMMANDS = [
+    ['--help'],
+    ['info', '--help'],
+    ['info', 'nothing'],
+    ['install', '--help'],
+    ['remove', 'nothing'],
+    ['rollback', 'nothing'],
+    ['link', 'nothing'],
+    ['cache'],
+    ['bottle'],
+]
+
+
+def make_home(tmp):
+    """Make an empty toaster home"""
+    toaster = os.path.join(tmp, '.toaster')
+
+    for d in ['.cache', 'apps', 'bakery', 'binaries', 'bin', 'packages', 'package_data', 'etc']:
+        os.makedirs(os.path.join(toaster, d))
+
+    with open(os.path.join(toaster, 'bakery.json'), 'w') as f:
+        f.write('{}')
+
+
+def run(cli, args, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, cli] + args, env=env, cwd=os.path.dirname(cli),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def top_imports(cli, args, env, count=5):
+    """Returns the slowest top level imports of a command, from python -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', cli] + args, env=env,
+                            cwd=os.path.dirname(cli), stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    imports = []
+
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+
+        # Only modules imported directly by the command, not what they import themselves
+        if not name.startswith('  '):
+            imports.append((int(cumulative) / 1000, name.strip()))
+
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('runs', nargs='?', type=int, default=10)
+    parser.add_argument('--cli', default=CLI, help='cli.py to benchmark')
+    parser.add_argument('--imports', action='store_true',
+                        help='Also show the slowest imports of each command')
+    args = parser.parse_args()
+
+    cli = os.path.abspath(args.cli)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_home(tmp)
+        env = {**os.environ, 'HOME': tmp}
+
+        # Warm the OS file cache, so the first command isn't slower just because it ran first
+        run(cli, ['--help'], env)
+
+        print(f'{"command":<24} {"min":>8} {"median":>8}')
+
+        for command in COMMANDS:
+            times = [run(cli, command, env) for _ in range(args.runs)]
+            print(f'{" ".join(command):<24} {min(times) * 1000:6.0f}ms {statistics.median(times) * 1000:6.0f}ms')
+
+            if args.imports:
+                for elapsed, name in top_imports(cli, command, env):
+                    print(f'    {name:<20} {elapsed:6.0f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Content-addressed store for downloaded package archives
+"""
+import contextlib
+import hashlib
+import os
+import threading
+import time
+
+import locks
+from config import get_config
+from database import connect
+from exceptions import Locked
+from utils import hash_file
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+store_dir = os.path.join(toaster_loc, '.cache', 'artifacts')
+store_db_loc = os.path.join(toaster_loc, '.cache', 'artifacts.db')
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS artifacts (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS artifacts_last_used ON artifacts (last_used)',
+    '''CREATE TABLE IF NOT EXISTS urls (
+        url TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256)',
+    '''CREATE TABLE IF NOT EXISTS validators (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT
+    )''',
+]
+
+# URLs which have already been downloaded or revalidated by this process
+_checked = set()
+_checked_lock = threading.Lock()
+
+# The artifacts each thread has pinned in its outermost `pinned` block
+_pins = threading.local()
+
+
+def get_store_db():
+    """Returns a connection to the artifact store's index"""
+    os.makedirs(os.path.dirname(store_db_loc), exist_ok=True)
+    return connect(store_db_loc, schema)
+
+
+def artifact_loc(sha256):
+    """Get the location of an artifact in the store"""
+    return os.path.join(store_dir, sha256[:2], sha256)
+
+
+def _pin_name(sha256):
+    return f'artifact-{sha256}'
+
+
+@contextlib.contextmanager
+def pinned():
+    """Keep the artifacts used in this block from being evicted by any toaster process until it ends
+
+    Artifacts are pinned with a shared lock each, which gc has to take exclusively to delete them."""
+    if getattr(_pins, 'stack', None) is not None:
+        yield
+        return
+
+    with contextlib.ExitStack() as stack:
+        _pins.stack = stack
+        _pins.names = set()
+
+        try:
+            yield
+        finally:
+            _pins.stack = None
+
+
+def _pin(sha256):
+    name = _pin_name(sha256)
+
+    if name not in _pins.names:
+        _pins.stack.enter_context(locks.shared(name))
+        _pins.names.add(name)
+
+
+def _use(sha256):
+    conn = get_store_db()
+
+    with conn:
+        conn.execute('UPDATE artifacts SET last_used = ? WHERE sha256 = ?',
+                     (time.time(), sha256))
+
+
+def lookup(url):
+    """Get the location of the artifact downloaded from a URL, or None if it isn't in the store
+
+    The artifact is pinned until the `pinned` block this is called in ends."""
+    row = get_store_db().execute(
+        'SELECT sha256 FROM urls WHERE url = ?', (url,)).fetchone()
+
+    if not row:
+        return None
+
+    with pinned():
+        _pin(row['sha256'])
+
+        # Checked once it's pinned, since it can't be evicted after that
+        if os.path.exists(artifact_loc(row['sha256'])):
+            _use(row['sha256'])
+            return artifact_loc(row['sha256'])
+
+
+def _get_validators(url):
+    row = get_store_db().execute(
+        'SELECT etag, last_modified FROM validators WHERE url = ?', (url,)).fetchone()
+
+    if row:
+        return dict(row)
+
+
+def _set_validators(url, validators):
+    conn = get_store_db()
+
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO validators VALUES (?, ?, ?)',
+                     (url, validators.get('etag'), validators.get('last_modified')))
+
+
+def add(file_name, url=None):
+    """Move a file into the store, returns its location in the store
+
+    If the same content is already stored the file is deleted instead. The artifact is pinned until
+    the `pinned` block this is called in ends."""
+    sha256 = hash_file(file_name)
+    loc = artifact_loc(sha256)
+
+    # Pinned before it is stored, an evicting process would delete it as soon as it is
+    with pinned():
+        _pin(sha256)
+
+        os.makedirs(os.path.dirname(loc), exist_ok=True)
+
+        if os.path.exists(loc):
+            os.remove(file_name)
+        else:
+            os.replace(file_name, loc)
+
+        conn = get_store_db()
+
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)',
+                         (sha256, os.path.getsize(loc), time.time()))
+
+            if url:
+                conn.execute(
+                    'INSERT OR REPLACE INTO urls VALUES (?, ?)', (url, sha256))
+
+        _use(sha256)
+
+        return loc
+
+
+def _was_checked(url):
+    with _checked_lock:
+        return url in _checked
+
+
+def fetch(url, extract=None):
+    """Get an artifact from the store, downloading it first if needed, returns its location
+
+    Stored artifacts are revalidated with the server once per run, and downloaded again if they changed.
+    If `extract` is given and the artifact has to be downloaded, it is called with a file object of the
+    download so it can be extracted while it arrives.
+    The artifact is pinned until the fetch ends, or the `pinned` block it is called in does."""
+    with pinned():
+        return _fetch(url, extract)
+
+
+def _fetch(url, extract):
+    # Only loaded when something may have to be downloaded, looking at the store doesn't need them
+    import requests
+    from downloads import download_file
+    from downloads import NotModified
+    from downloads import stream_file
+    from filelock import FileLock
+
+    loc = lookup(url)
+    validators = _get_validators(url)
+
+    if loc and (_was_checked(url) or not validators or not get_config('revalidate_downloads')):
+        return loc
+
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Named after the URL so an interrupted download can be resumed next time
+    tmp = os.path.join(
+        store_dir, f'download-{hashlib.sha1(url.encode()).hexdigest()}')
+
+    with FileLock(f'{tmp}.lock'):
+        # Someone else may have downloaded it while we waited
+        if _was_checked(url) and lookup(url):
+            return lookup(url)
+
+        try:
+            if extract:
+                validators = stream_file(
+                    url, tmp, extract, validators=validators if loc else None)
+            else:
+                validators = download_file(
+                    url, tmp, validators=validators if loc else None)
+        except NotModified:
+            validators = None
+        except requests.RequestException:
+            # Use what we have if the server can't be reached
+            if not loc:
+                raise
+
+            validators = None
+        else:
+            loc = add(tmp, url)
+
+            if validators:
+                _set_validators(url, validators)
+
+        with _checked_lock:
+            _checked.add(url)
+
+    gc()
+
+    return loc
+
+
+def usage():
+    """Returns how many artifacts are stored and how many bytes they use"""
+    row = get_store_db().execute(
+        'SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS size FROM artifacts').fetchone()
+
+    return row['count'], row['size']
+
+
+def gc(max_bytes=None):
+    """Delete the least recently used artifacts until the store fits in `max_bytes`
+
+    Returns how many artifacts were deleted and how many bytes that freed."""
+    if max_bytes is None:
+        max_bytes = get_config('artifact_cache_size')
+
+    conn = get_store_db()
+    _, total = usage()
+    deleted = 0
+    freed = 0
+
+    for row in conn.execute('SELECT sha256, size FROM artifacts ORDER BY last_used').fetchall():
+        if total - freed <= max_bytes:
+            break
+
+        try:
+            with locks.exclusive(_pin_name(row['sha256']), wait=False):
+                with conn:
+                    # Validators are only any use while what they validate is stored
+                    conn.execute('DELETE FROM validators WHERE url IN (SELECT url FROM urls WHERE sha256 = ?)',
+                                 (row['sha256'],))
+                    conn.execute('DELETE FROM urls WHERE sha256 = ?', (row['sha256'],))
+                    conn.execute('DELETE FROM artifacts WHERE sha256 = ?',
+                                 (row['sha256'],))
+
+                if os.path.exists(artifact_loc(row['sha256'])):
+                    os.remove(artifact_loc(row['sha256']))
+        except Locked:
+            # Pinned by a fetch or install which is still using it
+            continue
+
+        deleted += 1
+        freed += row['size']
+
+    return deleted, freed
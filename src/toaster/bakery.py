@@ -1,115 +1,244 @@
-from asyncore import write
-import os
 import json
+import os
 import shutil
-from atomicwrites import AtomicWriter
-from git import Repo
+import time
+from concurrent.futures import as_completed
+
+import locks
+import manifests
+import spec
 import toml
+import tracing
+from atomicwrites import AtomicWriter
+from catalog import all_packages
+from catalog import has_bakery
+from catalog import LOCK
+from catalog import remove_bakery
+from catalog import write_bakeries
+from config import get_config
 from exceptions import AlreadyInstalled
-from utils import CloneProgress, where_is_toaster, secho, errecho
-from filelock import Timeout, SoftFileLock
+from git import GitCommandError
+from git import Repo
+from progress import CloneProgress
+from scheduler import make_executor
+from utils import dependingonsys
+from utils import errecho
+from utils import secho
+from utils import where_is_toaster
 
 toaster_loc = where_is_toaster()
 
-db_lock_file = os.path.join(toaster_loc, 'bakery.json.lock')
-db_lock = SoftFileLock(db_lock_file, timeout=1)
-
-
-def check_lock():
-    """Check if database file is locked"""
-    try:
-        db_lock.acquire()
-    except:
-        errecho(
-            f'Unable to unlock database.\nIf you are sure another toaster process is not running, you can remove {db_lock_file}')
-        exit(1)
-
 
 def get_database():
     """Reads the database from file"""
-    check_lock()
-
-    with open(os.path.join(toaster_loc, 'bakery.json'), 'r') as f:
-        return json.loads(f.read())
-
+    with locks.shared(LOCK):
+        with open(os.path.join(toaster_loc, 'bakery.json'), 'r') as f:
+            return json.loads(f.read())
 
-def write_database(db, release=True):
-    """Overwrite the database with an updated one"""
-    check_lock()
 
-    with AtomicWriter(os.path.join(toaster_loc, 'bakery.json'), 'w', overwrite=True).open() as f:
-        f.write(json.dumps(db))
+def write_database(db):
+    """Overwrite the database with an updated one
 
-    if release:
-        # Release lock
-        db_lock.release()
+    Hold the catalog's exclusive lock from reading the database until writing it, so changes made
+    by other toaster processes in between aren't lost."""
+    with locks.exclusive(LOCK):
+        with AtomicWriter(os.path.join(toaster_loc, 'bakery.json'), 'w', overwrite=True).open() as f:
+            f.write(json.dumps(db))
 
 
 def add_bakery(name, loc):
     """Adds a bakery"""
-    db = get_database()
+    with locks.exclusive(LOCK):
+        db = get_database()
 
-    if name in db:
-        secho(f'Bakery "{name}" exists, re-adding...', fg='yellow')
+        if name in db:
+            secho(f'Bakery "{name}" exists, re-adding...', fg='yellow')
 
-    db[name] = {}
-    db[name]['repo'] = loc
+        db[name] = {}
+        db[name]['repo'] = loc
 
-    write_database(db)
+        write_database(db)
 
 
 def rm_bakery(name, loc):
     """Removes a bakery"""
-    db = get_database()
+    with locks.exclusive(LOCK):
+        db = get_database()
 
-    if not name in db:
-        raise KeyError(name)
+        if not name in db:
+            raise KeyError(name)
 
-    del db[name]
+        del db[name]
 
-    write_database(db)
+        remove_bakery(name)
+        write_database(db)
 
 
-def refresh_bakeries():
-    """Refreshes all bakeries"""
-    db = get_database()
+def _changed_folders(repo, old_head, new_head):
+    """Get the set of files changed between two commits, or None if the old commit isn't available"""
+    if old_head == new_head:
+        return set()
+
+    try:
+        return set(repo.git.diff('--name-only', '--no-renames', old_head, new_head).splitlines())
+    except GitCommandError:
+        return None
+
 
-    for bakery in db:
-        git_url = db[bakery]['repo']
+def _refresh_bakery(bakery, entry):
+    """Pull or clone a single bakery and rescan whatever changed since it was last indexed
+
+    Returns a dict with the bakery's new `head`, its `info` (None if unchanged), the `packages` that were
+    rescanned, the package names to `remove` from the catalog first (None to replace all of them)
+    and the `time` it took."""
+    start = time.monotonic()
+
+    # Another toaster process could be pulling the same bakery
+    with tracing.span('refresh_bakery', bakery=bakery), locks.exclusive(f'bakery-{bakery}'):
+        git_url = entry['repo']
         repo_dir = os.path.join(toaster_loc, 'bakery', bakery)
 
         if os.path.exists(repo_dir):
             repo = Repo(repo_dir)
             repo.remotes.origin.pull()
         else:
-            Repo.clone_from(git_url, repo_dir,
-                            progress=CloneProgress(bakery, git_url))
+            # Bakeries are only ever read, so history isn't needed
+            repo = Repo.clone_from(git_url, repo_dir, depth=1,
+                                   progress=CloneProgress(bakery, git_url))
+
+        head = repo.head.commit.hexsha
+        changed = None
+
+        if entry.get('head') and has_bakery(bakery):
+            changed = _changed_folders(repo, entry['head'], head)
+
+        result = {'head': head, 'info': None, 'packages': []}
+
+        if changed is None or '_toaster.toml' in changed:
+            package_toml = toml.load(os.path.join(repo_dir, '_toaster.toml'))
 
-        package_toml = toml.load(os.path.join(repo_dir, '_toaster.toml'))
+            info = {}
 
-        db[bakery]['name'] = package_toml['name']
-        db[bakery]['maintainer'] = package_toml['maintainer']
-        db[bakery]['description'] = package_toml['description']
+            info['name'] = package_toml['name']
+            info['maintainer'] = package_toml['maintainer']
+            info['description'] = package_toml['description']
 
-        subfolders = [f.name for f in os.scandir(repo_dir) if f.is_dir()]
+            result['info'] = info
 
-        packages = []
+        if changed is None:
+            subfolders = [f.name for f in os.scandir(repo_dir) if f.is_dir()]
+            result['remove'] = None
+        else:
+            subfolders = sorted({p.split('/')[0] for p in changed if '/' in p})
+            result['remove'] = [f for f in subfolders if not f.startswith('.')]
 
         for folder in subfolders:
-            if not (folder.startswith('.')):
-                packages.append(folder)
+            if not (folder.startswith('.')) and os.path.isdir(os.path.join(repo_dir, folder)):
+                package = _scan_package(repo_dir, folder)
 
-        db[bakery]['packages'] = packages
+                if package:
+                    result['packages'].append(package)
 
-    write_database(db)
+    result['time'] = time.monotonic() - start
 
+    return result
 
-def get_all_packages():
-    """Returns a list of all available packages"""
+
+def _scan_package(repo_dir, package):
+    """Read the catalog info for a package in a bakery"""
+    try:
+        package_toml = manifests.load(os.path.join(
+            repo_dir, package, f'{package}.toml'))
+    except FileNotFoundError:
+        return
+    except toml.TomlDecodeError as e:
+        errecho(f'Skipping {package}, its TOML is invalid: {e}')
+        return
+
+    return {
+        'name': package,
+        'version': package_toml.get('version'),
+        'types': package_toml.get('types', []),
+        'desc': package_toml.get('desc'),
+        'homepage': package_toml.get('homepage'),
+        'license': package_toml.get('license'),
+        'dependencies': dependingonsys(package_toml, 'dependencies', append_mode=True),
+        'spec': spec.resolve(package_toml, package),
+    }
+
+
+def index_clones(bakeries):
+    """Add bakeries to the catalog from their clones as they are, without pulling them"""
+    db = get_database()
+    catalog = {}
+
+    for bakery in bakeries:
+        if bakery not in db:
+            continue
+
+        repo_dir = os.path.join(toaster_loc, 'bakery', bakery)
+
+        # Not while a refresh is pulling it
+        with locks.shared(f'bakery-{bakery}'):
+            packages = [_scan_package(repo_dir, folder) for folder in sorted(os.listdir(repo_dir))
+                        if not folder.startswith('.') and os.path.isdir(os.path.join(repo_dir, folder))]
+
+        catalog[bakery] = (list(db).index(bakery), [p for p in packages if p], None)
+
+    with locks.exclusive(LOCK):
+        # A refresh could have added them meanwhile, with newer packages
+        write_bakeries({bakery: entry for bakery, entry in catalog.items()
+                        if bakery in get_database() and not has_bakery(bakery)})
+
+
+@tracing.traced()
+def refresh_bakeries(jobs=None):
+    """Refreshes all bakeries at once, returns a dict of bakery -> seconds it took to refresh"""
     db = get_database()
-    pkgl = {}
+    timings = {}
+    results = {}
 
-    for bakery in db:
-        pkgl[bakery] = db[bakery]['packages']
+    # Pulling doesn't hold the catalog's lock, so other toaster processes can keep using it meanwhile
+    with make_executor(jobs or get_config('refresh_jobs')) as executor:
+        futures = {executor.submit(_refresh_bakery, bakery, db[bakery]): bakery
+                   for bakery in db}
 
-    return pkgl
+        for future in as_completed(futures):
+            bakery = futures[future]
+
+            try:
+                results[bakery] = future.result()
+            except Exception as e:
+                errecho(f'Unable to refresh bakery "{bakery}": {e}')
+                continue
+
+            timings[bakery] = results[bakery]['time']
+
+    with locks.exclusive(LOCK):
+        # Read again, bakeries could have been added or removed by another toaster process
+        db = get_database()
+        catalog = {}
+
+        for bakery, result in results.items():
+            if bakery not in db:
+                continue
+
+            if result['info']:
+                db[bakery].update(result['info'])
+
+            db[bakery].pop('packages', None)
+            db[bakery]['head'] = result['head']
+            db[bakery]['refresh_time'] = result['time']
+
+            catalog[bakery] = (list(db).index(bakery),
+                               result['packages'], result['remove'])
+
+        write_bakeries(catalog)
+        write_database(db)
+
+    return timings
+
+
+def get_all_packages():
+    """Returns a dict of bakery -> list of its packages"""
+    return all_packages()
@@ -0,0 +1,228 @@
+"""
+Cache of finished builds ("bottles"), so build packages are only compiled once per recipe, source and platform
+"""
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import time
+import zlib
+
+import tracing
+from config import get_config
+from extract import extract_tar
+from extract import UnsafeArchive
+from utils import errecho
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+bottles_dir = os.path.join(toaster_loc, '.cache', 'bottles')
+
+
+def source_id(repo_dir=None, file_name=None):
+    """Identify a build's source by its git commit or its archive's hash"""
+    if repo_dir:
+        from git import Repo
+
+        return Repo(repo_dir).head.commit.hexsha
+
+    # Archives are named after their hash in the artifact store
+    return os.path.basename(file_name)
+
+
+def key(package_spec, source, package_dir):
+    """Get the key of a build, or None if bottles are turned off
+
+    The package's Spec is already resolved for this platform. Builds can have their prefix baked in,
+    so it is part of the key as well. That is the generation an update builds into, not the package's
+    usual location, since a build which was bottled there still points into that generation."""
+    if not get_config('bottles'):
+        return None
+
+    recipe = {
+        'name': package_spec.name,
+        'version': package_spec.version,
+        'dependencies': package_spec.dependencies,
+        'build': {name: getattr(package_spec.build, name) for name in package_spec.build.__slots__},
+    }
+
+    data = json.dumps([recipe, source, package_spec.platform, package_dir],
+                      sort_keys=True, default=str)
+
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def bottle_loc(bottle):
+    """Get the location of a bottle's archive, its metadata is kept next to it"""
+    return os.path.join(bottles_dir, f'{bottle}.tar.gz')
+
+
+def _meta_loc(bottle):
+    return os.path.join(bottles_dir, f'{bottle}.json')
+
+
+@tracing.traced('pour_bottle')
+def pour(bottle, package_dir):
+    """Unpack a bottle into `package_dir`, returns False if there is no such bottle or it can't be used
+
+    A bottle that fails to unpack is deleted along with whatever it unpacked, so the package is built instead."""
+    if not bottle or not os.path.exists(bottle_loc(bottle)):
+        return False
+
+    try:
+        extract_tar(package_dir, bottle_loc(bottle), strip=0)
+    except (UnsafeArchive, tarfile.TarError, OSError, EOFError, zlib.error) as e:
+        errecho(f'Not using a broken bottle, building instead: {e}')
+        shutil.rmtree(package_dir, ignore_errors=True)
+        remove(bottle)
+        return False
+
+    # Used to decide which bottles to delete first
+    os.utime(bottle_loc(bottle))
+
+    return True
+
+
+def _portable(package_dir):
+    """Check a build only has symlinks which extracting it again allows, absolute ones or ones leading out aren't"""
+    real_dir = os.path.realpath(package_dir)
+
+    for root, dirs, files in os.walk(package_dir):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+
+            if not os.path.islink(path):
+                continue
+
+            linkname = os.readlink(path)
+            resolved = os.path.realpath(os.path.join(os.path.realpath(root), linkname))
+
+            if os.path.isabs(linkname) or not (resolved == real_dir or resolved.startswith(real_dir + os.sep)):
+                return False
+
+    return True
+
+
+@tracing.traced('pack_bottle')
+def pack(bottle, package_dir, package_spec, source):
+    """Save a finished build as a bottle, unless it couldn't be poured again"""
+    if not bottle or not _portable(package_dir):
+        return
+
+    os.makedirs(bottles_dir, exist_ok=True)
+    tmp = f'{bottle_loc(bottle)}.tmp-{os.getpid()}'
+
+    with tarfile.open(tmp, 'w:gz') as tar:
+        tar.add(package_dir, arcname='.')
+
+    with open(_meta_loc(bottle), 'w') as f:
+        json.dump({
+            'package': package_spec.name,
+            'version': package_spec.version,
+            'platform': package_spec.platform,
+            'source': source,
+            'prefix': package_dir,
+            'time': time.time(),
+        }, f)
+
+    os.replace(tmp, bottle_loc(bottle))
+
+    gc()
+
+
+def list_bottles():
+    """Returns the metadata of every bottle by key"""
+    bottles = {}
+
+    if not os.path.exists(bottles_dir):
+        return bottles
+
+    for filename in os.listdir(bottles_dir):
+        if not filename.endswith('.json'):
+            continue
+
+        bottle = filename[:-len('.json')]
+
+        if os.path.exists(bottle_loc(bottle)):
+            with open(_meta_loc(bottle)) as f:
+                bottles[bottle] = json.load(f)
+
+    return bottles
+
+
+def export_bottles(dest, packages=None):
+    """Copy bottles to `dest` so they can be imported on another machine, returns how many were copied"""
+    os.makedirs(dest, exist_ok=True)
+    count = 0
+
+    for bottle, meta in list_bottles().items():
+        if packages and meta['package'] not in packages:
+            continue
+
+        shutil.copyfile(bottle_loc(bottle), os.path.join(
+            dest, os.path.basename(bottle_loc(bottle))))
+        shutil.copyfile(_meta_loc(bottle), os.path.join(
+            dest, os.path.basename(_meta_loc(bottle))))
+        count += 1
+
+    return count
+
+
+def import_bottles(src):
+    """Copy bottles exported with `export_bottles` into the cache, returns how many were copied
+
+    Bottles are only used on machines where their key matches, so bottles for other platforms are
+    imported but never poured."""
+    os.makedirs(bottles_dir, exist_ok=True)
+    count = 0
+
+    for filename in os.listdir(src):
+        if not filename.endswith('.json'):
+            continue
+
+        bottle = filename[:-len('.json')]
+        archive = os.path.join(src, os.path.basename(bottle_loc(bottle)))
+
+        if not os.path.exists(archive):
+            continue
+
+        tmp = f'{bottle_loc(bottle)}.tmp-{os.getpid()}'
+        shutil.copyfile(archive, tmp)
+        shutil.copyfile(os.path.join(src, filename), _meta_loc(bottle))
+        os.replace(tmp, bottle_loc(bottle))
+        count += 1
+
+    return count
+
+
+def usage():
+    """Returns how many bytes each bottle uses by key"""
+    return {bottle: os.path.getsize(bottle_loc(bottle)) for bottle in list_bottles()}
+
+
+def gc(max_bytes=None):
+    """Delete the least recently used bottles until they fit in `max_bytes`, returns how many bytes were freed"""
+    if max_bytes is None:
+        max_bytes = get_config('bottle_cache_size')
+
+    sizes = usage()
+    total = sum(sizes.values())
+    freed = 0
+
+    for bottle in sorted(sizes, key=lambda b: os.path.getmtime(bottle_loc(b))):
+        if total - freed <= max_bytes:
+            break
+
+        remove(bottle)
+        freed += sizes[bottle]
+
+    return freed
+
+
+def remove(bottle):
+    """Delete a bottle and its metadata"""
+    for loc in (bottle_loc(bottle), _meta_loc(bottle)):
+        if os.path.exists(loc):
+            os.remove(loc)
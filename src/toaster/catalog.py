@@ -0,0 +1,337 @@
+"""
+SQLite catalog of every package available from the bakeries
+"""
+import json
+import os
+import pickle
+
+import locks
+import search
+import spec
+import tracing
+from database import connect
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+catalog_loc = os.path.join(toaster_loc, 'catalog.db')
+
+# Held shared while the catalog or bakery.json is read and exclusive while either is written
+LOCK = 'catalog'
+
+# The whole catalog, kept in memory by toasterd for as long as catalog.db doesn't change
+_memory = None
+
+# Bakeries are only looked for in the catalog once per process, see _index_clones
+_clones_checked = False
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS packages (
+        name TEXT NOT NULL,
+        bakery TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        version TEXT,
+        types TEXT NOT NULL,
+        dependencies TEXT NOT NULL,
+        PRIMARY KEY (bakery, name)
+    )''',
+    'CREATE INDEX IF NOT EXISTS packages_name ON packages (name, priority)',
+    # Packages resolved for this platform when their bakery was refreshed, see spec.py
+    '''CREATE TABLE IF NOT EXISTS specs (
+        name TEXT NOT NULL,
+        bakery TEXT NOT NULL,
+        spec BLOB NOT NULL,
+        PRIMARY KEY (bakery, name)
+    )''',
+    # The search index, see search.py
+    '''CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        bakery TEXT NOT NULL,
+        desc TEXT NOT NULL,
+        homepage TEXT NOT NULL,
+        license TEXT NOT NULL,
+        UNIQUE (bakery, name)
+    )''',
+    # Postings point at documents by id, which keeps the biggest table small
+    '''CREATE TABLE IF NOT EXISTS terms (
+        term TEXT NOT NULL,
+        document INTEGER NOT NULL,
+        field INTEGER NOT NULL,
+        PRIMARY KEY (term, document, field)
+    ) WITHOUT ROWID''',
+    # Postings are removed by their document, whatever terms its fields were split into back then
+    'CREATE INDEX IF NOT EXISTS terms_document ON terms (document)',
+    '''CREATE TABLE IF NOT EXISTS grams (
+        gram TEXT NOT NULL,
+        term TEXT NOT NULL,
+        PRIMARY KEY (gram, term)
+    ) WITHOUT ROWID''',
+]
+
+# Tables with a row per package
+_PACKAGE_TABLES = ('packages', 'specs', 'documents')
+
+
+def get_catalog():
+    """Returns a connection to the catalog"""
+    return connect(catalog_loc, schema)
+
+
+def _to_dict(row):
+    return {
+        'name': row['name'],
+        'bakery': row['bakery'],
+        'version': row['version'],
+        'types': json.loads(row['types']),
+        'dependencies': json.loads(row['dependencies']),
+    }
+
+
+def write_bakeries(bakeries):
+    """Update the packages of bakeries in one transaction
+
+    `bakeries` is a dict of bakery name -> (priority, list of package dicts, names to remove).
+    If the names to remove are None, all of the bakery's old packages are replaced."""
+    conn = get_catalog()
+
+    with locks.exclusive(LOCK), conn:
+        for bakery, (priority, packages, remove) in bakeries.items():
+            _unindex(conn, bakery, remove)
+
+            for table in _PACKAGE_TABLES:
+                if remove is None:
+                    conn.execute(
+                        f'DELETE FROM {table} WHERE bakery = ?', (bakery,))
+                else:
+                    conn.executemany(f'DELETE FROM {table} WHERE bakery = ? AND name = ?',
+                                     [(bakery, name) for name in remove])
+
+            conn.executemany(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)',
+                [(p['name'], bakery, priority, p['version'], json.dumps(p['types']), json.dumps(p['dependencies']))
+                 for p in packages])
+            conn.executemany(
+                'INSERT OR REPLACE INTO specs VALUES (?, ?, ?)',
+                [(p['name'], bakery, pickle.dumps((spec.SCHEMA, p['spec']), protocol=pickle.HIGHEST_PROTOCOL))
+                 for p in packages if p.get('spec')])
+            conn.execute(
+                'UPDATE packages SET priority = ? WHERE bakery = ?', (priority, bakery))
+
+            _index(conn, bakery, packages)
+
+
+def _unindex(conn, bakery, names=None):
+    """Remove a bakery's packages from the search index, all of them if `names` is None"""
+    conn.execute('CREATE TEMP TABLE old_documents (id INTEGER PRIMARY KEY)')
+
+    if names is None:
+        conn.execute(
+            'INSERT INTO old_documents SELECT id FROM documents WHERE bakery = ?', (bakery,))
+    else:
+        conn.executemany('INSERT INTO old_documents SELECT id FROM documents WHERE bakery = ? AND name = ?',
+                         [(bakery, name) for name in names])
+
+    removed = {row['term'] for row in conn.execute(
+        'SELECT DISTINCT term FROM terms WHERE document IN old_documents')}
+    conn.execute('DELETE FROM terms WHERE document IN old_documents')
+    conn.execute('DROP TABLE old_documents')
+
+    # Trigrams are only kept for terms some package still has
+    fuzzy = {term for term in removed if search.is_fuzzy(term)}
+    gone = fuzzy - _indexed(conn, fuzzy)
+    conn.executemany('DELETE FROM grams WHERE gram = ? AND term = ?',
+                     [(gram, term) for term in gone for gram in search.grams(term)])
+
+
+def _indexed(conn, terms):
+    """Get which of these terms any package has"""
+    return {term for term in terms
+            if conn.execute('SELECT 1 FROM terms WHERE term = ? LIMIT 1', (term,)).fetchone()}
+
+
+@tracing.traced('search_index')
+def _index(conn, bakery, packages):
+    """Add packages to the search index, after their old entries were removed by _unindex"""
+    rows = []
+
+    for p in packages:
+        document = conn.execute(
+            'INSERT OR REPLACE INTO documents (name, bakery, desc, homepage, license) VALUES (?, ?, ?, ?, ?)',
+            (p['name'], bakery, str(p.get('desc') or ''), str(p.get('homepage') or ''), str(p.get('license') or ''))).lastrowid
+        rows.extend((term, document, field) for term, field in search.terms(p))
+
+    new = {row[0] for row in rows if search.is_fuzzy(row[0])}
+    new -= _indexed(conn, new)
+
+    # Inserting in key order is much faster than inserting all over the table, and SQLite sorts faster than Python
+    conn.execute('CREATE TEMP TABLE new_terms (term, document, field)')
+    conn.execute('CREATE TEMP TABLE new_grams (gram, term)')
+    conn.executemany('INSERT INTO new_terms VALUES (?, ?, ?)', rows)
+    conn.executemany('INSERT INTO new_grams VALUES (?, ?)',
+                     [(gram, term) for term in new for gram in search.grams(term)])
+    conn.execute(
+        'INSERT OR IGNORE INTO terms SELECT * FROM new_terms ORDER BY term, document, field')
+    conn.execute(
+        'INSERT OR IGNORE INTO grams SELECT * FROM new_grams ORDER BY gram, term')
+    conn.execute('DROP TABLE new_terms')
+    conn.execute('DROP TABLE new_grams')
+
+
+def has_bakery(bakery):
+    """Check if the catalog has any packages from a bakery
+
+    Catalogs from before search existed don't count, and neither do bakeries whose specs were stored
+    by a toaster with other Specs, so those bakeries are scanned again in full."""
+    with locks.shared(LOCK):
+        conn = get_catalog()
+
+        if conn.execute('SELECT 1 FROM documents WHERE bakery = ? LIMIT 1', (bakery,)).fetchone() is None:
+            return False
+
+        # A full scan stores every spec again, so one of them tells
+        row = conn.execute(
+            'SELECT spec FROM specs WHERE bakery = ? LIMIT 1', (bakery,)).fetchone()
+
+    return row is None or _load_spec(row['spec']) is not None
+
+
+def remove_bakery(bakery):
+    """Remove all of a bakery's packages from the catalog"""
+    conn = get_catalog()
+
+    with locks.exclusive(LOCK), conn:
+        _unindex(conn, bakery)
+
+        for table in _PACKAGE_TABLES:
+            conn.execute(f'DELETE FROM {table} WHERE bakery = ?', (bakery,))
+
+
+def _index_clones():
+    """Scan the bakeries which are cloned but missing from the catalog, like after upgrading from a
+    toaster without one, since the catalog is otherwise only filled by a refresh"""
+    global _clones_checked
+
+    if _clones_checked:
+        return
+
+    _clones_checked = True
+
+    try:
+        with locks.shared(LOCK):
+            with open(os.path.join(toaster_loc, 'bakery.json')) as f:
+                bakeries = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    missing = [bakery for bakery in bakeries
+               if os.path.isdir(os.path.join(toaster_loc, 'bakery', bakery)) and not has_bakery(bakery)]
+
+    if missing:
+        # Loads git, which looking packages up doesn't need otherwise
+        from bakery import index_clones
+
+        index_clones(missing)
+
+
+def _catalog_key():
+    try:
+        st = os.stat(catalog_loc)
+    except FileNotFoundError:
+        return None
+
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _load_spec(blob):
+    """Unpickle a stored Spec, or None if it was stored by a toaster whose Specs had other fields"""
+    try:
+        schema, package_spec = pickle.loads(blob)
+    except (pickle.PickleError, AttributeError, TypeError, ValueError, EOFError):
+        return None
+
+    return package_spec if schema == spec.SCHEMA else None
+
+
+def warm():
+    """Load the whole catalog into memory, lookups then use it until catalog.db changes"""
+    global _memory
+
+    _index_clones()
+
+    if _memory and _memory['key'] == _catalog_key():
+        return
+
+    with locks.shared(LOCK):
+        key = _catalog_key()
+        conn = get_catalog()
+        packages = {}
+
+        for row in conn.execute('SELECT * FROM packages ORDER BY priority DESC'):
+            packages.setdefault(row['name'], _to_dict(row))
+
+        specs = {(row['bakery'], row['name']): _load_spec(row['spec'])
+                 for row in conn.execute('SELECT * FROM specs')}
+
+    _memory = {'key': key, 'packages': packages, 'specs': specs}
+
+
+def _warm():
+    """Get the catalog in memory if it is still current"""
+    if _memory and _memory['key'] == _catalog_key():
+        return _memory
+
+
+def find_package(package):
+    """Look up a package, returns a dict of its catalog info or None if it isn't in any bakery
+
+    If more than one bakery has the package, the bakery added last wins."""
+    _index_clones()
+
+    if _warm():
+        return _memory['packages'].get(package)
+
+    with locks.shared(LOCK):
+        row = get_catalog().execute(
+            'SELECT * FROM packages WHERE name = ? ORDER BY priority DESC LIMIT 1', (package,)).fetchone()
+
+    if row:
+        return _to_dict(row)
+
+
+def find_spec(package, bakery):
+    """Get the Spec stored for a bakery's package when it was refreshed, or None if there isn't one"""
+    _index_clones()
+
+    if _warm():
+        return _memory['specs'].get((bakery, package))
+
+    with locks.shared(LOCK):
+        row = get_catalog().execute(
+            'SELECT spec FROM specs WHERE bakery = ? AND name = ?', (bakery, package)).fetchone()
+
+    if row:
+        return _load_spec(row['spec'])
+
+
+def all_packages():
+    """Returns a dict of bakery -> list of package names"""
+    _index_clones()
+    pkgl = {}
+
+    with locks.shared(LOCK):
+        rows = get_catalog().execute(
+            'SELECT bakery, name FROM packages ORDER BY priority, name').fetchall()
+
+    for row in rows:
+        pkgl.setdefault(row['bakery'], []).append(row['name'])
+
+    return pkgl
+
+
+def search_packages(query, limit=20, fuzzy=True):
+    """Search every bakery's packages, see search.find"""
+    _index_clones()
+
+    with locks.shared(LOCK):
+        return search.find(get_catalog(), query, limit, fuzzy)
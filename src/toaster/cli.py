@@ -1,29 +1,28 @@
 #!/usr/bin/env python3
+import os
 import platform
 import sys
 from urllib.parse import urlparse
 
+# Hand the command to toasterd if it is running, before loading anything the daemon already has
+if __name__ == '__main__' and sys.argv[1:2] != ['daemon']:
+    import daemon
+
+    code = daemon.forward(sys.argv[1:])
+
+    if code is not None:
+        sys.exit(code)
+
 import click
-import sysupdates
-import validators
-from bakery import add_bakery
-from bakery import refresh_bakeries
-from bakery import rm_bakery
 from click_aliases import ClickAliasedGroup
+from config import get_config
 from exceptions import *
-from packages import get_all_packages
-from packages import get_info as get_package_info
-from packages import get_package_loc
-from packages import install_package
-from packages import make_symlinks
-from packages import remove_package
-from packages import remove_symlinks
-from packages import update_all_packages
-from packages import update_package
 from utils import echo
 from utils import errecho
 from utils import secho
-from utils import update_toaster
+
+# Commands import what they need themselves, so each command only loads the modules it uses.
+# Loading git, requests and friends up front is most of toaster's startup time.
 
 
 # https://stackoverflow.com/a/58770064
@@ -40,6 +39,16 @@ class GroupedGroup(ClickAliasedGroup):
 
         return wrapper
 
+    def invoke(self, ctx):
+        """Run a command, exiting with a message if another toaster process holds a lock for too long"""
+        try:
+            return super().invoke(ctx)
+        except Locked as e:
+            name, holder = e.args
+            errecho(
+                f"Gave up waiting for {f'toaster process {holder}' if holder else 'another toaster process'} to finish with {name}.\nYou can wait longer by setting `lock_timeout` in your config.")
+            sys.exit(1)
+
     def format_commands(self, ctx, formatter):
         # Modified fom the base class method
 
@@ -68,12 +77,49 @@ class GroupedGroup(ClickAliasedGroup):
 
 
 @click.group(cls=GroupedGroup)
-def cli():
-    pass
+@click.option('--profile', is_flag=True, help='Time each step of the command and show where the time went')
+@click.option('--profile-output', help='Where --profile writes a Chrome trace of the command', default='toaster-trace.json', show_default=True)
+@click.pass_context
+def cli(ctx, profile, profile_output):
+    if profile:
+        import tracing
+
+        tracing.enable()
+        ctx.call_on_close(lambda: report_profile(profile_output))
+
+
+def report_profile(loc):
+    """Show a summary of the command's spans and write all of them as a Chrome trace"""
+    import tracing
+
+    collected = tracing.events()
+    wall = tracing.wall_time()
+    rows = tracing.summary(collected)
+
+    secho('\n:: Profile', fg='bright_magenta', err=True)
+
+    if rows:
+        width = max(len(name) for name, *_ in rows)
+        secho(f"{'span':<{width}} {'count':>6} {'total':>10} {'max':>10}", bold=True, err=True)
+
+        for name, count, total, longest in rows:
+            echo(f'{name:<{width}} {count:>6} {total * 1000:>8.1f}ms {longest * 1000:>8.1f}ms', err=True)
+
+    echo(f'Total: {wall * 1000:.1f}ms', err=True)
+
+    try:
+        tracing.write_chrome_trace(collected, loc)
+        secho(f'Trace written to {os.path.abspath(loc)}, open it in chrome://tracing or ui.perfetto.dev', fg='bright_black', err=True)
+    except OSError as e:
+        errecho(f"Couldn't write the trace to {loc}: {e}")
+    finally:
+        tracing.finish()
 
 
 def refresh_db(auto=False):
     """Refresh bakeries (this is for commands to use)"""
+    from bakery import refresh_bakeries
+
     msg = 'Refreshing bakeries...'
 
     if auto:
@@ -81,7 +127,11 @@ def refresh_db(auto=False):
 
     secho(
         f':: {msg}', fg='bright_magenta')
-    refresh_bakeries()
+    timings = refresh_bakeries()
+
+    for name, elapsed in sorted(timings.items(), key=lambda t: t[1], reverse=True):
+        secho(f'{name}: {elapsed:.2f}s', fg='bright_black')
+
     secho(
         'Bakeries updated :)', fg='bright_green')
 
@@ -96,6 +146,9 @@ def refresh():
 @click.argument('bakeries', nargs=-1, required=True, type=str)
 def bakery(bakeries):
     """Add a bakery"""
+    import validators
+    from bakery import add_bakery
+
     for bakery in bakeries:
         if validators.url(bakery):
             # Git url
@@ -125,6 +178,9 @@ def bakery(bakeries):
 @click.argument('bakeries', nargs=-1, required=True, type=str)
 def unbake(bakeries):
     """Remove a bakery"""
+    import validators
+    from bakery import rm_bakery
+
     for bakery in bakeries:
         if validators.url(bakery):
             # Git url
@@ -159,6 +215,8 @@ def unbake(bakeries):
 @click.argument('packages', nargs=-1, required=True, type=str)
 def info(packages):
     """Get info about a package"""
+    from packages import get_info as get_package_info
+
     for package in packages:
         try:
             package_toml = get_package_info(package)
@@ -195,20 +253,55 @@ def info(packages):
                 f"Architectures: {', '.join(archs) or 'None'}", fg='green')
 
 
+@cli.command(help='Search packages by name, description, homepage and license', group='Packages')
+@click.argument('query', nargs=-1, required=True, type=str)
+@click.option('--limit', '-n', help='How many packages to show', type=click.IntRange(1), default=20, show_default=True)
+@click.option('--fuzzy/--no-fuzzy', help='Also find misspelled words', default=True)
+def search(query, limit, fuzzy):
+    """Search packages"""
+    from catalog import search_packages
+
+    total, results, truncated = search_packages(' '.join(query), limit, fuzzy)
+
+    if not results:
+        errecho(f"No packages match {' '.join(query)}.")
+        sys.exit(1)
+
+    for result in results:
+        secho(f"{result['name']} {result['version'] or ''}", fg='bright_magenta', bold=True, nl=False)
+        secho(f" ({result['bakery']})", fg='bright_black')
+
+        if result['desc']:
+            echo(f"    {result['desc']}")
+
+    if total > len(results):
+        secho(f'{total - len(results)} more, show them with --limit {total}', fg='bright_black')
+
+    for word in truncated:
+        secho(f'Too many words start with "{word}", only some of them were searched. Type more of it to see the rest.',
+              fg='bright_black')
+
+
 @cli.command(help='Install packages', group='Packages')
 @click.argument('packages', nargs=-1, required=True, type=str)
 @click.option('--refresh', help='Refresh Packages', default=True)
-def install(packages, refresh):
+@click.option('--jobs', '-j', help='How many downloads/builds to run at once', type=int, default=None)
+def install(packages, refresh, jobs):
     """Install a package"""
+    from packages import install_packages
+
     if refresh:
         refresh_db(auto=True)
 
-    for package in packages:
-        secho(
-            f':: Installing {package}...', fg='bright_magenta')
+    secho(
+        f':: Installing {", ".join(packages)}...', fg='bright_magenta')
 
+    errors = install_packages(packages, jobs=jobs)
+
+    for package in packages:
         try:
-            install_package(package)
+            if errors[package]:
+                raise errors[package]
         except NotFound:
             errecho(f'{package} could not be found.')
         except AlreadyInstalled:
@@ -220,6 +313,14 @@ def install(packages, refresh):
         except UseNotFound as e:
             errecho(
                 f'{package} requires the external dependency `{e}`, which could not be found!')
+        except DependencyCycle as e:
+            errecho(
+                f'{package} could not be installed because its dependencies loop: {e}')
+        except DependencyFailed:
+            errecho(
+                f'{package} could not be installed because one of its dependencies failed to install.')
+        except Exception as e:
+            errecho(f'{package} failed to install: {e}')
         else:
             secho(
                 f'{package} installed!', fg='bright_green')
@@ -229,6 +330,8 @@ def install(packages, refresh):
 @click.argument('packages', nargs=-1, required=True, type=str)
 def remove(packages):
     """Remove a package"""
+    from packages import remove_package
+
     for package in packages:
         secho(
             f':: Remoivng {package}...', fg='bright_magenta')
@@ -250,6 +353,11 @@ def remove(packages):
 @click.option('--refresh', help='Refresh Packages', default=True)
 def update(packages, refresh):
     """Update a package"""
+    import sysupdates
+    from packages import update_all_packages
+    from packages import update_package
+    from utils import update_toaster
+
     if not packages:
         packages = ['all']
 
@@ -323,15 +431,43 @@ def update(packages, refresh):
         except NotImplementedError:
             errecho(
                 f'{package} was found but is not available because it is a binary or app which is not supported yet.')
+        except BuildFailed as e:
+            errecho(
+                f'{package} failed to build while running {e.args[0]}, the installed version was kept.')
         else:
             secho(
                 f'{package} updated!', fg='bright_green')
 
 
+@cli.command(help='Go back to the version a package was updated from', group='Packages')
+@click.argument('packages', nargs=-1, required=True, type=str)
+def rollback(packages):
+    """Roll back a package"""
+    from packages import rollback_package
+
+    for package in packages:
+        secho(
+            f':: Rolling back {package}...', fg='bright_magenta')
+
+        try:
+            version = rollback_package(package)
+        except NotFound:
+            errecho(f'{package} is not installed.')
+        except NoPreviousVersion:
+            errecho(f'{package} has no previous version to roll back to.')
+        else:
+            secho(
+                f'Rolled back {package} to {version or "its previous version"}!', fg='bright_green')
+
+
 @cli.command(help='Link packages to your path', group='Packages')
 @click.argument('packages', nargs=-1, type=str)
 @click.option('--force/--no-force', help='Force packages to be linked', default=False)
 def link(packages, force):
+    from packages import get_info as get_package_info
+    from packages import get_package_loc
+    from packages import make_symlinks
+
     for package in packages:
         secho(
             f':: Linking {package}...', fg='bright_magenta')
@@ -352,6 +488,10 @@ def link(packages, force):
 @cli.command(help='Unlink packages from your path', group='Packages')
 @click.argument('packages', nargs=-1, type=str)
 def unlink(packages):
+    from packages import get_info as get_package_info
+    from packages import get_package_loc
+    from packages import remove_symlinks
+
     for package in packages:
         secho(
             f':: Uninking {package}...', fg='bright_magenta')
@@ -369,5 +509,197 @@ def unlink(packages):
             f'Unlinked {package}!', fg='bright_green')
 
 
+@cli.command(name='list', help='List installed packages', aliases=['ls'], group='Packages')
+def list_packages():
+    """List installed packages"""
+    from packages import get_installed
+
+    for row in get_installed():
+        echo(
+            f"{row['name']} {row['version'] or ''} ({row['kind']}, {row['files']} files, {format_size(row['size'])})")
+
+
+@cli.command(help='Find which packages own files', group='Packages')
+@click.argument('paths', nargs=-1, required=True, type=str)
+def owns(paths):
+    """Find which package owns a file"""
+    import manifest
+    from packages import index_installed
+
+    index_installed()
+
+    for path in paths:
+        found = manifest.owner(path)
+
+        if found:
+            echo(f'{path} is owned by {found[0]}')
+        else:
+            errecho(f'{path} is not owned by any package.')
+
+
+@cli.command(help="Check installed packages' files haven't changed", group='Packages')
+@click.argument('packages', nargs=-1, type=str)
+@click.option('--quick', is_flag=True, help='Only compare sizes and permissions instead of hashes')
+def verify(packages, quick):
+    """Verify installed packages"""
+    import manifest
+    from packages import get_installed
+
+    # Also indexes packages installed before manifests were recorded
+    installed = [row['name'] for row in get_installed()]
+
+    if not packages:
+        packages = installed
+
+    for package in packages:
+        secho(
+            f':: Verifying {package}...', fg='bright_magenta')
+
+        problems = manifest.verify(package, quick)
+
+        if problems is None:
+            errecho(f'{package} is not installed.')
+            continue
+
+        for path, problem in problems:
+            errecho(f'{path}: {problem}')
+
+        if problems:
+            errecho(f'{package} has {len(problems)} changed files!')
+        else:
+            secho(
+                f'{package} is intact!', fg='bright_green')
+
+
+def format_size(size):
+    """Format a number of bytes for humans"""
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+
+        size /= 1024
+
+    return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+
+
+@cli.command(help='Show cache usage and clean it up', group='Cache')
+@click.option('--gc', 'run_gc', is_flag=True, help='Delete least recently used cache entries until the cache fits in its size limits')
+def cache(run_gc):
+    """Show and garbage collect the cache"""
+    import artifacts
+    import bottles
+    import gitcache
+    import manifests
+    import store
+
+    if run_gc:
+        from packages import index_installed
+
+        secho(
+            ':: Cleaning up cache...', fg='bright_magenta')
+
+        # Stored files are kept for the packages the manifests say use them
+        index_installed()
+
+        deleted, freed = artifacts.gc()
+        freed += gitcache.evict()
+        deleted_files, freed_files = store.gc()
+        freed += freed_files
+        freed += bottles.gc()
+        # Parsed TOMLs are only kept for the TOMLs still on disk as they are
+        freed += manifests.gc()
+
+        secho(
+            f'Deleted {deleted} artifacts and {deleted_files} stored files, freed {format_size(freed)}!', fg='bright_green')
+
+    count, size = artifacts.usage()
+    mirrors = gitcache.usage()
+    stored, stored_size = store.usage()
+    bottle_sizes = bottles.usage()
+    parsed, parsed_size = manifests.usage()
+
+    secho(
+        f"Artifacts: {count} ({format_size(size)} of {format_size(get_config('artifact_cache_size'))})", fg='bright_yellow')
+    secho(
+        f"Git mirrors: {len(mirrors)} ({format_size(sum(mirrors.values()))} of {format_size(get_config('git_cache_size'))})", fg='bright_yellow')
+    secho(
+        f'Stored files: {stored} ({format_size(stored_size)})', fg='bright_yellow')
+    secho(
+        f"Bottles: {len(bottle_sizes)} ({format_size(sum(bottle_sizes.values()))} of {format_size(get_config('bottle_cache_size'))})", fg='bright_yellow')
+    secho(
+        f'Parsed manifests: {parsed} ({format_size(parsed_size)})', fg='bright_yellow')
+
+
+@cli.command(help='List, export and import prebuilt packages', group='Cache')
+@click.argument('packages', nargs=-1, type=str)
+@click.option('--export', 'export_dir', type=click.Path(file_okay=False), help='Copy bottles to a directory, only those of PACKAGES if given')
+@click.option('--import', 'import_dir', type=click.Path(exists=True, file_okay=False), help='Add bottles exported on another machine')
+def bottle(packages, export_dir, import_dir):
+    """Manage bottles"""
+    import bottles
+
+    if import_dir:
+        count = bottles.import_bottles(import_dir)
+        secho(f'Imported {count} bottles!', fg='bright_green')
+
+    if export_dir:
+        count = bottles.export_bottles(export_dir, packages)
+        secho(f'Exported {count} bottles to {export_dir}!', fg='bright_green')
+
+    if import_dir or export_dir:
+        return
+
+    for key, meta in sorted(bottles.list_bottles().items(), key=lambda b: b[1]['package'] or ''):
+        if packages and meta['package'] not in packages:
+            continue
+
+        echo(
+            f"{meta['package']} {meta['version'] or ''} ({' '.join(meta['platform'])}, {format_size(os.path.getsize(bottles.bottle_loc(key)))})")
+
+
+@cli.command(help='Start, stop or check on toasterd, which makes commands start faster', group='Other')
+@click.argument('action', type=click.Choice(['start', 'stop', 'status', 'run']), default='status')
+def daemon(action):
+    """Manage toasterd"""
+    import time
+
+    import daemon as toasterd
+
+    status = toasterd.control('status')
+
+    if action == 'run':
+        toasterd.Server().serve()
+    elif action == 'start':
+        if status:
+            return secho(f"toasterd is already running ({status['pid']}).", fg='bright_black')
+
+        pid = toasterd.start()
+
+        # Loading everything takes a moment, commands run in their own process until then
+        for _ in range(100):
+            if toasterd.control('status'):
+                return secho(f'toasterd started ({pid})!', fg='bright_green')
+
+            time.sleep(0.1)
+
+        errecho(f'toasterd did not start, see {toasterd.log_loc}')
+    elif action == 'stop':
+        if not status:
+            return errecho('toasterd is not running.')
+
+        toasterd.control('stop')
+        secho('toasterd will stop once its running commands finish.', fg='bright_green')
+    elif status:
+        secho(f"toasterd is running ({status['pid']})", fg='bright_green')
+
+        for args in status['running']:
+            echo(f"Running: toaster {' '.join(args)}")
+
+        for args in status['queued']:
+            echo(f"Queued: toaster {' '.join(args)}")
+    else:
+        echo('toasterd is not running.')
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,59 @@
+"""
+User configuration for toaster
+"""
+import os
+
+import toml
+from utils import where_is_toaster
+
+config_loc = os.path.join(where_is_toaster(), 'etc', 'toaster.toml')
+
+defaults = {
+    # How many packages can be downloaded/built at the same time
+    'jobs': os.cpu_count() or 1,
+    # How many build jobs may run at once across all packages being built, see `{jobs}` in scripts
+    'build_jobs': os.cpu_count() or 1,
+    # Which kind of worker pool to use for installs, `thread` or `process`
+    'pool': 'thread',
+    # How many bakeries can be refreshed at the same time
+    'refresh_jobs': 8,
+    # How many parsed package TOMLs to keep in memory
+    'manifest_cache_size': 512,
+    # Whether to also keep parsed package TOMLs in .cache/manifests
+    'manifest_cache_persist': True,
+    # Most bytes the git mirrors in .cache/git may use before old ones are deleted
+    'git_cache_size': 2 * 1024 ** 3,
+    # Most bytes downloaded archives in .cache/artifacts may use before old ones are deleted
+    'artifact_cache_size': 2 * 1024 ** 3,
+    # How many ranged requests a download may be split into
+    'download_segments': 4,
+    # Files smaller than twice this are always downloaded with one request
+    'download_segment_min_size': 8 * 1024 ** 2,
+    # Whether to check with the server that cached downloads haven't changed
+    'revalidate_downloads': True,
+    # Whether to extract tar archives while they download
+    'stream_extract': True,
+    # Whether finished builds are cached in .cache/bottles and reused instead of building again
+    'bottles': True,
+    # Most bytes bottles may use before old ones are deleted
+    'bottle_cache_size': 2 * 1024 ** 3,
+    # How installed files are shared with identical ones in the store, `auto`, `reflink`, `hardlink` or `off`
+    'dedupe': 'auto',
+    # Seconds to wait for another toaster process to release a lock before giving up
+    'lock_timeout': 600,
+}
+
+_config = None
+
+
+def get_config(key):
+    """Get a config value from etc/toaster.toml, falling back to its default"""
+    global _config
+
+    if _config is None:
+        _config = {}
+
+        if os.path.exists(config_loc):
+            _config = toml.load(config_loc)
+
+    return _config.get(key, defaults[key])
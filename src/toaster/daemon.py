@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""
+toasterd, which keeps toaster loaded and its indexes warm and runs commands sent by the CLI
+
+Each command runs in a process forked from the daemon, so it starts with everything already
+imported and loaded, and its output goes straight back to the CLI that sent it. A command is
+interrupted like Ctrl-C would once every CLI waiting for it hangs up.
+This module is imported by the CLI before anything else, so it must stay light.
+"""
+import json
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+
+# Same as utils.where_is_toaster, which would load click
+toaster_loc = os.path.join(os.path.expanduser('~'), '.toaster')
+
+socket_loc = os.path.join(toaster_loc, 'toasterd.sock')
+log_loc = os.path.join(toaster_loc, 'toasterd.log')
+
+# Set to run commands in the CLI's own process even if toasterd is running
+DISABLE_ENV = 'TOASTER_NO_DAEMON'
+
+# Commands which change installed packages, they run one at a time and identical ones are run once
+QUEUED = {'install', 'remove', 'uninstall', 'update', 'rollback', 'link', 'unlink'}
+
+# Messages from the daemon are a type byte and a length, followed by that many bytes
+_HEADER = struct.Struct('>cI')
+STDOUT = b'o'
+STDERR = b'e'
+EXIT = b'x'
+# The CLI should run the command itself, like when toaster's code changed since toasterd started
+FALLBACK = b'f'
+
+# A CLI has this long to send its request, and requests can't be bigger than this
+_REQUEST_TIMEOUT = 5
+_MAX_REQUEST = 16 * 1024 * 1024
+
+
+def _recv_exactly(sock, size):
+    data = b''
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+
+        if not chunk:
+            raise ConnectionError('toasterd closed the connection')
+
+        data += chunk
+
+    return data
+
+
+def _connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(socket_loc)
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def _send_request(sock, request):
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+
+def forward(args):
+    """Run a command in toasterd, returns its exit code or None if it has to run in this process"""
+    if os.environ.get(DISABLE_ENV) or not os.path.exists(socket_loc):
+        return None
+
+    sock = _connect()
+
+    if not sock:
+        return None
+
+    with sock:
+        _send_request(sock, {
+            'args': args,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+            'color': sys.stdout.isatty(),
+        })
+
+        streams = {STDOUT: sys.stdout.buffer, STDERR: sys.stderr.buffer}
+
+        try:
+            while True:
+                kind, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+                data = _recv_exactly(sock, size)
+
+                if kind == EXIT:
+                    return int(data)
+
+                if kind == FALLBACK:
+                    return None
+
+                streams[kind].write(data)
+                streams[kind].flush()
+        except ConnectionError as e:
+            sys.stderr.write(f'{e}\n')
+            return 1
+
+
+def control(command):
+    """Send `status` or `stop` to toasterd, returns its reply or None if it isn't running"""
+    sock = _connect()
+
+    if not sock:
+        return None
+
+    with sock:
+        _send_request(sock, {'control': command})
+        return json.loads(sock.makefile().readline())
+
+
+def start():
+    """Start toasterd in the background, returns its PID"""
+    import subprocess
+
+    with open(log_loc, 'ab') as log:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.DEVNULL,
+                                stdout=log, stderr=log, start_new_session=True).pid
+
+
+class _Client:
+    """A connected CLI, its socket never blocks the daemon
+
+    Its request is read and its output written whenever the selector says it can be, output it isn't
+    ready for yet waits in `outbox`."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.inbox = b''
+        self.outbox = bytearray()
+        self.deadline = time.monotonic() + _REQUEST_TIMEOUT
+        self.events = 0
+        self.closing = False
+        self.closed = False
+
+        sock.setblocking(False)
+        server.clients.add(self)
+        self._watch(selectors.EVENT_READ)
+
+    def _watch(self, events):
+        selector = self.server.selector
+
+        if events == self.events:
+            return
+
+        if not self.events:
+            selector.register(self.sock, events, self)
+        elif not events:
+            selector.unregister(self.sock)
+        else:
+            selector.modify(self.sock, events, self)
+
+        self.events = events
+
+    def ready(self, events):
+        if events & selectors.EVENT_WRITE:
+            self.flush()
+
+        if events & selectors.EVENT_READ and not self.closed:
+            self.receive()
+
+    def receive(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        # CLIs send nothing after their request, so reading anything then is one hanging up
+        if not data or self.inbox is None or len(self.inbox) + len(data) > _MAX_REQUEST:
+            self.close()
+            return
+
+        self.inbox += data
+
+        if b'\n' not in self.inbox:
+            return
+
+        line = self.inbox.split(b'\n', 1)[0]
+        self.inbox = None
+        self._watch(selectors.EVENT_WRITE if self.outbox else selectors.EVENT_READ)
+
+        try:
+            request = json.loads(line)
+        except ValueError:
+            self.close()
+            return
+
+        self.server.handle(self, request)
+
+    def write(self, data):
+        if self.closed:
+            return
+
+        self.outbox += data
+        self.flush()
+
+    def flush(self):
+        try:
+            while self.outbox:
+                del self.outbox[:self.sock.send(self.outbox)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            # The CLI went away
+            self.close()
+            return
+
+        if self.outbox:
+            self._watch(selectors.EVENT_WRITE)
+        elif self.closing:
+            self.close()
+        else:
+            self._watch(selectors.EVENT_READ)
+
+    def finish(self):
+        """Close the connection once everything written to it was sent"""
+        self.closing = True
+        self.flush()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._watch(0)
+        self.sock.close()
+        self.closed = True
+        self.server.clients.discard(self)
+        self.server.hang_up(self)
+
+
+class _Job:
+    """A command running in a forked process, with every CLI waiting for its output"""
+
+    def __init__(self, request, client, queued=False):
+        self.request = request
+        self.key = tuple(request['args'])
+        self.queued = queued
+        self.clients = [client]
+        self.pid = None
+        self.pipes = {}
+        # Everything sent so far, for CLIs which send the same command while it runs
+        self.sent = []
+
+    def attach(self, client):
+        """Send the command's output to another CLI as well, starting with what it missed"""
+        self.clients.append(client)
+        client.write(b''.join(self.sent))
+
+    def send(self, kind, data):
+        message = _HEADER.pack(kind, len(data)) + data
+        self.sent.append(message)
+
+        # CLIs which hang up while this is written to them are detached by Server.hang_up
+        for client in list(self.clients):
+            client.write(message)
+
+
+class Server:
+    """The daemon's accept loop, it only ever runs on one thread so forking is safe"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.running = {}
+        self.queue = []
+        self.clients = set()
+        self.stopping = False
+        self.code_mtime = _code_mtime()
+
+    def preload(self):
+        """Import everything commands use and load the catalog, manifests and installed index"""
+        import cli  # noqa: F401
+        import bakery  # noqa: F401
+        import downloads  # noqa: F401
+        import gitcache  # noqa: F401
+        import packaging.version  # noqa: F401
+
+        self.warm()
+
+    def warm(self):
+        """Load whatever changed since the last command into memory, before the next command is forked"""
+        import catalog
+        import packages
+        import spec
+
+        catalog.warm()
+        packages.index_installed()
+
+        for row in packages.get_installed():
+            loc = os.path.join(toaster_loc, 'package_data', f"{row['name']}.toml")
+
+            if os.path.exists(loc):
+                spec.load(loc, row['name'])
+
+    def serve(self):
+        if os.path.exists(socket_loc):
+            sock = _connect()
+
+            if sock:
+                sock.close()
+                raise RuntimeError('toasterd is already running')
+
+            # Left over by a toasterd which didn't exit cleanly
+            os.remove(socket_loc)
+
+        self.preload()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+
+        try:
+            listener.bind(socket_loc)
+        finally:
+            os.umask(old_umask)
+
+        listener.listen()
+        self.selector.register(listener, selectors.EVENT_READ)
+        print(f'toasterd {os.getpid()} listening on {socket_loc}', flush=True)
+
+        try:
+            while not self.stopping or self.running or self.queue or self.clients:
+                for key, events in self.selector.select(timeout=1):
+                    if key.fileobj is listener:
+                        self.accept(listener)
+                    elif isinstance(key.data, _Client):
+                        key.data.ready(events)
+                    else:
+                        self.read(key.fileobj, key.data)
+
+                self.expire()
+        finally:
+            self.selector.unregister(listener)
+            listener.close()
+
+            if os.path.exists(socket_loc):
+                os.remove(socket_loc)
+
+    def accept(self, listener):
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+
+        _Client(self, sock)
+
+    def expire(self):
+        """Hang up on CLIs which never sent their request"""
+        now = time.monotonic()
+
+        for client in list(self.clients):
+            if client.inbox is not None and now > client.deadline:
+                client.close()
+
+    def handle(self, client, request):
+        if 'control' in request:
+            if request['control'] == 'stop':
+                self.stopping = True
+
+            client.write(json.dumps({
+                'pid': os.getpid(),
+                'running': [list(job.key) for job in self.running.values()],
+                'queued': [list(job.key) for job in self.queue],
+                'stopping': self.stopping,
+            }).encode() + b'\n')
+            client.finish()
+            return
+
+        # Commands have to run with the code the CLI has, so a daemon running old code steps aside
+        if self.stopping or _code_mtime() != self.code_mtime:
+            self.stopping = True
+            client.write(_HEADER.pack(FALLBACK, 0))
+            client.finish()
+            return
+
+        args = request['args']
+
+        if _command(args) in QUEUED:
+            # The same command sent while it is waiting or running is only run once
+            for job in list(self.running.values()) + self.queue:
+                if job.key == tuple(args):
+                    job.attach(client)
+                    return
+
+            self.queue.append(_Job(request, client, queued=True))
+            self.start_queued()
+        else:
+            self.start(_Job(request, client))
+
+    def start_queued(self):
+        if self.queue and not any(job.queued for job in self.running.values()):
+            self.start(self.queue.pop(0))
+
+    def start(self, job):
+        self.warm()
+
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            # Its own process group, so hang_up interrupts the scripts it runs as well
+            os.setpgid(0, 0)
+            os.close(out_r)
+            os.close(err_r)
+
+            # Only the daemon talks to CLIs. Their sockets are only closed, unregistering them would
+            # change the selector the daemon shares with this process
+            for key in list(self.selector.get_map().values()):
+                if isinstance(key.fileobj, socket.socket):
+                    key.fileobj.close()
+
+            for client in self.clients:
+                client.sock.close()
+
+            _run_child(job.request, out_w, err_w)
+
+        os.close(out_w)
+        os.close(err_w)
+
+        # Also set here, in case the child didn't get to it before hang_up needs it
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+
+        job.pid = pid
+        job.pipes = {out_r: STDOUT, err_r: STDERR}
+        self.running[pid] = job
+
+        for fd in job.pipes:
+            self.selector.register(fd, selectors.EVENT_READ, job)
+
+    def hang_up(self, client):
+        """Stop sending output to a CLI which closed its connection
+
+        A command nothing waits for anymore is dropped from the queue, or interrupted with SIGINT like
+        Ctrl-C would have, so it can clean up after itself."""
+        for job in list(self.running.values()) + self.queue:
+            if client not in job.clients:
+                continue
+
+            job.clients.remove(client)
+
+            if job.clients:
+                continue
+
+            if job.pid is None:
+                self.queue.remove(job)
+                continue
+
+            try:
+                os.killpg(job.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    def read(self, fd, job):
+        data = os.read(fd, 65536)
+
+        if data:
+            job.send(job.pipes[fd], data)
+            return
+
+        self.selector.unregister(fd)
+        os.close(fd)
+        del job.pipes[fd]
+
+        if job.pipes:
+            return
+
+        _, status = os.waitpid(job.pid, 0)
+        del self.running[job.pid]
+
+        code = os.waitstatus_to_exitcode(status)
+
+        # Killed by a signal, exit like a shell would report it
+        if code < 0:
+            code = 128 - code
+
+        job.send(EXIT, str(code).encode())
+
+        for client in job.clients:
+            client.finish()
+
+        self.start_queued()
+
+
+def _command(args):
+    """Get the command in a CLI's args, after any of toaster's own options"""
+    import cli
+
+    takes_value = {opt for param in cli.cli.params if not getattr(param, 'is_flag', False)
+                   for opt in param.opts}
+    args = iter(args)
+
+    for arg in args:
+        if arg == '--':
+            return next(args, None)
+
+        if not arg.startswith('-'):
+            return arg
+
+        if arg in takes_value:
+            next(args, None)
+
+    return None
+
+
+def _code_mtime():
+    """Newest modification time of toaster's code"""
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+
+    return max(os.stat(os.path.join(code_dir, f)).st_mtime_ns
+               for f in os.listdir(code_dir) if f.endswith('.py'))
+
+
+def _run_child(request, out_w, err_w):
+    """Run a command in a forked daemon process, never returns"""
+    code = 1
+
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_w, 1)
+        os.dup2(err_w, 2)
+
+        # Started in the background, toasterd may ignore SIGINT, commands have to get it like Ctrl-C
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+
+        sys.stdout.reconfigure(line_buffering=True)
+
+        import cli
+        import config
+        import links
+
+        # The config file and PATH can change between commands
+        config._config = None
+        links._index = None
+
+        cli.cli.main(args=request['args'], prog_name='toaster',
+                     color=request['color'] or None)
+        code = 0
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            sys.stderr.write(f'{e.code}\n')
+
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        import traceback
+
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+if __name__ == '__main__':
+    Server().serve()
@@ -0,0 +1,30 @@
+"""
+Shared helpers for toaster's SQLite databases
+"""
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+
+def connect(loc, schema):
+    """Returns this thread's connection to a database, running its schema statements when first opened"""
+    conns = getattr(_local, 'conns', None)
+
+    # Connections can't be shared with forked worker processes
+    if conns is None or _local.pid != os.getpid():
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+
+    if loc not in conns:
+        conn = sqlite3.connect(loc, timeout=30)
+        conn.row_factory = sqlite3.Row
+
+        with conn:
+            for statement in schema:
+                conn.execute(statement)
+
+        conns[loc] = conn
+
+    return conns[loc]
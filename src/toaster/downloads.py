@@ -0,0 +1,339 @@
+"""
+Resumable, conditional downloads over pooled connections, split into several ranged requests when the server allows it
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+import tracing
+from config import get_config
+from requests.adapters import HTTPAdapter
+from tqdm.auto import tqdm
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = (10, 60)
+
+# How often the progress of a segmented download is saved, in seconds
+STATE_SAVE_INTERVAL = 0.5
+
+
+class RangeNotSatisfied(Exception):
+    """Raised when a server ignores a Range header"""
+    pass
+
+
+class NotModified(Exception):
+    """Raised when a conditional download finds the file hasn't changed"""
+    pass
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """Returns a keep-alive session shared by every download from a URL's host"""
+    parts = urlsplit(url)
+    host = f'{parts.scheme}://{parts.netloc}'
+
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max(
+                1, get_config('download_segments') * get_config('jobs')))
+
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            _sessions[host] = session
+
+        return _sessions[host]
+
+
+def _validators(r):
+    """Get the headers a response can be revalidated with later"""
+    return {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+
+
+def _conditional_headers(validators):
+    headers = {}
+
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    return headers
+
+
+def _probe(url, headers):
+    """Find out how big a file is, whether the server supports ranged requests and its validators"""
+    try:
+        r = get_session(url).head(url, headers=headers,
+                                  allow_redirects=True, timeout=TIMEOUT)
+
+        if r.status_code == 304:
+            raise NotModified(url)
+
+        r.raise_for_status()
+    except requests.RequestException:
+        return None, False, None
+
+    size = r.headers.get('Content-Length')
+    size = int(size) if size and size.isdigit() else None
+
+    return size, r.headers.get('Accept-Ranges', '').lower() == 'bytes', _validators(r)
+
+
+def _validator(validators):
+    """Get the single value used to check a partial download is still of the same file"""
+    if validators:
+        return validators['etag'] or validators['last_modified']
+
+
+def _load_state(state_loc, url, size, validator):
+    try:
+        with open(state_loc) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if state.get('url') == url and state.get('size') == size and state.get('validator') == validator:
+        return state
+
+
+def _save_state(state_loc, state):
+    with open(f'{state_loc}.tmp', 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(f'{state_loc}.tmp', state_loc)
+
+
+def _download_single(url, part_loc, can_resume, pbar, headers=None, size=None):
+    """Download a file with one request, continuing a partial file if the server supports it
+
+    `size` is how big the file should be, if known. Returns the response's validators."""
+    offset = os.path.getsize(part_loc) if can_resume and os.path.exists(part_loc) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else (headers or {})
+
+    with get_session(url).get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 304:
+            raise NotModified(url)
+
+        if r.status_code == 416 and offset:
+            # Nothing is left past the end of the partial file, which is complete if it is as big as the file
+            if r.headers.get('Content-Range') == f'bytes */{offset}' or size == offset:
+                pbar.total = offset
+                pbar.update(offset)
+                return _validators(r)
+
+            pbar.reset(total=size)
+            return _download_single(url, part_loc, False, pbar)
+
+        r.raise_for_status()
+
+        # The server sent the whole file instead of the rest of it
+        if r.status_code != 206:
+            offset = 0
+
+        length = r.headers.get('Content-Length')
+
+        if length and length.isdigit():
+            pbar.total = offset + int(length)
+
+        pbar.update(offset)
+
+        with open(part_loc, 'ab' if offset else 'wb') as output:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                output.write(chunk)
+                pbar.update(len(chunk))
+
+        return _validators(r)
+
+
+def _download_segment(url, part_loc, segment, state, lock, pbar):
+    """Download one byte range of a file into its place in the partial file"""
+    start, end = segment['start'] + segment['done'], segment['end']
+
+    if start > end:
+        return
+
+    headers = {'Range': f'bytes={start}-{end}'}
+
+    with get_session(url).get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            raise RangeNotSatisfied(url)
+
+        done = segment['done']
+        saved = time.monotonic()
+
+        with open(part_loc, 'r+b') as output:
+            output.seek(start)
+
+            def save():
+                # Progress is only saved once it is on disk, each segment saving its own
+                output.flush()
+                os.fsync(output.fileno())
+
+                with lock:
+                    segment['done'] = done
+                    _save_state(state['loc'], state['data'])
+
+            try:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    # Never write past the end of this segment
+                    chunk = chunk[:end + 1 - segment['start'] - done]
+
+                    if not chunk:
+                        break
+
+                    output.write(chunk)
+                    done += len(chunk)
+                    pbar.update(len(chunk))
+
+                    if time.monotonic() - saved > STATE_SAVE_INTERVAL:
+                        save()
+                        saved = time.monotonic()
+            finally:
+                save()
+
+
+def _download_segmented(url, part_loc, state_loc, size, validator, segments, pbar):
+    """Download a file with several ranged requests at once, resuming from the last saved progress"""
+    data = _load_state(state_loc, url, size, validator)
+
+    if not data or 'segments' not in data or not os.path.exists(part_loc):
+        segment_size = -(-size // segments)
+        data = {
+            'url': url,
+            'size': size,
+            'validator': validator,
+            'segments': [{'start': start, 'end': min(start + segment_size, size) - 1, 'done': 0}
+                         for start in range(0, size, segment_size)],
+        }
+
+        with open(part_loc, 'wb') as f:
+            f.truncate(size)
+
+        _save_state(state_loc, data)
+
+    pbar.update(sum(s['done'] for s in data['segments']))
+
+    state = {'loc': state_loc, 'data': data}
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=len(data['segments'])) as executor:
+        futures = [executor.submit(_download_segment, url, part_loc, segment, state, lock, pbar)
+                   for segment in data['segments']]
+
+        for future in futures:
+            future.result()
+
+
+@tracing.traced()
+def download_file(url, loc, segments=None, validators=None):
+    """Download a file
+
+    Large files are split into `segments` ranged requests run at the same time. Interrupted downloads
+    are kept in `loc`.part and continue from where they stopped next time.
+    If `validators` from an earlier download are given and the file hasn't changed since,
+    NotModified is raised instead. Returns the new file's validators."""
+    part_loc = f'{loc}.part'
+    state_loc = f'{part_loc}.json'
+    headers = _conditional_headers(validators)
+
+    if segments is None:
+        segments = get_config('download_segments')
+
+    size, accepts_ranges, new_validators = _probe(url, headers)
+    validator = _validator(new_validators)
+
+    with tqdm(total=size, unit='B', unit_scale=True, unit_divisor=1024, desc='') as pbar:
+        if accepts_ranges and size and segments > 1 and size >= 2 * get_config('download_segment_min_size'):
+            try:
+                _download_segmented(url, part_loc, state_loc, size,
+                                    validator, segments, pbar)
+            except RangeNotSatisfied:
+                pbar.reset(total=size)
+                _download_single(url, part_loc, False, pbar)
+        else:
+            # Only resume a single stream if the file on the server hasn't changed
+            state = _load_state(state_loc, url, size, validator)
+            can_resume = accepts_ranges and state is not None and 'segments' not in state
+
+            _save_state(state_loc, {'url': url, 'size': size, 'validator': validator})
+
+            try:
+                response_validators = _download_single(
+                    url, part_loc, can_resume, pbar, headers, size)
+            except NotModified:
+                os.remove(state_loc)
+                raise
+
+            new_validators = new_validators or response_validators
+
+    os.replace(part_loc, loc)
+    os.remove(state_loc)
+
+    return new_validators
+
+
+class _TeeReader:
+    """File object that copies everything read from a response into a file"""
+
+    def __init__(self, raw, output, pbar):
+        self.raw = raw
+        self.output = output
+        self.pbar = pbar
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.output.write(data)
+        self.pbar.update(len(data))
+
+        return data
+
+
+@tracing.traced()
+def stream_file(url, loc, consume, validators=None):
+    """Download a file while passing it to `consume` as a file object, so it can be used as it arrives
+
+    The whole file is saved to `loc` even if `consume` stops reading early.
+    Raises NotModified like download_file, returns the new file's validators."""
+    part_loc = f'{loc}.part'
+
+    with get_session(url).get(url, headers=_conditional_headers(validators), stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 304:
+            raise NotModified(url)
+
+        r.raise_for_status()
+        r.raw.decode_content = True
+
+        length = r.headers.get('Content-Length')
+
+        with tqdm(total=int(length) if length and length.isdigit() else None,
+                  unit='B', unit_scale=True, unit_divisor=1024, desc='') as pbar:
+            with open(part_loc, 'wb') as output:
+                tee = _TeeReader(r.raw, output, pbar)
+
+                consume(tee)
+
+                # Save whatever `consume` didn't need, like padding at the end of tars
+                while tee.read(CHUNK_SIZE):
+                    pass
+
+        new_validators = _validators(r)
+
+    os.replace(part_loc, loc)
+
+    return new_validators
@@ -30,3 +30,28 @@ class DependedOnError(Error):
         super().__init__(message)
         self.msg = message
         self.dependants = []
+
+
+class DependencyCycle(Error):
+    """Raised when packages depend on each other in a loop"""
+    pass
+
+
+class DependencyFailed(Error):
+    """Raised when a package cannot be installed because one of its dependencies failed"""
+    pass
+
+
+class BuildFailed(Error):
+    """Raised when a script fails while building a package update"""
+    pass
+
+
+class NoPreviousVersion(Error):
+    """Raised when a package has no previous version to roll back to"""
+    pass
+
+
+class Locked(Error):
+    """Raised when a lock held by another toaster process isn't released in time"""
+    pass
@@ -0,0 +1,414 @@
+"""
+Archive extraction for binary and build packages
+"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+import stat
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+from config import get_config
+
+TAR_TYPES = ['tar', 'gz', 'xz']
+ZIP_TYPES = ['zip']
+
+BUFFER_SIZE = 1024 * 1024
+
+# Files up to this size are read into memory and written by a pool of threads
+SMALL_FILE_SIZE = 256 * 1024
+
+
+class UnsafeArchive(Exception):
+    """Raised when an archive member would be extracted outside of the destination"""
+    pass
+
+
+class _Destination:
+    """Resolves archive member names to safe paths inside of a directory"""
+
+    def __init__(self, path, strip):
+        self.path = os.path.abspath(path)
+        self.real_path = os.path.realpath(self.path)
+        self.strip = strip
+        self._safe_dirs = set()
+        self._lock = threading.Lock()
+
+        # In a new, empty destination only members already extracted can be in the way,
+        # which saves checking the disk for every member
+        self.fresh = not os.path.exists(self.path) or not os.listdir(self.path)
+        self._claimed = set()
+        self._links = []
+
+    def _inside(self, real):
+        return real == self.real_path or real.startswith(self.real_path + os.sep)
+
+    def resolve(self, name):
+        """Strip the leading components from a member name, returns its target path or None to skip it"""
+        parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+
+        if len(parts) <= self.strip:
+            return None
+
+        parts = parts[self.strip:]
+
+        # Leading slashes were dropped above, so only `..` can lead outside
+        if '..' in parts:
+            raise UnsafeArchive(name)
+
+        return os.path.join(self.path, *parts)
+
+    def check_link(self, target, linkname):
+        """Make sure a symlink can't point outside of the destination
+
+        The link is resolved from where its directory really is, since links extracted earlier can be in its path."""
+        if os.path.isabs(linkname):
+            raise UnsafeArchive(f'{target} -> {linkname}')
+
+        resolved = os.path.realpath(os.path.join(
+            os.path.realpath(os.path.dirname(target)), linkname))
+
+        if not self._inside(resolved):
+            raise UnsafeArchive(f'{target} -> {linkname}')
+
+    def add_link(self, target):
+        """Note a symlink was made, which can change where directories checked before lead"""
+        with self._lock:
+            self._links.append(target)
+            self._safe_dirs.clear()
+
+    def check_hardlink(self, target, source):
+        """Make sure a hard link's source really is inside the destination"""
+        if not self._inside(os.path.realpath(source)):
+            raise UnsafeArchive(f'{target} -> {source}')
+
+    def check_links(self):
+        """Make sure no symlink leads outside the destination, now that every link they could go through exists
+
+        A link pointing at a path which didn't exist yet when it was checked could lead outside once later links fill it in."""
+        for target in self._links:
+            if os.path.islink(target) and not self._inside(os.path.realpath(target)):
+                linkname = os.readlink(target)
+                os.unlink(target)
+                raise UnsafeArchive(f'{target} -> {linkname}')
+
+    def claim(self, target):
+        """Mark a target as extracted, returns whether something may already be there"""
+        with self._lock:
+            if target in self._claimed:
+                return True
+
+            self._claimed.add(target)
+
+        return not self.fresh
+
+    def make_dir(self, d):
+        """Create a directory, making sure symlinks made earlier don't lead it outside the destination"""
+        with self._lock:
+            if d in self._safe_dirs:
+                return
+
+        os.makedirs(d, exist_ok=True)
+
+        if not self._inside(os.path.realpath(d)):
+            raise UnsafeArchive(d)
+
+        with self._lock:
+            self._safe_dirs.add(d)
+
+
+def _create(target, exists):
+    """Create a new file, never writing through a link or into a file shared by a hard link"""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | getattr(os, 'O_CLOEXEC', 0)
+
+    if exists and os.path.lexists(target):
+        os.unlink(target)
+
+    try:
+        return os.open(target, flags, 0o644)
+    except FileExistsError:
+        # Reached through a symlink to its directory, under another name
+        os.unlink(target)
+        return os.open(target, flags, 0o644)
+
+
+def _write_file(src, target, mode, exists=True):
+    # Unbuffered so every write goes straight to the file in large chunks
+    with open(_create(target, exists), 'wb', buffering=0) as dst:
+        while True:
+            chunk = src.read(BUFFER_SIZE)
+
+            if not chunk:
+                break
+
+            dst.write(chunk)
+
+    if mode:
+        os.chmod(target, mode)
+
+
+class _PrependReader:
+    """File object which returns some already read bytes before the rest of a stream"""
+
+    def __init__(self, head, fileobj):
+        self.head = head
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+
+        if size is None or size < 0:
+            data, self.head = self.head + self.fileobj.read(), b''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+
+        return data
+
+
+def _decompress_stream(fileobj):
+    """Wrap a stream in the decompressor its magic bytes call for
+
+    This decompresses in large chunks, unlike tarfile's own stream mode."""
+    head = fileobj.read(6)
+    stream = _PrependReader(head, fileobj)
+
+    if head.startswith(b'\x1f\x8b'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    elif head.startswith(b'\xfd7zXZ'):
+        return lzma.LZMAFile(stream)
+    elif head.startswith(b'BZh'):
+        return bz2.BZ2File(stream)
+
+    return stream
+
+
+class _ParallelWriter:
+    """Writes small files from a pool of threads, so slow file creation doesn't hold up reading the archive"""
+
+    def __init__(self, jobs):
+        # With one job there's nothing to gain from threads, so files are written right away
+        self.executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+        # Bounds how many files are held in memory waiting to be written
+        self.slots = threading.BoundedSemaphore(jobs * 16)
+        self.pending = []
+        self.targets = set()
+
+    def _write(self, data, target, mode, mtime, exists):
+        try:
+            _write_file(io.BytesIO(data), target, mode, exists)
+            os.utime(target, (mtime, mtime))
+        finally:
+            self.slots.release()
+
+    def write(self, data, target, mode, mtime, exists=True):
+        # Later members with the same name replace earlier ones, so keep them in order
+        if target in self.targets:
+            self.wait()
+
+        self.slots.acquire()
+
+        if not self.executor:
+            self._write(data, target, mode, mtime, exists)
+            return
+
+        self.pending.append(self.executor.submit(
+            self._write, data, target, mode, mtime, exists))
+        self.targets.add(target)
+
+        if len(self.pending) > 1024:
+            for future in [f for f in self.pending if f.done()]:
+                future.result()
+
+            self.pending = [f for f in self.pending if not f.done()]
+
+    def wait(self):
+        """Wait for every file written so far"""
+        for future in self.pending:
+            future.result()
+
+        self.pending = []
+        self.targets.clear()
+
+    def close(self):
+        self.wait()
+
+        if self.executor:
+            self.executor.shutdown()
+
+
+@tracing.traced()
+def extract_tar(path, file_name=None, fileobj=None, strip=1, jobs=None):
+    """Extract a tar archive in one pass, from a file or as it is read from a stream if `fileobj` is given
+
+    Members are read in order, while small files are written by `jobs` threads."""
+    dest = _Destination(path, strip)
+    writer = _ParallelWriter(jobs or get_config('jobs'))
+    dirs = []
+
+    if fileobj:
+        tar = tarfile.open(fileobj=_decompress_stream(fileobj), mode='r|')
+    else:
+        tar = tarfile.open(file_name)
+
+    os.makedirs(dest.path, exist_ok=True)
+
+    with tar:
+        try:
+            _extract_tar_members(tar, dest, writer, dirs)
+        finally:
+            writer.close()
+
+    dest.check_links()
+
+    # Set directory permissions last, so read-only directories can still be filled
+    for target, mode in reversed(dirs):
+        os.chmod(target, mode | stat.S_IWUSR | stat.S_IXUSR)
+
+
+def _extract_tar_members(tar, dest, writer, dirs):
+    for member in tar:
+        target = dest.resolve(member.name)
+
+        if target is None:
+            continue
+
+        # Never extract setuid/setgid bits
+        mode = member.mode & 0o777
+
+        if member.isdir():
+            dest.make_dir(target)
+            dirs.append((target, mode))
+            continue
+
+        dest.make_dir(os.path.dirname(target))
+        exists = dest.claim(target)
+
+        if member.isreg():
+            if member.size <= SMALL_FILE_SIZE:
+                writer.write(tar.extractfile(member).read(),
+                             target, mode, member.mtime, exists)
+            else:
+                _write_file(tar.extractfile(member), target, mode, exists)
+                os.utime(target, (member.mtime, member.mtime))
+        elif member.issym():
+            dest.check_link(target, member.linkname)
+
+            if target in writer.targets:
+                writer.wait()
+
+            if exists and os.path.lexists(target):
+                os.unlink(target)
+
+            os.symlink(member.linkname, target)
+            dest.add_link(target)
+        elif member.islnk():
+            # Hard links point at an earlier member, by its name in the archive
+            source = dest.resolve(member.linkname)
+
+            if source is None:
+                raise UnsafeArchive(f'{member.name} -> {member.linkname}')
+
+            # The file being linked to may still be waiting to be written
+            writer.wait()
+            dest.check_hardlink(target, source)
+
+            if exists and os.path.lexists(target):
+                os.unlink(target)
+
+            os.link(source, target, follow_symlinks=False)
+
+            # A hard link to a symlink is a new symlink, which resolves from its own directory
+            if os.path.islink(target):
+                dest.add_link(target)
+
+        # Devices, fifos and the like are never needed by packages, so they're skipped
+
+
+def _zip_mode(info):
+    return info.external_attr >> 16
+
+
+def _extract_zip_members(z, dest, members):
+    for info, target in members:
+        dest.make_dir(os.path.dirname(target))
+        exists = dest.claim(target)
+        mode = _zip_mode(info)
+
+        if stat.S_ISLNK(mode):
+            linkname = z.read(info).decode()
+            dest.check_link(target, linkname)
+
+            if exists and os.path.lexists(target):
+                os.unlink(target)
+
+            os.symlink(linkname, target)
+            dest.add_link(target)
+        else:
+            with z.open(info) as src:
+                _write_file(src, target, mode & 0o777, exists)
+
+
+@tracing.traced()
+def extract_zip(path, file_name, strip=0, jobs=None):
+    """Extract a zip archive, writing files from several threads at once"""
+    dest = _Destination(path, strip)
+    files = []
+    links = []
+
+    os.makedirs(dest.path, exist_ok=True)
+
+    with zipfile.ZipFile(file_name) as z:
+        for info in z.infolist():
+            target = dest.resolve(info.filename)
+
+            if target is None:
+                continue
+
+            if info.is_dir():
+                dest.make_dir(target)
+            elif stat.S_ISLNK(_zip_mode(info)):
+                links.append((info, target))
+            else:
+                files.append((info, target))
+
+        jobs = max(1, min(jobs or get_config('jobs'), len(files) // 64 or 1))
+
+        if jobs == 1:
+            _extract_zip_members(z, dest, files)
+        else:
+            # Zip members can be read at any offset and ZipFile locks around its reads,
+            # so workers share it and decompress at the same time
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(_extract_zip_members, z, dest, files[i::jobs])
+                           for i in range(jobs)]
+
+                for future in futures:
+                    future.result()
+
+        # Symlinks are made last, once everything they could point to exists
+        _extract_zip_members(z, dest, links)
+
+    dest.check_links()
+
+
+def extract_archive(archive_type, path, file_name=None, fileobj=None):
+    """Extract a package's archive to `path`
+
+    Tars have their top level directory stripped, zips are extracted as they are."""
+    archive_type = archive_type.strip().lower()
+
+    if archive_type in TAR_TYPES:
+        extract_tar(path, file_name, fileobj)
+    elif archive_type in ZIP_TYPES:
+        if fileobj:
+            raise ValueError('zip archives can not be extracted from a stream')
+
+        extract_zip(path, file_name)
+    else:
+        raise NotImplementedError(f'Unknown archive type: {archive_type}')
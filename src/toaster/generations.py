@@ -0,0 +1,132 @@
+"""
+Staged package updates, kept as numbered generations so they can be rolled back
+"""
+import os
+import shutil
+
+from exceptions import NoPreviousVersion
+
+# Each package updated through staging gets `<type dir>/.versions/<package>/<n>` for every kept
+# generation, with the TOML it was built from at `<n>.toml`. The package's usual location is then a
+# symlink to its current generation, so swapping generations is a single atomic rename.
+VERSIONS = '.versions'
+
+
+def versions_dir(package_dir):
+    """Get the directory a package's generations are kept in"""
+    parent, package = os.path.split(package_dir)
+    return os.path.join(parent, VERSIONS, package)
+
+
+def _generations(package_dir):
+    d = versions_dir(package_dir)
+
+    if not os.path.isdir(d):
+        return []
+
+    return sorted(int(n) for n in os.listdir(d) if n.isdigit())
+
+
+def _current(package_dir):
+    if os.path.islink(package_dir):
+        return os.path.basename(os.readlink(package_dir))
+
+
+def _previous(package_dir):
+    previous = os.path.join(versions_dir(package_dir), 'previous')
+
+    if os.path.islink(previous):
+        return os.readlink(previous)
+
+
+def _point(link, target):
+    """Atomically make `link` a symlink to `target`"""
+    tmp = f'{link}.toaster-swap'
+
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    os.symlink(target, tmp)
+    os.replace(tmp, link)
+
+
+def stage(package_dir):
+    """Get a new generation directory to build a package update into, it isn't created"""
+    d = versions_dir(package_dir)
+    os.makedirs(d, exist_ok=True)
+
+    # Unfinished generations from a failed update are left after the kept ones
+    n = max(_generations(package_dir) + [0]) + 1
+
+    # Leave room for the installed version to become the generation before it
+    if not os.path.islink(package_dir):
+        n += 1
+
+    return os.path.join(d, str(n))
+
+
+def discard(generation_dir):
+    """Delete a staged generation which failed to build"""
+    if os.path.exists(generation_dir):
+        shutil.rmtree(generation_dir)
+
+    if os.path.exists(f'{generation_dir}.toml'):
+        os.remove(f'{generation_dir}.toml')
+
+
+def commit(package_dir, generation_dir, package_toml_loc, old_toml_loc):
+    """Swap a staged generation in as the package's current one
+
+    The current generation is kept for `rollback`, older ones are deleted."""
+    d = versions_dir(package_dir)
+    shutil.copyfile(package_toml_loc, f'{generation_dir}.toml')
+
+    if os.path.islink(package_dir):
+        old = _current(package_dir)
+    else:
+        # Installed before it was ever staged, so it becomes a generation first. This is the only
+        # time the package is briefly missing, later updates only replace a symlink.
+        old = str(int(os.path.basename(generation_dir)) - 1)
+
+        if os.path.exists(os.path.join(d, old)):
+            old = str(max(_generations(package_dir)) + 1)
+
+        shutil.copyfile(old_toml_loc, os.path.join(d, f'{old}.toml'))
+        os.rename(package_dir, os.path.join(d, old))
+
+    _point(package_dir, os.path.join(VERSIONS, os.path.basename(package_dir),
+                                     os.path.basename(generation_dir)))
+    _point(os.path.join(d, 'previous'), old)
+
+    # Only the current and previous generations are kept
+    for n in _generations(package_dir):
+        if str(n) not in (old, os.path.basename(generation_dir)):
+            discard(os.path.join(d, str(n)))
+
+
+def rollback(package_dir):
+    """Swap a package back to its previous generation, returns the location of that generation's TOML
+
+    Rolling back again goes forward to the generation that was rolled back from."""
+    d = versions_dir(package_dir)
+    current = _current(package_dir)
+    previous = _previous(package_dir)
+
+    if not current or not previous or not os.path.isdir(os.path.join(d, previous)):
+        raise NoPreviousVersion(os.path.basename(package_dir))
+
+    _point(package_dir, os.path.join(VERSIONS, os.path.basename(package_dir), previous))
+    _point(os.path.join(d, 'previous'), current)
+
+    return os.path.join(d, f'{previous}.toml')
+
+
+def remove(package_dir):
+    """Delete a package along with all its generations"""
+    if os.path.islink(package_dir):
+        os.remove(package_dir)
+    elif os.path.exists(package_dir):
+        shutil.rmtree(package_dir)
+
+    if os.path.exists(versions_dir(package_dir)):
+        shutil.rmtree(versions_dir(package_dir))
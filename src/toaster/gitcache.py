@@ -0,0 +1,119 @@
+"""
+Persistent bare mirrors of the git repos that build packages come from
+"""
+import hashlib
+import os
+import shutil
+
+import tracing
+from config import get_config
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+mirrors_dir = os.path.join(toaster_loc, '.cache', 'git')
+
+
+def _mirror_loc(git_url):
+    return os.path.join(mirrors_dir, hashlib.sha1(git_url.encode()).hexdigest() + '.git')
+
+
+def _dir_size(path):
+    size = 0
+
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+def _update(package, git_url, mirror_loc):
+    from git import Repo
+    from progress import CloneProgress
+
+    if os.path.exists(mirror_loc):
+        Repo(mirror_loc).remotes.origin.fetch(
+            prune=True, progress=CloneProgress(package, git_url))
+    else:
+        Repo.clone_from(git_url, mirror_loc, mirror=True,
+                        progress=CloneProgress(package, git_url))
+
+    # Used to decide which mirrors to evict first
+    os.utime(mirror_loc)
+
+
+def update_mirror(package, git_url):
+    """Clone a mirror of a repo, or fetch only what's new if it's already mirrored, returns its location"""
+    # Loaded here so looking at the cache doesn't load git
+    from filelock import FileLock
+
+    os.makedirs(mirrors_dir, exist_ok=True)
+    mirror_loc = _mirror_loc(git_url)
+
+    with FileLock(f'{mirror_loc}.lock'):
+        _update(package, git_url, mirror_loc)
+
+    return mirror_loc
+
+
+@tracing.traced('git_checkout')
+def checkout(package, git_url, repo_dir, branch='master'):
+    """Make a working tree of a repo's branch at `repo_dir`, hard linking the objects in its mirror
+
+    The working tree has its own links to the objects, so it keeps working after the mirror is evicted."""
+    from filelock import FileLock
+    from git import Repo
+
+    os.makedirs(mirrors_dir, exist_ok=True)
+    mirror_loc = _mirror_loc(git_url)
+
+    if os.path.exists(repo_dir):
+        shutil.rmtree(repo_dir)
+
+    # Held until the clone is done, so the mirror can't be evicted in between
+    with FileLock(f'{mirror_loc}.lock'):
+        _update(package, git_url, mirror_loc)
+        Repo.clone_from(mirror_loc, repo_dir, branch=branch, local=True)
+
+    evict(keep=[mirror_loc])
+
+    return Repo(repo_dir)
+
+
+def usage():
+    """Returns a dict of mirror location -> size in bytes"""
+    if not os.path.exists(mirrors_dir):
+        return {}
+
+    return {os.path.join(mirrors_dir, d): _dir_size(os.path.join(mirrors_dir, d))
+            for d in os.listdir(mirrors_dir) if d.endswith('.git')}
+
+
+def evict(max_bytes=None, keep=()):
+    """Delete the least recently used mirrors until they fit in `max_bytes`, returns the bytes freed"""
+    from filelock import FileLock
+
+    if max_bytes is None:
+        max_bytes = get_config('git_cache_size')
+
+    sizes = usage()
+    total = sum(sizes.values())
+    freed = 0
+
+    for mirror_loc in sorted(sizes, key=os.path.getmtime):
+        if total - freed <= max_bytes:
+            break
+
+        if mirror_loc in keep:
+            continue
+
+        with FileLock(f'{mirror_loc}.lock'):
+            shutil.rmtree(mirror_loc, ignore_errors=True)
+
+        freed += sizes[mirror_loc]
+
+    return freed
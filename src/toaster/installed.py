@@ -0,0 +1,180 @@
+"""
+Index of installed packages, the packages they depend on and the files they own
+"""
+import os
+import time
+
+from database import connect
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+installed_loc = os.path.join(toaster_loc, 'installed.db')
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS dependencies (
+        package TEXT NOT NULL,
+        dependency TEXT NOT NULL,
+        PRIMARY KEY (package, dependency)
+    )''',
+    'CREATE INDEX IF NOT EXISTS dependencies_dependency ON dependencies (dependency)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    '''CREATE TABLE IF NOT EXISTS links (
+        name TEXT PRIMARY KEY,
+        package TEXT NOT NULL,
+        target TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS links_package ON links (package)',
+    '''CREATE TABLE IF NOT EXISTS packages (
+        name TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        location TEXT NOT NULL,
+        version TEXT,
+        installed REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS files (
+        package TEXT NOT NULL,
+        path TEXT NOT NULL,
+        type TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mode INTEGER NOT NULL,
+        hash TEXT,
+        PRIMARY KEY (package, path)
+    )''',
+]
+
+
+def get_installed_db():
+    """Returns a connection to the installed packages index"""
+    return connect(installed_loc, schema)
+
+
+def set_dependencies(package, dependencies):
+    """Record the dependencies of an installed package, replacing any old ones"""
+    conn = get_installed_db()
+
+    with conn:
+        conn.execute('DELETE FROM dependencies WHERE package = ?', (package,))
+        conn.executemany('INSERT OR IGNORE INTO dependencies VALUES (?, ?)',
+                         [(package, dependency) for dependency in dependencies])
+
+
+def forget_package(package):
+    """Remove a package from the index"""
+    conn = get_installed_db()
+
+    with conn:
+        conn.execute('DELETE FROM dependencies WHERE package = ?', (package,))
+        conn.execute('DELETE FROM packages WHERE name = ?', (package,))
+        conn.execute('DELETE FROM files WHERE package = ?', (package,))
+
+
+def get_dependants(package):
+    """Get list of installed packages that depend on a package"""
+    return [row['package'] for row in get_installed_db().execute(
+        'SELECT package FROM dependencies WHERE dependency = ? ORDER BY package', (package,))]
+
+
+def rebuild(packages):
+    """Replace the whole index, `packages` is a dict of installed package -> its dependencies"""
+    conn = get_installed_db()
+
+    with conn:
+        conn.execute('DELETE FROM dependencies')
+
+        for package, dependencies in packages.items():
+            conn.executemany('INSERT OR IGNORE INTO dependencies VALUES (?, ?)',
+                             [(package, dependency) for dependency in dependencies])
+
+        conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('dependencies_indexed', '1')")
+
+
+def is_indexed(index='dependencies'):
+    """Check if an index has been built, `dependencies` or `files`"""
+    return get_installed_db().execute(
+        'SELECT 1 FROM meta WHERE key = ?', (f'{index}_indexed',)).fetchone() is not None
+
+
+def set_indexed(index):
+    """Record that an index has been built"""
+    conn = get_installed_db()
+
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                     (f'{index}_indexed', '1'))
+
+
+def get_links(package=None):
+    """Get a dict of link name -> (owning package, target) in toaster's bin, only a package's if given"""
+    if package:
+        rows = get_installed_db().execute(
+            'SELECT * FROM links WHERE package = ?', (package,))
+    else:
+        rows = get_installed_db().execute('SELECT * FROM links')
+
+    return {row['name']: (row['package'], row['target']) for row in rows}
+
+
+def set_links(package, links):
+    """Record links owned by a package, `links` is a dict of link name -> target"""
+    conn = get_installed_db()
+
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO links VALUES (?, ?, ?)',
+                         [(name, package, target) for name, target in links.items()])
+
+
+def forget_links(names):
+    """Remove links from the index"""
+    conn = get_installed_db()
+
+    with conn:
+        conn.executemany('DELETE FROM links WHERE name = ?',
+                         [(name,) for name in names])
+
+
+def set_manifest(package, kind, location, version, files):
+    """Record an installed package and the files it owns, replacing any old ones
+
+    `files` is a list of (path in the package, type, size, mode, hash) tuples."""
+    conn = get_installed_db()
+
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)',
+                     (package, kind, location, version, time.time()))
+        conn.execute('DELETE FROM files WHERE package = ?', (package,))
+        conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                         [(package, *f) for f in files])
+
+
+def get_package(package):
+    """Get the row of an installed package, or None if it has no manifest"""
+    return get_installed_db().execute(
+        'SELECT * FROM packages WHERE name = ?', (package,)).fetchone()
+
+
+def get_packages():
+    """Get every package with a manifest, with how many files it has and their total size"""
+    return get_installed_db().execute(
+        '''SELECT packages.*, COUNT(files.path) AS files, COALESCE(SUM(files.size), 0) AS size
+        FROM packages LEFT JOIN files ON files.package = packages.name
+        GROUP BY packages.name ORDER BY packages.name''').fetchall()
+
+
+def get_files(package):
+    """Get the files an installed package owns"""
+    return get_installed_db().execute(
+        'SELECT * FROM files WHERE package = ? ORDER BY path', (package,)).fetchall()
+
+
+def get_file_contents():
+    """Get the (hash, mode) of every file any installed package owns"""
+    return {(row['hash'], row['mode']) for row in get_installed_db().execute(
+        "SELECT DISTINCT hash, mode FROM files WHERE type = 'f'")}
+
+
+def get_file(package, path):
+    """Get a file an installed package owns, or None"""
+    return get_installed_db().execute(
+        'SELECT * FROM files WHERE package = ? AND path = ?', (package, path)).fetchone()
@@ -0,0 +1,97 @@
+"""
+GNU make compatible jobserver shared by every build running at the same time
+"""
+import contextlib
+import os
+import threading
+
+import tracing
+from config import get_config
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+# Set while a jobserver runs, as `<jobs>:<fifo>`. Worker processes inherit it and open the FIFO
+# themselves, so the same tokens are shared no matter which pool the builds run in.
+ENV = 'TOASTER_JOBSERVER'
+
+_fds = {}
+_lock = threading.Lock()
+
+
+def _open(fifo):
+    """Returns this process's read and write ends of the jobserver FIFO"""
+    with _lock:
+        if _fds.get('pid') != os.getpid() or _fds.get('fifo') != fifo:
+            # Opening the read end first can't block, and make expects blocking reads
+            r = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            w = os.open(fifo, os.O_WRONLY)
+            os.set_blocking(r, True)
+
+            _fds.update(pid=os.getpid(), fifo=fifo, r=r, w=w)
+
+        return _fds['r'], _fds['w']
+
+
+def _close():
+    with _lock:
+        if _fds.get('pid') == os.getpid():
+            os.close(_fds['r'])
+            os.close(_fds['w'])
+
+        _fds.clear()
+
+
+@contextlib.contextmanager
+def running(jobs=None):
+    """Run a jobserver with `jobs` slots for the builds started inside this block
+
+    Nested blocks share the jobserver that is already running."""
+    if os.environ.get(ENV):
+        yield
+        return
+
+    jobs = max(1, jobs or get_config('build_jobs'))
+    fifo = os.path.join(toaster_loc, '.cache', f'jobserver-{os.getpid()}')
+
+    if os.path.exists(fifo):
+        os.remove(fifo)
+
+    os.mkfifo(fifo, 0o600)
+    os.environ[ENV] = f'{jobs}:{fifo}'
+
+    try:
+        # A FIFO keeps its tokens only while it is open, this process holds it until the end
+        _, w = _open(fifo)
+        os.write(w, b'+' * jobs)
+
+        yield
+    finally:
+        del os.environ[ENV]
+        _close()
+        os.remove(fifo)
+
+
+@contextlib.contextmanager
+def slot():
+    """Wait for a free job slot and hold it while a package builds
+
+    Yields how many jobs builds may use, the environment variables for its scripts and the file
+    descriptors they need. Make uses the slot as its implicit job and takes more from the jobserver."""
+    server = os.environ.get(ENV)
+
+    if not server:
+        jobs = get_config('build_jobs')
+        yield jobs, {'MAKEFLAGS': f'-j{jobs}'}, ()
+        return
+
+    jobs, fifo = server.split(':', 1)
+    r, w = _open(fifo)
+
+    with tracing.span('wait_job_slot'):
+        token = os.read(r, 1)
+
+    try:
+        yield int(jobs), {'MAKEFLAGS': f'-j{jobs} --jobserver-auth={r},{w}'}, (r, w)
+    finally:
+        os.write(w, token)
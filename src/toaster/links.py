@@ -0,0 +1,182 @@
+"""
+Links from toaster's bin directory to the binaries of installed packages
+"""
+import os
+import threading
+
+import installed
+import locks
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+bin_dir = os.path.join(toaster_loc, 'bin')
+
+# Held while links are made or removed, by install workers and other toaster processes
+LOCK = 'links'
+
+# Install workers share the PATH index
+_lock = threading.RLock()
+_index = None
+
+
+class PathIndex:
+    """Snapshot of the files in every PATH directory, so looking up a command doesn't scan PATH again"""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = {}
+
+        seen = set()
+
+        for d in path.split(os.pathsep):
+            if not d or d in seen:
+                continue
+
+            seen.add(d)
+
+            try:
+                filenames = os.listdir(d)
+            except OSError:
+                continue
+
+            for filename in filenames:
+                self.names.setdefault(filename, []).append(d)
+
+    def which(self, name):
+        """Find a command like shutil.which does, returns its path or None"""
+        for d in self.names.get(name, ()):
+            loc = os.path.join(d, name)
+
+            if os.access(loc, os.X_OK) and not os.path.isdir(loc):
+                return loc
+
+    def add(self, name, d):
+        """Record a file made in a directory after the snapshot was taken"""
+        dirs = self.names.setdefault(name, [])
+
+        if d not in dirs:
+            dirs.append(d)
+
+    def remove(self, name, d):
+        """Record a file deleted from a directory after the snapshot was taken"""
+        if d in self.names.get(name, ()):
+            self.names[name].remove(d)
+
+
+def path_index():
+    """Returns the PATH index for this command, it is only built again if PATH changes"""
+    global _index
+
+    path = os.environ.get('PATH', os.defpath)
+
+    with _lock:
+        if _index is None or _index.path != path:
+            _index = PathIndex(path)
+
+        return _index
+
+
+def _unlink(names):
+    index = path_index()
+
+    for name in names:
+        loc = os.path.join(bin_dir, name)
+
+        if os.path.islink(loc):
+            os.remove(loc)
+            index.remove(name, bin_dir)
+
+    installed.forget_links(names)
+
+
+def link_package(package, package_dir, link_dirs, force=False):
+    """Link every file in a package's link dirs into toaster's bin, returns the names which weren't linked
+
+    A name isn't linked if a command with that name already exists, unless `force` is set."""
+    index = path_index()
+    conflicts = []
+    made = {}
+
+    with locks.exclusive(LOCK):
+        owned = installed.get_links(package)
+
+        for ld in link_dirs:
+            ld = os.path.join(package_dir, ld)
+
+            if not os.path.isdir(ld):
+                continue
+
+            for filename in os.listdir(ld):
+                target = os.path.join(ld, filename)
+                link_loc = os.path.join(bin_dir, filename)
+
+                if os.path.islink(link_loc) and os.readlink(link_loc) == target:
+                    # Linked before, only recorded if it was linked before links were recorded
+                    if filename not in owned:
+                        made[filename] = target
+
+                    continue
+
+                if not force and (os.path.lexists(link_loc) or index.which(filename)):
+                    conflicts.append(filename)
+                    continue
+
+                if os.path.lexists(link_loc):
+                    os.remove(link_loc)
+
+                os.symlink(target, link_loc)
+                index.add(filename, bin_dir)
+                made[filename] = target
+
+        installed.set_links(package, made)
+
+    return conflicts
+
+
+def unlink_package(package, package_dir=None, link_dirs=()):
+    """Delete a package's links from toaster's bin
+
+    Links made before links were recorded are found by pointing into `package_dir`."""
+    with locks.exclusive(LOCK):
+        names = set(installed.get_links(package))
+
+        if package_dir:
+            prefix = os.path.join(package_dir, '')
+
+            for ld in link_dirs:
+                ld = os.path.join(package_dir, ld)
+
+                if not os.path.isdir(ld):
+                    continue
+
+                for filename in os.listdir(ld):
+                    loc = os.path.join(bin_dir, filename)
+
+                    if os.path.islink(loc) and os.readlink(loc).startswith(prefix):
+                        names.add(filename)
+
+        _unlink(names)
+
+
+def prune(package):
+    """Delete a package's links which point at files it doesn't have any more, like after an update"""
+    with locks.exclusive(LOCK):
+        _unlink([name for name, (_, target) in installed.get_links(package).items()
+                 if not os.path.exists(target)])
+
+
+def clean():
+    """Delete every broken link in toaster's bin, and forget links which are gone"""
+    with locks.exclusive(LOCK):
+        broken = []
+
+        for filename in os.listdir(bin_dir):
+            loc = os.path.join(bin_dir, filename)
+
+            if os.path.islink(loc) and not os.path.exists(loc):
+                broken.append(filename)
+
+        _unlink(broken)
+        installed.forget_links([name for name in installed.get_links()
+                                if not os.path.lexists(os.path.join(bin_dir, name))])
@@ -0,0 +1,251 @@
+"""
+Locks shared between toaster processes, so more than one toaster can run at once
+"""
+import contextlib
+import fcntl
+import os
+import threading
+import time
+
+from config import get_config
+from exceptions import Locked
+from utils import secho
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+locks_dir = os.path.join(toaster_loc, '.locks')
+
+# Locks are flock(2) locks, which belong to the process. Threads of this process share its flock and
+# take the lock from each other here, like they would from other processes.
+_states = {}
+_cond = threading.Condition()
+
+
+class _State:
+    """How this process holds a lock"""
+
+    def __init__(self):
+        self.fd = None
+        # Thread ident -> how many times it took the lock shared
+        self.readers = {}
+        self.writer = None
+        self.depth = 0
+        # A thread is taking the flock, nobody else may until it has it
+        self.busy = False
+
+
+def _after_fork():
+    """Forget the parent's locks in a forked worker process, they stay held by the parent"""
+    global _cond
+
+    _cond = threading.Condition()
+
+    # Unlocking would unlock the parent's lock as well, closing only drops the child's copy
+    for state in _states.values():
+        if state.fd is not None:
+            os.close(state.fd)
+
+    _states.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def lock_loc(name):
+    """Get the location of a lock's file"""
+    return os.path.join(locks_dir, f'{name}.lock')
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _holder(loc):
+    """Get the PID last written to a lock by a process holding it exclusively, or None
+
+    It is only ever shown to the user. A process that was killed leaves its PID behind,
+    but the kernel already dropped its lock."""
+    try:
+        with open(loc) as f:
+            pid = int(f.read().strip() or 0) or None
+    except (OSError, ValueError):
+        return None
+
+    return pid if pid and _is_alive(pid) else None
+
+
+def _open(name, op, wait):
+    """Open a lock's file and take the flock, returns its file descriptor"""
+    loc = lock_loc(name)
+    timeout = get_config('lock_timeout')
+    start = time.monotonic()
+    delay = 0.01
+    waiting = False
+
+    os.makedirs(locks_dir, exist_ok=True)
+    fd = os.open(loc, os.O_RDWR | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0), 0o644)
+
+    while True:
+        try:
+            fcntl.flock(fd, op | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            pass
+
+        holder = _holder(loc)
+
+        if not wait or time.monotonic() - start > timeout:
+            os.close(fd)
+            raise Locked(name, holder)
+
+        if not waiting:
+            waiting = True
+            secho(
+                f"Waiting for {f'toaster process {holder}' if holder else 'another toaster process'} to finish with {name}...", fg='bright_black')
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def _wait(name, start, ready, wait):
+    """Wait for other threads of this process until `ready()`, with _cond held"""
+    timeout = get_config('lock_timeout')
+
+    while not ready():
+        remaining = timeout - (time.monotonic() - start)
+
+        if not wait or remaining <= 0:
+            raise Locked(name, os.getpid())
+
+        _cond.wait(min(remaining, 0.5))
+
+
+def _acquire(name, op, wait=True):
+    me = threading.get_ident()
+    start = time.monotonic()
+
+    with _cond:
+        state = _states.setdefault(name, _State())
+
+        # Nested in a block of the same thread which holds it exclusively, or shared for shared
+        if state.writer == me:
+            state.depth += 1
+            return
+
+        if me in state.readers:
+            if op == fcntl.LOCK_EX:
+                if not wait:
+                    raise Locked(name, os.getpid())
+
+                raise RuntimeError(
+                    f'{name} can not be taken exclusively while this thread holds it shared')
+
+            state.readers[me] += 1
+            return
+
+        if op == fcntl.LOCK_SH:
+            _wait(name, start, lambda: state.writer is None and not state.busy, wait)
+
+            # Other threads already hold the process's shared flock
+            if state.fd is not None:
+                state.readers[me] = 1
+                return
+        else:
+            _wait(name, start, lambda: state.writer is None and not state.readers and not state.busy, wait)
+
+        state.busy = True
+
+    try:
+        fd = _open(name, op, wait)
+    except BaseException:
+        with _cond:
+            state.busy = False
+            _cond.notify_all()
+
+        raise
+
+    if op == fcntl.LOCK_EX:
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(os.getpid()).encode(), 0)
+
+    with _cond:
+        state.fd = fd
+        state.busy = False
+
+        if op == fcntl.LOCK_EX:
+            state.writer = me
+            state.depth = 1
+        else:
+            state.readers[me] = 1
+
+        _cond.notify_all()
+
+
+def _release(name):
+    me = threading.get_ident()
+
+    with _cond:
+        state = _states[name]
+
+        if state.writer == me:
+            state.depth -= 1
+
+            if state.depth:
+                return
+
+            state.writer = None
+            os.ftruncate(state.fd, 0)
+        else:
+            state.readers[me] -= 1
+
+            if state.readers[me]:
+                return
+
+            del state.readers[me]
+
+            if state.readers:
+                return
+
+        # Closing the file drops the flock
+        os.close(state.fd)
+        state.fd = None
+        _cond.notify_all()
+
+
+@contextlib.contextmanager
+def shared(name, wait=True):
+    """Hold a lock which other readers can hold at the same time, but not a writer
+
+    Without `wait`, Locked is raised right away if it is held."""
+    _acquire(name, fcntl.LOCK_SH, wait)
+
+    try:
+        yield
+    finally:
+        _release(name)
+
+
+@contextlib.contextmanager
+def exclusive(name, wait=True):
+    """Hold a lock which nothing else can hold at the same time
+
+    Without `wait`, Locked is raised right away if it is held."""
+    _acquire(name, fcntl.LOCK_EX, wait)
+
+    try:
+        yield
+    finally:
+        _release(name)
+
+
+def package(package):
+    """Hold the lock of a single package while it is installed, updated or removed"""
+    return exclusive(f'package-{package}')
@@ -0,0 +1,118 @@
+"""
+Manifests of the files installed packages own, so they can be listed, looked up and verified without walking every package
+"""
+import os
+import stat
+
+import installed
+from generations import VERSIONS
+from utils import hash_file
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+# Directory each kind of package is installed in
+KIND_DIRS = {'build': 'packages', 'binary': 'binaries', 'app': 'apps'}
+
+
+def scan(package_dir, hashes=None):
+    """Get the manifest entries of every file and link in a package directory
+
+    `hashes` has hashes which are already known by path in the package, like from store.dedupe, so
+    those files aren't hashed again."""
+    hashes = hashes or {}
+    files = []
+
+    # The package directory itself can be a link to its current generation
+    for root, dirs, filenames in os.walk(os.path.realpath(package_dir)):
+        rel_root = os.path.relpath(root, os.path.realpath(package_dir))
+        rel_root = '' if rel_root == os.curdir else rel_root
+
+        for name in dirs + filenames:
+            loc = os.path.join(root, name)
+            rel = os.path.join(rel_root, name)
+            st = os.lstat(loc)
+
+            if stat.S_ISLNK(st.st_mode):
+                files.append((rel, 'l', 0, 0, os.readlink(loc)))
+            elif stat.S_ISREG(st.st_mode):
+                files.append((rel, 'f', st.st_size, stat.S_IMODE(st.st_mode),
+                              hashes.get(rel) or hash_file(loc)))
+
+    return files
+
+
+def kind_of(package_dir):
+    """Get the kind of package installed in a directory from where it is"""
+    return {t: kind for kind, t in KIND_DIRS.items()}[os.path.basename(os.path.dirname(package_dir))]
+
+
+def record(package, package_dir, version, hashes=None):
+    """Record the files an installed package owns"""
+    installed.set_manifest(package, kind_of(package_dir), package_dir,
+                           None if version is None else str(version),
+                           scan(package_dir, hashes))
+
+
+def owner(path):
+    """Find the installed package which owns a path, returns (package, path in the package) or None
+
+    Links in toaster's bin belong to the package they were linked from."""
+    path = os.path.abspath(os.path.expanduser(path))
+
+    if os.path.dirname(path) == os.path.join(toaster_loc, 'bin'):
+        link = installed.get_links().get(os.path.basename(path))
+
+        if link:
+            return link[0], os.path.basename(path)
+
+    for loc in dict.fromkeys([path, os.path.realpath(path)]):
+        parts = os.path.relpath(loc, toaster_loc).split(os.sep)
+
+        if len(parts) < 3 or parts[0] not in KIND_DIRS.values():
+            continue
+
+        # packages/<package>/... or packages/.versions/<package>/<generation>/...
+        if parts[1] == VERSIONS:
+            package, rel = parts[2], parts[4:]
+        else:
+            package, rel = parts[1], parts[2:]
+
+        if rel and installed.get_file(package, os.path.join(*rel)):
+            return package, os.path.join(*rel)
+
+    return None
+
+
+def verify(package, quick=False):
+    """Check an installed package's files against its manifest
+
+    Returns a list of (path in the package, problem). With `quick` set, files are only compared by
+    size and mode instead of by hash."""
+    row = installed.get_package(package)
+
+    if not row:
+        return None
+
+    problems = []
+
+    for f in installed.get_files(package):
+        loc = os.path.join(row['location'], f['path'])
+
+        try:
+            st = os.lstat(loc)
+        except FileNotFoundError:
+            problems.append((f['path'], 'missing'))
+            continue
+
+        if f['type'] == 'l':
+            if not stat.S_ISLNK(st.st_mode) or os.readlink(loc) != f['hash']:
+                problems.append((f['path'], 'link changed'))
+        elif not stat.S_ISREG(st.st_mode):
+            problems.append((f['path'], 'not a file'))
+        elif st.st_size != f['size'] or (not quick and hash_file(loc) != f['hash']):
+            problems.append((f['path'], 'modified'))
+        elif stat.S_IMODE(st.st_mode) != f['mode']:
+            problems.append((f['path'], 'permissions changed'))
+
+    return problems
@@ -0,0 +1,155 @@
+"""
+Cache of parsed package TOMLs
+"""
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import toml
+import tracing
+from config import get_config
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+cache_dir = os.path.join(toaster_loc, '.cache', 'manifests')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+
+def _disk_loc(path):
+    return os.path.join(cache_dir, hashlib.sha1(path.encode()).hexdigest() + '.pickle')
+
+
+def _load_from_disk(path, key):
+    try:
+        with open(_disk_loc(path), 'rb') as f:
+            # The TOML's path comes first, so gc can read it without the rest
+            if pickle.load(f) != path:
+                return None
+
+            cached_key, data = pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError, ValueError, TypeError):
+        return None
+
+    if cached_key == key:
+        return data
+
+
+def _save_to_disk(path, key, data):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temp file first so other processes never see half a file
+    tmp = f'{_disk_loc(path)}.{os.getpid()}.{threading.get_ident()}'
+
+    with open(tmp, 'wb') as f:
+        pickle.dump(path, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp, _disk_loc(path))
+
+
+def load(path):
+    """Parse a TOML file, reusing the last result if the file hasn't changed
+
+    Files are considered unchanged if their modification time and size are the same.
+    The returned dict is shared between callers, so it must not be modified."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+
+    with _lock:
+        cached = _cache.get(path)
+
+        if cached and cached[0] == key:
+            _cache.move_to_end(path)
+            _stats['hits'] += 1
+            return cached[1]
+
+    persist = get_config('manifest_cache_persist')
+    data = None
+
+    if persist:
+        data = _load_from_disk(path, key)
+
+    if data is None:
+        with tracing.span('parse_toml', path=path):
+            data = toml.load(path)
+
+        if persist:
+            _save_to_disk(path, key, data)
+
+        stat = 'misses'
+    else:
+        stat = 'disk_hits'
+
+    with _lock:
+        _stats[stat] += 1
+        _cache[path] = (key, data)
+        _cache.move_to_end(path)
+
+        while len(_cache) > get_config('manifest_cache_size'):
+            _cache.popitem(last=False)
+
+    return data
+
+
+def stats():
+    """Returns a dict of how many loads were memory hits, disk hits and misses"""
+    with _lock:
+        return dict(_stats, size=len(_cache))
+
+
+def clear(disk=False):
+    """Empty the in-memory cache, and also the on-disk cache if `disk` is True"""
+    with _lock:
+        _cache.clear()
+
+    if disk and os.path.exists(cache_dir):
+        for filename in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, filename))
+
+
+def _disk_files():
+    if not os.path.exists(cache_dir):
+        return []
+
+    return [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.pickle')]
+
+
+def usage():
+    """Returns how many parsed TOMLs are saved on disk and how many bytes they use"""
+    sizes = [os.path.getsize(loc) for loc in _disk_files()]
+
+    return len(sizes), sum(sizes)
+
+
+def gc():
+    """Delete the parsed TOMLs saved on disk for files which were removed or changed since
+
+    Returns how many bytes that freed."""
+    freed = 0
+
+    for loc in _disk_files():
+        try:
+            with open(loc, 'rb') as f:
+                path = pickle.load(f)
+                cached_key, _ = pickle.load(f)
+
+            st = os.stat(path)
+            stale = cached_key != (st.st_mtime_ns, st.st_size)
+        except (OSError, pickle.PickleError, EOFError, ValueError, TypeError):
+            stale = True
+
+        if stale:
+            try:
+                freed += os.path.getsize(loc)
+                os.remove(loc)
+            except FileNotFoundError:
+                pass
+
+    return freed
@@ -5,18 +5,28 @@ import json
 import os
 import shutil
 import subprocess
-import tarfile
-import zipfile
-from pathlib import Path
 
-import toml
-from bakery import get_all_packages
+import artifacts
+import bottles
+import generations
+import installed
+import jobserver
+import links
+import locks
+import manifest
+import manifests
+import spec
+import store
+import tracing
+from catalog import find_package
+from catalog import find_spec
+from config import get_config
 from exceptions import *
-from git import Repo
-from packaging import version
-from utils import CloneProgress
+from extract import extract_archive
+from extract import extract_tar
+from extract import TAR_TYPES
+from scheduler import run_graph
 from utils import dependingonsys
-from utils import download_file
 from utils import echo
 from utils import errecho
 from utils import secho
@@ -40,15 +50,7 @@ def get_info(package, from_installed=True, from_bakery=True):
             from_bakery = False
 
     if from_bakery:
-        pkgs = get_all_packages()
-        package_source = None
-
-        for key in pkgs:
-            if package in pkgs[key]:
-                package_source = key
-
-        if not package_source:
-            raise NotFound(package)
+        package_source = _find_package(package)
 
         l = os.path.join(toaster_loc, 'bakery',
                          package_source, package, f'{package}.toml')
@@ -59,45 +61,84 @@ def get_info(package, from_installed=True, from_bakery=True):
     if not toml_loc:
         raise NotFound(package)
 
-    return toml.load(toml_loc)
+    return manifests.load(toml_loc)
 
 
-def get_dependants(package):
-    """Get list of installed packages that depend on a package"""
-    l = []
+def _dependency_names(package_spec):
+    """Get the names of a package's dependencies, without version requirements"""
+    return [_parse_requirement(d)[0] for d in package_spec.dependencies]
+
+
+def rebuild_dependency_index():
+    """Rebuild the reverse-dependency index from the TOMLs in package_data"""
+    packages = {}
 
     package_data_loc = os.path.join(
         toaster_loc, 'package_data')
 
     for filename in os.listdir(package_data_loc):
-        package_toml = toml.load(os.path.join(
+        package_spec = spec.load(os.path.join(
             package_data_loc, filename))
 
-        if package in dependingonsys(package_toml, 'dependencies', append_mode=True):
-            l.append(filename.split('.')[0])
+        packages[filename.rsplit('.', 1)[0]] = _dependency_names(package_spec)
 
-    return l
+    installed.rebuild(packages)
 
 
-def install_dependencies(dependencies, out=True):
-    """Install dependencies for a package"""
-    for dependency in dependencies:
-        try:
-            secho(f"Installing dependency: {dependency}", fg="bright_magenta")
-            install_package(dependency)
+def get_dependants(package):
+    """Get list of installed packages that depend on a package"""
+    if not installed.is_indexed():
+        rebuild_dependency_index()
+
+    return installed.get_dependants(package)
 
-        except AlreadyInstalled as e:
-            if out:
-                secho(
-                    f'Dependency {dependency} is already installed, ignoring!', fg='bright_black')
 
-            return
+def index_installed():
+    """Record manifests for installed packages which don't have one, like ones installed before manifests were recorded"""
+    if installed.is_indexed('files'):
+        return
 
-        secho(f'Installed dependency: {dependency}', fg="bright_magenta")
+    for t in manifest.KIND_DIRS.values():
+        d = os.path.join(toaster_loc, t)
+
+        if not os.path.isdir(d):
+            continue
+
+        for package in os.listdir(d):
+            # Kept generations of updated packages
+            if package.startswith('.') or installed.get_package(package):
+                continue
+
+            try:
+                package_spec = spec.load(os.path.join(
+                    toaster_loc, 'package_data', f'{package}.toml'), package)
+            except FileNotFoundError:
+                package_spec = None
+
+            manifest.record(package, os.path.join(d, package),
+                            package_spec.version if package_spec else None)
+
+    installed.set_indexed('files')
+
+
+def get_installed():
+    """Get every installed package, with how many files it has and their total size"""
+    index_installed()
+
+    return installed.get_packages()
 
 
 def get_package_loc(package):
     """Get the location of an installed package"""
+    row = installed.get_package(package)
+
+    if row:
+        return row['location']
+
+    # Every install has a manifest once the existing ones are indexed
+    if installed.is_indexed('files'):
+        raise NotFound(package)
+
     p = os.path.join(toaster_loc, 'packages', package)
     b = os.path.join(toaster_loc, 'binaries', package)
     a = os.path.join(toaster_loc, 'apps', package)
@@ -114,264 +155,239 @@ def get_package_loc(package):
     raise NotFound(package)
 
 
-def make_symlinks(package_toml, package_dir, link_warn=True, force=False):
-    """Makes symlinks"""
-    # Link package binaries to toaster/bin
-    link_dirs = dependingonsys(
-        package_toml, 'link_dirs', append_mode=True) or ['bin']
+def _link_dirs(d):
+    """Get the directories to link binaries from, `d` is a resolved Section or a TOML table"""
+    if isinstance(d, spec.Section):
+        return d.link_dirs
 
-    try:
-        for ld in link_dirs:
-            ld = os.path.join(package_dir, ld)
+    return dependingonsys(d, 'link_dirs', append_mode=True) or ['bin']
 
-            if os.path.isdir(ld):
-                for filename in os.listdir(ld):
-                    if not force:
-                        if shutil.which(os.path.split(filename)[-1]):
-                            raise FileExistsError
 
-                    link_loc = os.path.join(toaster_loc, 'bin', filename)
+@tracing.traced()
+def make_symlinks(package_toml, package_dir, link_warn=True, force=False):
+    """Makes symlinks, returns the names of the binaries which weren't linked because they already exist"""
+    # Link package binaries to toaster/bin
+    package = os.path.basename(package_dir)
+
+    conflicts = links.link_package(
+        package, package_dir, _link_dirs(package_toml), force=force)
 
-                    if force:
-                        if os.path.exists(link_loc):
-                            os.remove(link_loc)
+    if conflicts and link_warn:
+        secho(f"{len(conflicts)} links already exist and were not linked: {', '.join(sorted(conflicts))}. You can force links using `toaster link --force {package}`",
+              fg='bright_black')
 
-                    os.symlink(os.path.join(ld, filename), link_loc)
-    except FileExistsError:
-        if link_warn:
-            secho("1 or more links already exist and were not linked. You can force links using `toaster link --force package`",
-                  fg='bright_black')
+    return conflicts
 
 
 def remove_symlinks(package_toml, package_dir):
     """Deletes symlinks"""
     # Unlink package binaries to toaster/bin
-    link_dirs = dependingonsys(
-        package_toml, 'link_dirs', append_mode=True) or ['bin']
-
-    for ld in link_dirs:
-        ld = os.path.join(package_dir, ld)
-
-        if os.path.isdir(ld):
-            for filename in os.listdir(ld):
-                loc = os.path.join(toaster_loc, 'bin', filename)
-
-                if os.path.exists(loc):
-                    os.remove(loc)
+    links.unlink_package(os.path.basename(package_dir),
+                         package_dir, _link_dirs(package_toml))
 
 
 def clean_symlinks():
     """Cleans left over symbolic links from uninstalled/updated packages"""
-    bin_dir = os.path.join(toaster_loc, 'bin')
-
-    for filename in os.listdir(bin_dir):
-        file = os.path.join(bin_dir, filename)
-
-        if not os.path.exists(os.readlink(file)):
-            os.remove(file)
+    links.clean()
 
 
 def remove_package(package):
     """Remove/uninstall a package"""
-    package_dir = get_package_loc(package)
-    package_toml_loc = os.path.join(
-        toaster_loc, 'package_data', f'{package}.toml')
+    with locks.package(package):
+        package_dir = get_package_loc(package)
+        package_toml_loc = os.path.join(
+            toaster_loc, 'package_data', f'{package}.toml')
 
-    try:
-        package_toml = toml.load(package_toml_loc)
-    except FileNotFoundError:
-        raise NotFound(package)
+        try:
+            package_spec = spec.load(package_toml_loc)
+        except FileNotFoundError:
+            raise NotFound(package)
 
-    dependants = get_dependants(package)
+        dependants = get_dependants(package)
 
-    if dependants:
-        raise DependedOnError(package, dependants)
+        if dependants:
+            raise DependedOnError(package, dependants)
 
-    if 'binary' in package_toml['types']:
-        if 'uninstall' in package_toml['binary']:
+        if package_spec.section:
             # Run scripts
-            if dependingonsys(package_toml['binary']['uninstall'], 'scripts', append_mode=True):
-                for cmd in dependingonsys(package_toml['binary']['uninstall'], 'scripts', append_mode=True):
-                    subprocess.run(cmd)
+            for cmd in package_spec.section.uninstall_scripts:
+                subprocess.run(cmd)
 
             # Run "post_scripts"
-            if dependingonsys(package_toml['binary']['uninstall'], 'post_scripts', append_mode=True):
-                for cmd in dependingonsys(package_toml['binary']['uninstall'], 'post_scripts', append_mode=True):
-                    subprocess.run(cmd)
-    elif 'build' in package_toml['types']:
-        if 'uninstall' in package_toml['build']:
-            # Run scripts
-            if dependingonsys(package_toml['build']['uninstall'], 'scripts', append_mode=True):
-                for cmd in dependingonsys(package_toml['build']['uninstall'], 'scripts', append_mode=True):
-                    subprocess.run(cmd)
+            for cmd in package_spec.section.uninstall_post_scripts:
+                subprocess.run(cmd)
 
-            # Run "post_scripts"
-            if dependingonsys(package_toml['build']['uninstall'], 'post_scripts', append_mode=True):
-                for cmd in dependingonsys(package_toml['build']['uninstall'], 'post_scripts', append_mode=True):
-                    subprocess.run(cmd)
-    if os.path.exists(package_dir):
-        shutil.rmtree(package_dir)
-
-    if os.path.exists(package_toml_loc):
-        os.remove(package_toml_loc)
-
-    # Delete broken symlinks
-    clean_symlinks()
-
-
-def _tar_members(base, tar, strip=1):
-    members = []
-
-    for member in tar.getmembers():
-        p = Path(member.path)
-        member.path = os.path.join(
-            base, p.relative_to(*p.parts[:strip]))
-        members.append(member)
-
-    return members
-
-
-def _extract_tar(path, file_name):
-    with tarfile.open(file_name) as f:
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(f, members=_tar_members(path,f))
-
-
-def _build_package(repo_dir, package_dir, package_toml, file_name=None, is_git=True, link_warn=True, update=False):
-    """Build/install a package"""
-    wd = os.getcwd()
-
-    if update:
-        if os.path.exists(package_dir):
-            shutil.rmtree(package_dir)
+        links.unlink_package(package, package_dir,
+                             package_spec.section.link_dirs if package_spec.section else ())
+
+        generations.remove(package_dir)
+
+        if os.path.exists(package_toml_loc):
+            os.remove(package_toml_loc)
+
+        installed.forget_package(package)
+
+
+def _stream_extract(url, path):
+    """Download an archive straight into `path` while it is saved to the artifact store
+
+    Returns the artifact's location. Nothing is extracted if the artifact was already stored."""
+    return artifacts.fetch(url, extract=lambda fileobj: extract_tar(path, fileobj=fileobj))
+
+
+def _build_package(repo_dir, package_dir, package_spec, file_name=None, is_git=True, link_warn=True, extracted_dir=None, link=True, check=False):
+    """Build/install a package, returns the hashes of the files store.dedupe hashed
+
+    If `check` is set, a script that fails raises BuildFailed instead of being skipped."""
+    build = package_spec.build
+
+    source = bottles.source_id(repo_dir if is_git else None, file_name)
+    bottle = bottles.key(package_spec, source, package_dir)
+
+    # Built before with the same recipe, source and platform
+    if bottles.pour(bottle, package_dir):
+        for d in (repo_dir, extracted_dir):
+            if d and os.path.exists(d):
+                shutil.rmtree(d)
+
+        hashes = store.dedupe(package_dir)
+
+        if link:
+            make_symlinks(build, package_dir, link_warn)
+
+        return hashes
+
+    # Only builds where every script worked are bottled
+    failed = False
 
     # Make package dir and package/bin dir
     os.mkdir(package_dir)
     os.mkdir(os.path.join(package_dir, 'bin'))
 
     if not is_git:
-        repo_dir = os.path.join(
-            toaster_loc, '.cache', f'extracted{os.path.split(file_name)[-1]}')
+        # Extract to the package's own temp dir, archives from different packages can share a name
+        if os.path.exists(repo_dir):
+            shutil.rmtree(repo_dir)
 
         # Extract file
-        archive_type = dependingonsys(
-            package_toml['build'], 'type').strip().lower()
-
-        if archive_type in ['tar', 'gz', 'xz']:
-            _extract_tar(repo_dir, file_name)
-        elif archive_type == 'zip':
-            with zipfile.ZipFile(file_name, 'r') as f:
-                f.extractall(repo_dir)
+        if extracted_dir and os.path.exists(extracted_dir):
+            # Already extracted while it was downloaded
+            os.rename(extracted_dir, repo_dir)
         else:
-            msg = f"Unknown archive type: {dependingonsys(package_toml['build'], 'type')}"
-            raise NotImplemented(msg)
+            extract_archive(build.type, repo_dir, file_name)
 
         link_warn = True
 
-    os.chdir(repo_dir)
+    # Hold a job slot for the whole build, so builds running at once share the machine's CPUs
+    with jobserver.slot() as (jobs, env, fds):
+        env = {**os.environ, **env}
 
-    # Run scripts
-    if dependingonsys(package_toml['build'], 'scripts', append_mode=True):
-        for cmd in dependingonsys(package_toml['build'], 'scripts', append_mode=True):
+        # Run scripts
+        for cmd in build.scripts:
             # Format scripts
-            if dependingonsys(package_toml['build'], 'format_scripts'):
+            if build.format_scripts:
                 cmdnew = []
 
                 for i in cmd:
                     cmdnew.append(
-                        i.format(prefix=package_dir))
+                        i.format(prefix=package_dir, jobs=jobs))
 
                 cmd = cmdnew
 
             try:
-                subprocess.run(cmd)
+                with tracing.span('script', package=package_spec.name, cmd=' '.join(cmd)):
+                    failed = subprocess.run(
+                        cmd, cwd=repo_dir, env=env, pass_fds=fds).returncode != 0 or failed
             except:
                 errecho(f'error running: {cmd}')
+                failed = True
 
-    # Delete temp cache dir
-    shutil.rmtree(repo_dir)
+            if check and failed:
+                raise BuildFailed(cmd)
 
-    os.chdir(package_dir)
+        # Delete temp cache dir
+        shutil.rmtree(repo_dir)
 
-    # Run "post_scripts"
-    if dependingonsys(package_toml['build'], 'post_scripts', append_mode=True):
-        for cmd in dependingonsys(package_toml['build'], 'post_scripts', append_mode=True):
+        # Run "post_scripts"
+        for cmd in build.post_scripts:
             # Format scripts
-            if dependingonsys(package_toml['build'], 'format_scripts'):
+            if build.format_scripts:
                 cmdnew = []
 
                 for i in cmd:
-                    cmdnew.append(i.format(prefix=package_dir))
+                    cmdnew.append(i.format(prefix=package_dir, jobs=jobs))
 
                 cmd = cmdnew
 
-            subprocess.run(cmd)
+            with tracing.span('post_script', package=package_spec.name, cmd=' '.join(cmd)):
+                failed = subprocess.run(
+                    cmd, cwd=package_dir, env=env, pass_fds=fds).returncode != 0 or failed
+
+            if check and failed:
+                raise BuildFailed(cmd)
+
+    if not failed:
+        bottles.pack(bottle, package_dir, package_spec, source)
+
+    hashes = store.dedupe(package_dir)
 
     link_warn = True
 
-    make_symlinks(package_toml['build'], package_dir, link_warn)
+    if link:
+        make_symlinks(build, package_dir, link_warn)
+
+    return hashes
 
-    os.chdir(wd)
 
+def _install_binary(package, package_dir, file_name, package_spec, link_warn=True, extracted_dir=None):
+    """Installs a binary package, returns the hashes of the files which are already known"""
+    binary = package_spec.binary
+
+    # Archives are named after their hash in the artifact store
+    artifact = os.path.basename(file_name)
+    # Scripts may change the extracted files, so only untouched archives can be linked from the store
+    has_scripts = bool(binary.scripts)
+    materialized = False
 
-def _install_binary(package, package_dir, file_name, package_toml, link_warn=True):
-    """Installs a binary package"""
     # Extract file
-    archive_type = dependingonsys(
-        package_toml['binary'], 'type').strip().lower()
-
-    if archive_type in ['tar', 'gz', 'xz']:
-        _extract_tar(package_dir, file_name)
-    elif archive_type == 'zip':
-        with zipfile.ZipFile(file_name, 'r') as f:
-            f.extractall(package_dir)
+    if extracted_dir and os.path.exists(extracted_dir):
+        # Already extracted while it was downloaded
+        os.rename(extracted_dir, package_dir)
+    elif not has_scripts and store.materialize(artifact, package_dir):
+        materialized = True
     else:
-        msg = f"Unknown archive type: {dependingonsys(package_toml['binary'], 'type')}"
-        raise NotImplemented(msg)
-
-    os.chdir(package_dir)
+        extract_archive(binary.type, package_dir, file_name)
 
     # Run scripts
-    if dependingonsys(package_toml['binary'], 'scripts', append_mode=True):
-        for cmd in dependingonsys(package_toml['binary'], 'scripts', append_mode=True):
-            # Format scripts
-            if dependingonsys(package_toml['binary'], 'format_scripts'):
-                cmdnew = []
+    for cmd in binary.scripts:
+        # Format scripts
+        if binary.format_scripts:
+            cmdnew = []
 
-                for i in cmd:
-                    cmdnew.append(
-                        i.format(prefix=package_dir))
+            for i in cmd:
+                cmdnew.append(
+                    i.format(prefix=package_dir))
 
-                cmd = cmdnew
+            cmd = cmdnew
 
-            try:
-                subprocess.run(cmd)
-            except:
-                errecho(f'error running: {cmd}')
+        try:
+            with tracing.span('script', package=package, cmd=' '.join(cmd)):
+                subprocess.run(cmd, cwd=package_dir)
+        except:
+            errecho(f'error running: {cmd}')
+
+    if materialized:
+        hashes = store.tree_hashes(artifact)
+    else:
+        hashes = store.dedupe(package_dir, None if has_scripts else artifact)
 
-    make_symlinks(package_toml['binary'], package_dir, link_warn)
+    make_symlinks(binary, package_dir, link_warn)
 
+    return hashes
 
-def install_package(package_name, ignore_dependencies=False):
-    """Install a package"""
+
+def _parse_requirement(package_name):
+    """Split a requirement like `foo>=2.5` into a package name and minimum version"""
     package = package_name.split('>=')[0]
 
     package_minver = None
@@ -379,153 +395,355 @@ def install_package(package_name, ignore_dependencies=False):
     if len(package_name.split('>=')) > 1:
         package_minver = package_name.split('>=')[1]
 
-    if not os.path.exists(os.path.join(toaster_loc, '.cache')):
-        os.mkdir(os.path.join(toaster_loc, '.cache'))
+    return package, package_minver
 
-    pkgs = get_all_packages()
-    package_source = None
 
-    for key in pkgs:
-        if package in pkgs[key]:
-            package_source = key
+def is_installed(package):
+    """Check if a package is installed"""
+    try:
+        get_package_loc(package)
+    except NotFound:
+        return False
+
+    return True
 
-    if not package_source:
+
+@tracing.traced()
+def resolve_dependencies(package_name, ignore_dependencies=False):
+    """Resolve a package and all of its dependencies into a graph
+
+    Returns a dict of package name -> node for every package that still needs to be installed.
+    Each node has the package's `toml_loc`, its resolved `spec`, and its `dependencies` in the graph."""
+    from packaging import version
+
+    graph = {}
+
+    def visit(package_name, chain):
+        package, package_minver = _parse_requirement(package_name)
+
+        if package in chain:
+            raise DependencyCycle(' -> '.join(chain + [package]))
+
+        if package in graph or is_installed(package):
+            return package
+
+        package_source = _find_package(package)
+
+        package_toml_loc = os.path.join(
+            toaster_loc, 'bakery', package_source, package, f'{package}.toml')
+
+        # Resolved when the bakery was refreshed, unless that was on another platform
+        package_spec = find_spec(package, package_source)
+
+        if not spec.is_current(package_spec):
+            package_spec = spec.load(package_toml_loc, package)
+
+        if package_minver:
+            if version.parse(package_minver) > version.parse(str(package_spec.version or 0)):
+                raise NotFound(
+                    f'Could not meet minimum version requirement {package_minver} for {package}')
+
+        if not package_spec.kind:
+            raise NotImplementedError
+
+        for use in package_spec.use:
+            if not links.path_index().which(use):
+                raise UseNotFound(use)
+
+        dependencies = []
+
+        if not ignore_dependencies:
+            for dependency in package_spec.dependencies:
+                dependency = visit(dependency, chain + [package])
+
+                if dependency in graph:
+                    dependencies.append(dependency)
+
+        graph[package] = {
+            'toml_loc': package_toml_loc,
+            'spec': package_spec,
+            'dependencies': dependencies,
+        }
+
+        return package
+
+    visit(package_name, [])
+
+    return graph
+
+
+def _find_package(package):
+    """Get the name of the bakery a package is in"""
+    package_info = find_package(package)
+
+    if not package_info:
         raise NotFound(package)
 
-    package_toml_loc = os.path.join(
-        toaster_loc, 'bakery', package_source, package, f'{package}.toml')
+    return package_info['bakery']
 
-    package_data_loc = os.path.join(
-        toaster_loc, 'package_data', f'{package}.toml')
 
-    # Copy package TOML to package_data for uninstall and in case bakery is removed
-    shutil.copyfile(package_toml_loc, package_data_loc)
+def _extracted_dir(package):
+    """Where a package's archive is extracted to while it downloads"""
+    return os.path.join(toaster_loc, '.cache', f'{package}.extracted')
 
-    package_toml = toml.load(package_toml_loc)
 
-    if package_minver:
-        if version.parse(package_minver) > version.parse(package_toml.get('version', 0)):
-            raise NotFound(
-                f'Could not meet minimum version requirement {package_minver} for {package}')
+def _can_stream(section):
+    """Check if an archive can be extracted while it downloads, zips can't since their index is at the end"""
+    archive_type = (section.type or '').strip().lower()
 
-    if not ignore_dependencies:
-        install_dependencies(dependingonsys(
-            package_toml, 'dependencies', append_mode=True)
-        )
+    return get_config('stream_extract') and archive_type in TAR_TYPES
 
-    for use in dependingonsys(package_toml, 'use', append_mode=True):
-        if not shutil.which(use):
-            raise UseNotFound(use)
 
-    if 'binary' in package_toml['types']:
-        download_url = dependingonsys(package_toml['binary'], 'url')
-        package_dir = os.path.join(toaster_loc, 'binaries', package)
-        cache_dir = os.path.join(toaster_loc, '.cache', package)
+def _fetch_package(package, package_spec):
+    """Download a package's archive or clone its repo into the cache"""
+    # Loads git, which most commands don't need
+    import gitcache
 
-        if os.path.exists(package_dir):
-            raise AlreadyInstalled
+    # The package's cache directories are shared with other toaster processes installing it
+    with tracing.span('fetch', package=package), locks.package(package):
+        if os.path.exists(_extracted_dir(package)):
+            shutil.rmtree(_extracted_dir(package))
 
-        if not os.path.exists(cache_dir):
-            os.mkdir(cache_dir, 0o777)
+        if package_spec.kind == 'binary':
+            url = package_spec.binary.url
 
-        file_name = os.path.join(cache_dir, download_url.split("/")[-1])
+            if _can_stream(package_spec.binary):
+                _stream_extract(url, _extracted_dir(package))
+            else:
+                artifacts.fetch(url)
 
-        if not os.path.exists(file_name):
-            download_file(
-                download_url, file_name
-            )
+        elif package_spec.kind == 'build':
+            build = package_spec.build
+            repo_dir = os.path.join(toaster_loc, '.cache', package)
+
+            if build.repo:
+                gitcache.checkout(package, build.repo, repo_dir,
+                                  branch=build.branch)
+            elif build.url:
+                if _can_stream(build):
+                    _stream_extract(build.url, _extracted_dir(package))
+                else:
+                    artifacts.fetch(build.url)
+            else:
+                raise Exception('No where to download package from')
+        else:
+            raise NotImplementedError
 
-        _install_binary(package, package_dir, file_name, package_toml)
 
-    elif 'build' in package_toml['types']:
-        repo_dir = os.path.join(toaster_loc, '.cache', package)
-        package_dir = os.path.join(toaster_loc, 'packages', package)
+def _install_fetched(package, package_toml_loc, package_spec, is_dependency=False):
+    """Install a package which has already been fetched by _fetch_package"""
+    # Its archive can't be evicted until it is installed
+    with tracing.span('install', package=package), locks.package(package), artifacts.pinned():
+        if is_dependency:
+            secho(f"Installing dependency: {package}", fg="bright_magenta")
+
+        package_data_loc = os.path.join(
+            toaster_loc, 'package_data', f'{package}.toml')
+
+        if package_spec.kind == 'binary':
+            package_dir = os.path.join(toaster_loc, 'binaries', package)
+        elif package_spec.kind == 'build':
+            package_dir = os.path.join(toaster_loc, 'packages', package)
+        else:
+            raise NotImplementedError
 
         if os.path.exists(package_dir):
             raise AlreadyInstalled
 
-        git_url = dependingonsys(package_toml['build'], 'repo')
-        url = dependingonsys(package_toml['build'], 'url')
+        try:
+            # Copy package TOML to package_data for uninstall and in case bakery is removed
+            shutil.copyfile(package_toml_loc, package_data_loc)
+
+            if package_spec.kind == 'binary':
+                file_name = artifacts.fetch(package_spec.binary.url)
+
+                hashes = _install_binary(package, package_dir, file_name, package_spec,
+                                         extracted_dir=_extracted_dir(package))
+            else:
+                repo_dir = os.path.join(toaster_loc, '.cache', package)
+                file_name = None
+
+                is_git = bool(package_spec.build.repo)
+
+                if not is_git:
+                    file_name = artifacts.fetch(package_spec.build.url)
+
+                hashes = _build_package(repo_dir, package_dir, package_spec, file_name, is_git,
+                                        extracted_dir=_extracted_dir(package))
+
+            installed.set_dependencies(package, _dependency_names(package_spec))
+            manifest.record(package, package_dir, package_spec.version, hashes)
+        except BaseException:
+            # Without a manifest a half installed package could neither be installed again nor removed
+            _discard_install(package, package_dir, package_spec, package_data_loc)
+            raise
+
+        if is_dependency:
+            secho(f'Installed dependency: {package}', fg="bright_magenta")
+
 
-        file_name = None
+def _discard_install(package, package_dir, package_spec, package_data_loc):
+    """Delete whatever a failed install left behind"""
+    links.unlink_package(package, package_dir,
+                         package_spec.section.link_dirs if package_spec.section else ())
 
-        is_git = bool(git_url)
+    generations.remove(package_dir)
 
-        if git_url:
-            Repo.clone_from(git_url, repo_dir, branch=(dependingonsys(
-                package_toml['build'], 'branch') or 'master'), progress=CloneProgress(package, git_url))
-        elif url:
-            cache_dir = os.path.join(toaster_loc, '.cache')
+    if os.path.exists(package_data_loc):
+        os.remove(package_data_loc)
 
-            file_name = os.path.join(cache_dir, url.split("/")[-1])
+    installed.forget_package(package)
 
-            if not os.path.exists(file_name):
-                download_file(url, file_name)
+
+def install_packages(package_names, ignore_dependencies=False, jobs=None, pool=None):
+    """Install packages along with their dependencies
+
+    The whole dependency graph is resolved first, then downloads and builds run in parallel,
+    with each package only being installed once its dependencies are.
+    Returns a dict of each package name -> the exception raised while installing it, or None."""
+    os.makedirs(os.path.join(toaster_loc, '.cache'), exist_ok=True)
+
+    errors = {}
+    roots = {}
+    graph = {}
+
+    for package_name in package_names:
+        package, _ = _parse_requirement(package_name)
+
+        try:
+            if is_installed(package):
+                raise AlreadyInstalled(package)
+
+            graph.update(resolve_dependencies(
+                package_name, ignore_dependencies))
+        except (Error, NotImplementedError) as e:
+            errors[package_name] = e
         else:
-            raise Exception('No where to download package from')
+            roots[package_name] = package
 
-        _build_package(repo_dir, package_dir, package_toml, file_name, is_git)
-    else:
-        raise NotImplementedError
+    tasks = {}
+
+    for package, node in graph.items():
+        is_dependency = package not in roots.values()
+
+        tasks[('fetch', package)] = (
+            _fetch_package, (package, node['spec']), [])
+        tasks[('install', package)] = (
+            _install_fetched,
+            (package, node['toml_loc'], node['spec'], is_dependency),
+            [('fetch', package)] + [('install', d)
+                                    for d in node['dependencies']]
+        )
+
+    # Every build in this install shares one jobserver
+    with jobserver.running():
+        results = run_graph(tasks, jobs or get_config(
+            'jobs'), pool or get_config('pool'))
+
+    for package_name, package in roots.items():
+        errors[package_name] = results[('install', package)]
+
+    return errors
+
+
+def install_package(package_name, ignore_dependencies=False, jobs=None):
+    """Install a package"""
+    err = install_packages([package_name], ignore_dependencies, jobs)[
+        package_name]
+
+    if err:
+        raise err
 
 
 def update_all_packages():
     """Update all packages"""
-    for t in ['packages', 'binaries', 'apps']:
-        for package in os.listdir(os.path.join(toaster_loc, t)):
-            try:
-                update_package(package)
-            except:
-                continue
+    for row in get_installed():
+        try:
+            update_package(row['name'])
+        except:
+            continue
 
 
 def update_package(package):
     """Update a package"""
-    pkgs = get_all_packages()
-    package_source = None
+    import gitcache
 
-    for key in pkgs:
-        if package in pkgs[key]:
-            package_source = key
+    with locks.package(package):
+        package_source = _find_package(package)
 
-    if not package_source:
-        raise NotFound(package)
+        package_toml_loc = os.path.join(
+            toaster_loc, 'bakery', package_source, package, f'{package}.toml')
 
-    package_toml_loc = os.path.join(
-        toaster_loc, 'bakery', package_source, package, f'{package}.toml')
+        package_data_loc = os.path.join(
+            toaster_loc, 'package_data', f'{package}.toml')
 
-    package_data_loc = os.path.join(
-        toaster_loc, 'package_data', f'{package}.toml')
+        if not os.path.exists(package_data_loc):
+            raise NotFound(package)
 
-    if not os.path.exists(package_data_loc):
-        raise NotFound(package)
+        package_spec = spec.load(package_toml_loc, package)
 
-    package_toml = toml.load(package_toml_loc)
+        package_data_spec = spec.load(package_data_loc, package)
 
-    package_data_toml = toml.load(package_data_loc)
+        if package_data_spec.version == package_spec.version:
+            raise AlreadyInstalled('Already up to date!')
 
-    if package_data_toml.get('version', None) == package_toml.get('version', None):
-        raise AlreadyInstalled('Already up to date!')
+        if package_spec.kind == 'build':
+            repo_dir = os.path.join(toaster_loc, '.cache', package)
+            package_dir = os.path.join(toaster_loc, 'packages', package)
 
-    if 'build' in package_toml['types']:
-        repo_dir = os.path.join(toaster_loc, '.cache', package)
-        package_dir = os.path.join(toaster_loc, 'packages', package)
+            if not os.path.exists(package_dir):
+                raise NotFound(package)
 
-        if not os.path.exists(package_dir):
-            raise NotFound(package)
+            if not package_spec.build.repo:
+                raise Exception('No repo in TOML')
+
+            gitcache.checkout(package, package_spec.build.repo, repo_dir,
+                              branch=package_spec.build.branch)
+
+            # Build into a new generation, the installed one keeps working until it is swapped out
+            generation_dir = generations.stage(package_dir)
+
+            try:
+                with jobserver.running():
+                    hashes = _build_package(repo_dir, generation_dir, package_spec,
+                                            link=False, check=True)
+            except BaseException:
+                generations.discard(generation_dir)
+                raise
 
-        git_url = dependingonsys(package_toml['build'], 'repo')
+            generations.commit(package_dir, generation_dir,
+                               package_toml_loc, package_data_loc)
 
-        if not git_url:
-            raise Exception('No repo in TOML')
+            # Copy package TOML to package_data for uninstall and in case bakery is removed
+            shutil.copyfile(package_toml_loc, package_data_loc)
 
-        Repo.clone_from(git_url, repo_dir, branch=(dependingonsys(
-            package_toml['build'], 'branch') or 'master'), progress=CloneProgress(package, git_url))
+            make_symlinks(package_spec.build, package_dir, link_warn=False)
+            links.prune(package)
 
-        # Copy package TOML to package_data for uninstall and in case bakery is removed
+            installed.set_dependencies(package, _dependency_names(package_spec))
+            manifest.record(package, package_dir, package_spec.version, hashes)
+        else:
+            raise NotImplementedError
+
+
+def rollback_package(package):
+    """Swap a package back to the version it was updated from, without building it again"""
+    with locks.package(package):
+        package_dir = get_package_loc(package)
+        package_data_loc = os.path.join(
+            toaster_loc, 'package_data', f'{package}.toml')
+
+        package_toml_loc = generations.rollback(package_dir)
         shutil.copyfile(package_toml_loc, package_data_loc)
 
-        _build_package(repo_dir, package_dir, package_toml,
-                       link_warn=True, update=True)
-    else:
-        raise NotImplementedError
+        package_spec = spec.load(package_data_loc, package)
+
+        if package_spec.section:
+            make_symlinks(package_spec.section, package_dir, link_warn=False)
+
+        links.prune(package)
+
+        installed.set_dependencies(package, _dependency_names(package_spec))
+        manifest.record(package, package_dir, package_spec.version)
+
+        return package_spec.version
@@ -0,0 +1,18 @@
+"""
+Progress bars for long running git operations
+"""
+from git import RemoteProgress
+from tqdm.auto import tqdm
+
+
+class CloneProgress(RemoteProgress):
+    """Progress bar for git cloning"""
+
+    def __init__(self, package, url):
+        super().__init__()
+        self.pbar = tqdm(desc=f'Cloning {url}...')
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        self.pbar.total = max_count
+        self.pbar.n = cur_count
+        self.pbar.refresh()
@@ -0,0 +1,78 @@
+"""
+Runs graphs of tasks on a worker pool
+"""
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from exceptions import DependencyFailed
+
+
+def make_executor(jobs, pool='thread'):
+    """Make a thread or process pool with `jobs` workers"""
+    jobs = max(1, int(jobs))
+
+    if pool == 'process':
+        return ProcessPoolExecutor(max_workers=jobs)
+    elif pool == 'thread':
+        return ThreadPoolExecutor(max_workers=jobs)
+
+    raise ValueError(f'Unknown pool type: {pool}')
+
+
+def run_graph(tasks, jobs, pool='thread'):
+    """Run a graph of tasks, starting each one as soon as its prerequisites are done
+
+    `tasks` is a dict of task id -> (function, args, prerequisite task ids).
+    Returns a dict of task id -> the exception the task raised, or None if it succeeded.
+    Tasks whose prerequisites failed are never started and get a DependencyFailed instead."""
+    results = {}
+    waiting = {t: set(tasks[t][2]) for t in tasks}
+    dependents = {t: [] for t in tasks}
+
+    for t in tasks:
+        for prereq in tasks[t][2]:
+            dependents[prereq].append(t)
+
+    def skip(t, err):
+        if t not in waiting:
+            return
+
+        del waiting[t]
+        results[t] = err
+
+        for dependent in dependents[t]:
+            skip(dependent, DependencyFailed(t))
+
+    with make_executor(jobs, pool) as executor:
+        running = {}
+
+        def submit_ready():
+            for t in [t for t in waiting if not waiting[t]]:
+                del waiting[t]
+                func, args, _ = tasks[t]
+                running[executor.submit(func, *args)] = t
+
+        submit_ready()
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                t = running.pop(future)
+                results[t] = future.exception()
+
+                for dependent in dependents[t]:
+                    if results[t] is not None:
+                        skip(dependent, DependencyFailed(t))
+                    elif dependent in waiting:
+                        waiting[dependent].discard(t)
+
+            submit_ready()
+
+    # Anything left over is part of a loop and can never start
+    for t in list(waiting):
+        skip(t, DependencyFailed(t))
+
+    return results
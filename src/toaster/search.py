@@ -0,0 +1,233 @@
+"""
+Full-text search over the packages in the catalog
+
+When a bakery is refreshed, each package's name, description, homepage and license are split into
+terms, and catalog.db stores an inverted index from each term to the packages which have it. Terms
+are indexed by their trigrams too, which finds the terms close to a misspelled word.
+"""
+import re
+
+# How much a match in each field counts towards a package's rank, fields are indexed by their position
+FIELDS = {'name': 8, 'desc': 2, 'homepage': 1, 'license': 1}
+_WEIGHTS = list(FIELDS.values())
+
+# Parts of homepages which say nothing about the package
+_URL_NOISE = {'http', 'https', 'www', 'com', 'org', 'net', 'io', 'html'}
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+# Words shorter than this only match exactly, and no prefix is expanded to more terms than this
+_MIN_PREFIX = 2
+_MAX_PREFIX_TERMS = 2000
+
+# Once this few packages match the words so far, the postings of the other words are only read for them
+_MAX_CANDIDATES = 500
+
+
+def words(text):
+    """Split text into lowercase words"""
+    return _WORD.findall(str(text or '').lower())
+
+
+def terms(package):
+    """Get the (term, field) pairs to index for a package dict from the catalog"""
+    found = {(package['name'].lower(), 0)}
+    found.update((word, 0) for word in words(package['name']))
+
+    for field, name in enumerate(FIELDS):
+        if field:
+            found.update((word, field) for word in words(package.get(name))
+                         if len(word) > 1 and not (name == 'homepage' and word in _URL_NOISE))
+
+    return found
+
+
+def is_fuzzy(term):
+    """Check if misspellings of a term are looked for, which needs its trigrams indexed
+
+    Whole package names like foo-bar are left out, since queries are split into words."""
+    return 3 <= len(term) <= 20 and _WORD.fullmatch(term) is not None
+
+
+def grams(term):
+    """Get the trigrams of a term, padded so its start and end count too"""
+    padded = f'${term}$'
+
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def distance(a, b, limit):
+    """Edit distance between two words, or limit + 1 as soon as it must be bigger than limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    previous = list(range(len(b) + 1))
+
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+
+        if min(current) > limit:
+            return limit + 1
+
+        previous = current
+
+    return previous[-1]
+
+
+def _postings(conn, sql, params):
+    cursor = conn.cursor()
+    # Plain tuples, there can be tens of thousands of these
+    cursor.row_factory = None
+
+    return cursor.execute(sql, params).fetchall()
+
+
+def _fuzzy_terms(conn, word):
+    """Find the indexed terms within a few typos of a word, as a dict of term -> distance"""
+    limit = 1 if len(word) <= 4 else 2
+    word_grams = grams(word)
+
+    # Every typo changes at most 3 trigrams
+    shared = max(1, len(word_grams) - 3 * limit)
+
+    candidates = _postings(
+        conn, f"SELECT term FROM grams WHERE gram IN ({', '.join('?' * len(word_grams))}) GROUP BY term HAVING COUNT(*) >= ?",
+        (*word_grams, shared))
+
+    found = {}
+
+    for (term,) in candidates:
+        d = distance(word, term, limit)
+
+        if d <= limit:
+            found[term] = d
+
+    return found
+
+
+def _prefixed(conn, word):
+    """Get the first _MAX_PREFIX_TERMS indexed terms starting with a word in order, and if there were more
+
+    Each term is found with one lookup in the table's primary key, however many packages have it."""
+    found = _postings(conn, '''WITH RECURSIVE prefixed (term) AS (
+                                   SELECT MIN(term) FROM terms WHERE term >= ?1 AND term < ?2
+                                   UNION ALL
+                                   SELECT (SELECT MIN(term) FROM terms WHERE term > prefixed.term AND term < ?2)
+                                   FROM prefixed WHERE prefixed.term IS NOT NULL
+                                   LIMIT ?3)
+                               SELECT term FROM prefixed WHERE term IS NOT NULL''',
+                      (word, word + '\U0010ffff', _MAX_PREFIX_TERMS + 2))
+
+    return [term for (term,) in found[:_MAX_PREFIX_TERMS]], len(found) > _MAX_PREFIX_TERMS
+
+
+def _match(conn, word, fuzzy, candidates=None):
+    """Score the packages matching a word, returns a dict of document -> score and if the word started
+    too many terms to look at all of them
+
+    If `candidates` are given, only those documents are looked at."""
+    only = ''
+
+    if candidates is not None:
+        only = f" AND document IN ({', '.join('?' * len(candidates))})"
+        candidates = tuple(candidates)
+    else:
+        candidates = ()
+
+    truncated = False
+
+    if len(word) < _MIN_PREFIX:
+        rows = _postings(
+            conn, f'SELECT * FROM terms WHERE term = ?{only}', (word, *candidates))
+    else:
+        prefixed, truncated = _prefixed(conn, word)
+
+        # Terms lead the table's primary key, so the postings of the terms starting with the word are one range scan
+        rows = _postings(conn, f'SELECT * FROM terms WHERE term >= ? AND term <= ?{only}',
+                         (word, prefixed[-1], *candidates)) if prefixed else []
+
+    found = None
+
+    # Misspellings are only looked for when nothing starts with the word
+    if not rows and fuzzy and is_fuzzy(word):
+        found = _fuzzy_terms(conn, word)
+
+        if found:
+            rows = _postings(conn, f"SELECT * FROM terms WHERE term IN ({', '.join('?' * len(found))}){only}",
+                             (*found, *candidates))
+
+    # The best match in each of a package's fields counts. Exact matches beat prefixes, prefixes
+    # close to the whole term beat short ones, and misspellings come last
+    best = {}
+
+    for term, document, field in rows:
+        if found:
+            quality = 0.4 / found[term]
+        elif term == word:
+            quality = 1
+        else:
+            quality = 0.5 + 0.4 * len(word) / len(term)
+
+        key = (document, field)
+        best[key] = max(best.get(key, 0), quality)
+
+    scores = {}
+
+    for (document, field), quality in best.items():
+        scores[document] = scores.get(document, 0) + _WEIGHTS[field] * quality
+
+    return scores, truncated
+
+
+def find(conn, query, limit=20, fuzzy=True):
+    """Rank the packages matching every word of a query, returns (how many matched, best `limit` of them,
+    words which started too many terms to look at all of them)
+
+    Results are dicts with the package's `name`, `bakery`, `version`, `desc`, `homepage` and `license`."""
+    scores = None
+    truncated = []
+
+    # Longer words tend to match fewer packages, which leaves fewer to look at for the rest
+    for word in sorted(set(words(query)), key=len, reverse=True):
+        small = scores is not None and len(scores) <= _MAX_CANDIDATES
+        matches, cut = _match(conn, word, fuzzy, scores if small else None)
+
+        if cut:
+            truncated.append(word)
+
+        if scores is None:
+            scores = matches
+        else:
+            scores = {document: score + matches[document]
+                      for document, score in scores.items() if document in matches}
+
+        if not scores:
+            return 0, [], truncated
+
+    if scores is None:
+        return 0, [], truncated
+
+    # Asking for a package by its name should always put it first
+    for _, document, _ in _postings(conn, 'SELECT * FROM terms WHERE term = ? AND field = 0', (query.strip().lower(),)):
+        if document in scores:
+            scores[document] += 100
+
+    ranked = sorted(scores, key=scores.get, reverse=True)
+
+    # Ties go to the bakery added last like they do everywhere else, then to names in order,
+    # so packages tied with the last one shown are ranked too
+    cutoff = scores[ranked[min(limit, len(ranked)) - 1]] if limit > 0 else float('inf')
+    best = [document for document in ranked if scores[document]
+            >= cutoff][:max(limit, _MAX_CANDIDATES)]
+    rows = conn.execute(f'''SELECT d.*, p.version, p.priority FROM documents d
+                            JOIN packages p ON p.bakery = d.bakery AND p.name = d.name
+                            WHERE d.id IN ({', '.join('?' * len(best))})''', best).fetchall()
+
+    results = [{**dict(row), 'score': scores[row['id']]} for row in rows]
+    results.sort(key=lambda r: (-r['score'], -r['priority'], r['name']))
+
+    return len(scores), results[:limit], truncated
@@ -0,0 +1,142 @@
+"""
+Package TOMLs resolved for this platform, so dependingonsys only has to walk them once
+"""
+import threading
+from collections import OrderedDict
+
+import manifests
+from config import get_config
+from utils import current_platform
+from utils import dependingonsys
+
+# Package types which have their own table of how to install them
+KINDS = ('binary', 'build')
+
+# Bumped whenever a Spec or Section gains, loses or changes a field, so saved ones are resolved again
+SCHEMA = 1
+
+
+class _Frozen:
+    """Base for read-only objects with slots, which can still be pickled for the catalog and worker processes"""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        # Pickles of an older version of the class would otherwise load with fields missing
+        if len(values) != len(self.__slots__):
+            raise TypeError(f'{type(self).__name__} takes {len(self.__slots__)} values, not {len(values)}')
+
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__reduce__() == other.__reduce__()
+
+    def __hash__(self):
+        return hash(self.__reduce__()[1])
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class Section(_Frozen):
+    """The resolved `binary` or `build` table of a package"""
+    __slots__ = ('type', 'url', 'repo', 'branch', 'scripts', 'post_scripts', 'format_scripts',
+                 'link_dirs', 'uninstall_scripts', 'uninstall_post_scripts')
+
+
+class Spec(_Frozen):
+    """A package TOML resolved for one platform"""
+    __slots__ = ('name', 'version', 'types', 'dependencies', 'use', 'binary', 'build', 'platform')
+
+    @property
+    def kind(self):
+        """The type of install this package uses, `binary` or `build`, or None if it has neither"""
+        for kind in KINDS:
+            if kind in self.types:
+                return kind
+
+    @property
+    def section(self):
+        """The resolved table for this package's kind of install"""
+        return getattr(self, self.kind) if self.kind else None
+
+
+def _scripts(d, item):
+    return tuple(tuple(cmd) for cmd in dependingonsys(d, item, append_mode=True))
+
+
+def _resolve_section(d):
+    if not isinstance(d, dict):
+        return None
+
+    uninstall = d.get('uninstall', {})
+
+    return Section(
+        dependingonsys(d, 'type'),
+        dependingonsys(d, 'url'),
+        dependingonsys(d, 'repo'),
+        dependingonsys(d, 'branch') or 'master',
+        _scripts(d, 'scripts'),
+        _scripts(d, 'post_scripts'),
+        bool(dependingonsys(d, 'format_scripts')),
+        tuple(dependingonsys(d, 'link_dirs', append_mode=True) or ['bin']),
+        _scripts(uninstall, 'scripts'),
+        _scripts(uninstall, 'post_scripts'),
+    )
+
+
+def resolve(package_toml, name=None):
+    """Resolve a parsed package TOML into a Spec for this platform"""
+    return Spec(
+        package_toml.get('name', name),
+        package_toml.get('version'),
+        tuple(package_toml.get('types', [])),
+        tuple(dependingonsys(package_toml, 'dependencies', append_mode=True)),
+        tuple(dependingonsys(package_toml, 'use', append_mode=True)),
+        _resolve_section(package_toml.get('binary')),
+        _resolve_section(package_toml.get('build')),
+        current_platform(),
+    )
+
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def load(path, name=None):
+    """Load a package TOML as a Spec, resolving it only when the file has changed"""
+    package_toml = manifests.load(path)
+
+    with _lock:
+        cached = _cache.get(path)
+
+        # manifests hands out the same dict for as long as the file is unchanged
+        if cached and cached[0] is package_toml:
+            _cache.move_to_end(path)
+            return cached[1]
+
+    spec = resolve(package_toml, name)
+
+    with _lock:
+        _cache[path] = (package_toml, spec)
+        _cache.move_to_end(path)
+
+        while len(_cache) > get_config('manifest_cache_size'):
+            _cache.popitem(last=False)
+
+    return spec
+
+
+def is_current(spec):
+    """Check if a Spec was resolved for this platform, a toaster home can be shared between computers"""
+    return spec is not None and spec.platform == current_platform()
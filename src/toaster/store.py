@@ -0,0 +1,326 @@
+"""
+Deduplicated store for the files of installed packages
+"""
+import ctypes
+import errno
+import json
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+
+import installed
+import tracing
+from config import get_config
+from database import connect
+from utils import hash_file
+from utils import where_is_toaster
+
+toaster_loc = where_is_toaster()
+
+store_dir = os.path.join(toaster_loc, 'store')
+objects_dir = os.path.join(store_dir, 'objects')
+store_db_loc = os.path.join(store_dir, 'store.db')
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS trees (
+        artifact TEXT PRIMARY KEY,
+        entries TEXT NOT NULL,
+        last_used REAL NOT NULL
+    )''',
+]
+
+# ioctl which makes a file share another file's data on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Errors which mean a filesystem can't link files at all, rather than that one link failed
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EINVAL}
+
+# Devices which turned out not to support reflinks or hardlinks into the store
+_no_reflink = set()
+_no_hardlink = set()
+_lock = threading.Lock()
+
+
+def get_store_db():
+    """Returns a connection to the store's index"""
+    os.makedirs(store_dir, exist_ok=True)
+    return connect(store_db_loc, schema)
+
+
+def object_loc(key):
+    """Get the location of a stored file"""
+    return os.path.join(objects_dir, key[:2], key)
+
+
+def _method():
+    method = str(get_config('dedupe')).lower()
+
+    if method in ('false', 'off', 'none'):
+        return None
+
+    return method
+
+
+def _reflink(src, dst):
+    """Make `dst` a copy-on-write clone of `src`"""
+    if sys.platform == 'darwin':
+        libc = ctypes.CDLL(None, use_errno=True)
+
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+    elif sys.platform.startswith('linux'):
+        import fcntl
+
+        try:
+            with open(src, 'rb') as s, open(dst, 'xb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+
+        shutil.copystat(src, dst)
+    else:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported', dst)
+
+
+def _link(src, dst, method):
+    """Make `dst` share `src`'s data, with a reflink if possible and a hardlink otherwise
+
+    Returns False if neither works on this filesystem."""
+    dev = os.stat(os.path.dirname(dst)).st_dev
+
+    if method in ('auto', 'reflink') and dev not in _no_reflink:
+        try:
+            _reflink(src, dst)
+            return True
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise
+
+            if e.errno in _UNSUPPORTED:
+                with _lock:
+                    _no_reflink.add(dev)
+
+    if method in ('auto', 'hardlink') and dev not in _no_hardlink:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise
+
+            if e.errno in _UNSUPPORTED:
+                with _lock:
+                    _no_hardlink.add(dev)
+
+    return False
+
+
+def _replace_with(obj, file, method):
+    """Replace `file` with a link to the stored `obj`"""
+    tmp = f'{file}.toaster-dedupe'
+
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+
+    if _link(obj, tmp, method):
+        os.replace(tmp, file)
+        return True
+
+    return False
+
+
+def _store_file(file, key, method):
+    """Deduplicate a file against the store, adding it if its content isn't stored yet"""
+    obj = object_loc(key)
+
+    if os.path.exists(obj):
+        return _replace_with(obj, file, method)
+
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+
+    try:
+        return _link(file, obj, method)
+    except FileExistsError:
+        # Stored by another install at the same time
+        return _replace_with(obj, file, method)
+
+
+@tracing.traced()
+def dedupe(path, artifact=None):
+    """Replace the files in a package directory with links to identical files in the store
+
+    Every file is hashed once here. If `artifact` is given, the tree is remembered so later installs
+    of the same archive can be linked straight from the store with `materialize`.
+    Returns a dict of each hashed file's path in the package -> its sha256 hash."""
+    method = _method()
+    hashes = {}
+
+    if not method:
+        return hashes
+
+    entries = []
+    complete = True
+
+    for root, dirs, files in os.walk(path):
+        rel_root = os.path.relpath(root, path)
+        rel_root = '' if rel_root == os.curdir else rel_root
+
+        for d in dirs:
+            d_path = os.path.join(root, d)
+            st = os.lstat(d_path)
+
+            if stat.S_ISLNK(st.st_mode):
+                entries.append(['l', os.path.join(rel_root, d),
+                                os.readlink(d_path)])
+            else:
+                entries.append(['d', os.path.join(rel_root, d),
+                                stat.S_IMODE(st.st_mode)])
+
+        for f in files:
+            file = os.path.join(root, f)
+            rel = os.path.join(rel_root, f)
+            st = os.lstat(file)
+
+            if stat.S_ISLNK(st.st_mode):
+                entries.append(['l', rel, os.readlink(file)])
+                continue
+            elif not stat.S_ISREG(st.st_mode):
+                complete = False
+                continue
+
+            # Linked files share their mode, so it is part of the key
+            hashes[rel] = hash_file(file)
+            key = f'{hashes[rel]}-{stat.S_IMODE(st.st_mode):o}'
+
+            if _store_file(file, key, method):
+                entries.append(['f', rel, key])
+            else:
+                complete = False
+
+    if artifact and complete:
+        conn = get_store_db()
+
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO trees VALUES (?, ?, ?)',
+                         (artifact, json.dumps(entries), time.time()))
+
+    return hashes
+
+
+def tree_hashes(artifact):
+    """Get the hashes of the files of an archive remembered by `dedupe`, like `dedupe` returns them"""
+    row = get_store_db().execute(
+        'SELECT entries FROM trees WHERE artifact = ?', (artifact,)).fetchone()
+
+    if not row:
+        return {}
+
+    return {rel: key.rsplit('-', 1)[0] for kind, rel, key in json.loads(row['entries']) if kind == 'f'}
+
+
+@tracing.traced()
+def materialize(artifact, path):
+    """Fill `path` with links to the stored files of an archive installed before
+
+    Returns False without touching `path` if the archive's files aren't all stored."""
+    method = _method()
+
+    if not method:
+        return False
+
+    conn = get_store_db()
+    row = conn.execute(
+        'SELECT entries FROM trees WHERE artifact = ?', (artifact,)).fetchone()
+
+    if not row:
+        return False
+
+    entries = json.loads(row['entries'])
+
+    if not all(os.path.exists(object_loc(entry[2])) for entry in entries if entry[0] == 'f'):
+        return False
+
+    tmp = f'{path}.toaster-materialize'
+
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+
+    os.makedirs(tmp)
+
+    try:
+        # Entries come from a top-down walk, so directories come before their contents
+        for kind, rel, value in entries:
+            target = os.path.join(tmp, rel)
+
+            if kind == 'd':
+                os.mkdir(target)
+            elif kind == 'l':
+                os.symlink(value, target)
+            elif not _link(object_loc(value), target, method):
+                shutil.copy2(object_loc(value), target)
+
+        # Directory modes are set last so read-only directories can still be filled
+        for kind, rel, value in entries:
+            if kind == 'd':
+                os.chmod(os.path.join(tmp, rel), value)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    os.rename(tmp, path)
+
+    with conn:
+        conn.execute('UPDATE trees SET last_used = ? WHERE artifact = ?',
+                     (time.time(), artifact))
+
+    return True
+
+
+def _objects():
+    if not os.path.exists(objects_dir):
+        return
+
+    for prefix in os.listdir(objects_dir):
+        prefix_dir = os.path.join(objects_dir, prefix)
+
+        for key in os.listdir(prefix_dir):
+            yield os.path.join(prefix_dir, key)
+
+
+def usage():
+    """Returns how many files are stored and how many bytes they use"""
+    count = 0
+    size = 0
+
+    for obj in _objects():
+        count += 1
+        size += os.lstat(obj).st_size
+
+    return count, size
+
+
+def gc():
+    """Delete stored files no installed package uses
+
+    A file is used if an installed package's manifest has its content, or if it is hardlinked anywhere.
+    Reflinked files can't be told apart from copies, so only the manifests know about them.
+    Returns how many files were deleted and how many bytes that freed."""
+    used = {f'{file_hash}-{mode:o}' for file_hash, mode in installed.get_file_contents()}
+    deleted = 0
+    freed = 0
+
+    for obj in _objects():
+        st = os.lstat(obj)
+
+        if st.st_nlink == 1 and os.path.basename(obj) not in used:
+            os.remove(obj)
+            deleted += 1
+            freed += st.st_size
+
+    return deleted, freed
@@ -0,0 +1,137 @@
+"""
+Spans timing each phase of a command, for `toaster --profile`
+"""
+import contextlib
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Set while tracing, to where processes other than the traced one write their spans
+ENV = 'TOASTER_TRACE'
+
+_enabled = bool(os.environ.get(ENV))
+_pid = None
+_start = None
+_events = []
+_lock = threading.Lock()
+_null = contextlib.nullcontext()
+
+
+def enable():
+    """Start recording spans in this process and the worker processes it starts"""
+    global _enabled, _pid, _start
+
+    _enabled = True
+    _pid = os.getpid()
+    _start = time.perf_counter_ns()
+    os.environ[ENV] = tempfile.mkdtemp(prefix='toaster-trace-')
+
+
+def _record(event):
+    if os.getpid() == _pid:
+        with _lock:
+            _events.append(event)
+        return
+
+    # Worker processes don't always get to run exit handlers, so their spans are written right away
+    with open(os.path.join(os.environ[ENV], f'{os.getpid()}.jsonl'), 'a') as f:
+        f.write(json.dumps(event) + '\n')
+
+
+@contextlib.contextmanager
+def _span(name, args):
+    start = time.perf_counter_ns()
+
+    try:
+        yield
+    finally:
+        _record({
+            'name': name,
+            'ts': start // 1000,
+            'dur': (time.perf_counter_ns() - start) // 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {k: str(v) for k, v in args.items()},
+        })
+
+
+def span(name, **args):
+    """Time a block of code as `name`, costs next to nothing while tracing is off"""
+    if not _enabled:
+        return _null
+
+    return _span(name, args)
+
+
+def traced(name=None):
+    """Time every call of a function"""
+    def decorator(f):
+        span_name = name or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return f(*args, **kwargs)
+
+            with _span(span_name, {}):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def events():
+    """Get every span recorded so far, including those of worker processes"""
+    with _lock:
+        collected = list(_events)
+
+    trace_dir = os.environ.get(ENV)
+
+    if trace_dir and os.path.isdir(trace_dir):
+        for filename in os.listdir(trace_dir):
+            with open(os.path.join(trace_dir, filename)) as f:
+                collected.extend(json.loads(line) for line in f if line.strip())
+
+    return sorted(collected, key=lambda e: e['ts'])
+
+
+def summary(collected):
+    """Get (name, count, total, max) in seconds for each kind of span, slowest first"""
+    totals = {}
+
+    for e in collected:
+        count, total, longest = totals.get(e['name'], (0, 0, 0))
+        totals[e['name']] = (count + 1, total + e['dur'], max(longest, e['dur']))
+
+    return sorted(((name, count, total / 1e6, longest / 1e6) for name, (count, total, longest) in totals.items()),
+                  key=lambda s: s[2], reverse=True)
+
+
+def wall_time():
+    """Seconds since tracing was enabled"""
+    return (time.perf_counter_ns() - _start) / 1e9
+
+
+def write_chrome_trace(collected, loc):
+    """Write spans as a Chrome trace, which chrome://tracing and Perfetto can open"""
+    with open(loc, 'w') as f:
+        json.dump({
+            'traceEvents': [{**e, 'ph': 'X', 'cat': 'toaster'} for e in collected],
+            'displayTimeUnit': 'ms',
+        }, f)
+
+
+def finish():
+    """Stop tracing and clean up after worker processes"""
+    global _enabled
+
+    _enabled = False
+    trace_dir = os.environ.pop(ENV, None)
+
+    if trace_dir:
+        shutil.rmtree(trace_dir, ignore_errors=True)
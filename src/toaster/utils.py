@@ -1,16 +1,12 @@
+import functools
 import hashlib
 import os
 import platform
-import shutil
 from pathlib import Path
 
-import requests
 from click import echo
 from click import secho
 from exceptions import NotFound
-from git import RemoteProgress
-from git import Repo
-from tqdm.auto import tqdm
 
 
 def where_is_toaster():
@@ -23,30 +19,22 @@ def errecho(err, **kwargs):
     secho(err, fg='bright_red', **kwargs)
 
 
-def download_file(url, loc):
-    """Download a file"""
-    with requests.get(url, stream=True) as r:
-        total_length = int(r.headers.get("Content-Length"))
-
-        with tqdm.wrapattr(r.raw, "read", total=total_length, desc="") as raw:
-            with open(loc, 'wb') as output:
-                shutil.copyfileobj(raw, output)
-
-
-def verify_file(file, hash):
-    """Verifies files using an sha256 hash."""
+def hash_file(file):
+    """Returns the sha256 hash of a file"""
     with open(file, "rb") as f:
         file_hash = hashlib.sha256()
-        chunk = f.read(4096)
+        chunk = f.read(65536)
 
         while chunk:
             file_hash.update(chunk)
-            chunk = f.read(4096)
+            chunk = f.read(65536)
+
+    return file_hash.hexdigest()
 
-    if file_hash.hexdigest() == hash:
-        return True
 
-    return False
+def verify_file(file, hash):
+    """Verifies files using an sha256 hash."""
+    return hash_file(file) == hash
 
 
 def _get_val_for_sys(d, item, system):
@@ -63,8 +51,16 @@ def _get_val_for_sys(d, item, system):
             return i[item]
 
 
+@functools.lru_cache(maxsize=None)
+def current_platform():
+    """Returns the (system, machine) tuple of this computer, platform looks these up again every call"""
+    return (platform.system(), platform.machine())
+
+
 def dependingonsys(d, item, append_mode=False):
     """Get platform-specific values from a dict"""
+    system, machine = current_platform()
+
     if append_mode:
         res = []
     else:
@@ -76,7 +72,7 @@ def dependingonsys(d, item, append_mode=False):
         else:
             res = d[item]
 
-    if platform.system() != 'Darwin':
+    if system != 'Darwin':
         if 'linux_any' in d:
             ans = _get_val_for_sys(d, item, 'linux_any')
 
@@ -86,7 +82,7 @@ def dependingonsys(d, item, append_mode=False):
                 else:
                     res = ans
 
-        if not (platform.machine().startswith('arm') or platform.machine().startswith('aarch')):
+        if not (machine.startswith('arm') or machine.startswith('aarch')):
             if 'linux_x86_64' in d:
                 ans = _get_val_for_sys(d, item, 'linux_x86_64')
 
@@ -95,7 +91,7 @@ def dependingonsys(d, item, append_mode=False):
                         res += ans
                     else:
                         res = ans
-    elif platform.system() == 'Darwin':
+    elif system == 'Darwin':
         if 'universal' in d:
             ans = _get_val_for_sys(d, item, 'universal')
 
@@ -105,7 +101,7 @@ def dependingonsys(d, item, append_mode=False):
                 else:
                     res = ans
 
-        if platform.machine() == 'arm64':
+        if machine == 'arm64':
             if 'arm64' in d:
                 ans = _get_val_for_sys(d, item, 'arm64')
 
@@ -128,6 +124,8 @@ def dependingonsys(d, item, append_mode=False):
 
 
 def update_toaster():
+    from git import Repo
+
     toaster_src_dir = os.path.join(where_is_toaster(), 'toaster')
 
     if not os.path.exists(toaster_src_dir):
@@ -135,16 +133,3 @@ def update_toaster():
 
     repo = Repo(toaster_src_dir)
     repo.remotes.origin.pull()
-
-
-class CloneProgress(RemoteProgress):
-    """Progress bar for git cloning"""
-
-    def __init__(self, package, url):
-        super().__init__()
-        self.pbar = tqdm(desc=f'Cloning {url}...')
-
-    def update(self, op_code, cur_count, max_count=None, message=''):
-        self.pbar.total = max_count
-        self.pbar.n = cur_count
-        self.pbar.refresh()
@@ -0,0 +1,15 @@
+"""
+toaster's modules find their home and config when they are imported, so every test run gets a fresh home
+"""
+import os
+import sys
+import tempfile
+
+HOME = tempfile.mkdtemp(prefix='toaster-tests-')
+os.environ['HOME'] = HOME
+
+# Like installer.sh
+for d in ['.cache', 'apps', 'bakery', 'binaries', 'bin', 'packages', 'package_data', 'etc']:
+    os.makedirs(os.path.join(HOME, '.toaster', d))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'toaster'))
@@ -0,0 +1,93 @@
+import os
+import subprocess
+import sys
+import threading
+
+import artifacts
+import pytest
+
+TOASTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'toaster')
+
+
+@pytest.fixture(autouse=True)
+def empty_store():
+    artifacts.gc(0)
+
+
+def stored(tmp_path, url):
+    file = tmp_path / 'download'
+    file.write_bytes(os.urandom(1024))
+
+    return artifacts.add(str(file), url)
+
+
+def test_gc_skips_artifacts_pinned_by_another_process(tmp_path):
+    loc = stored(tmp_path, 'https://example.com/pinned.tar.gz')
+
+    other = subprocess.Popen([sys.executable, '-c', f'''
+import sys
+sys.path.insert(0, {TOASTER!r})
+import artifacts
+with artifacts.pinned():
+    print(artifacts.lookup('https://example.com/pinned.tar.gz'), flush=True)
+    sys.stdin.readline()
+'''], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    assert other.stdout.readline().strip() == loc
+    assert artifacts.gc(0) == (0, 0)
+    assert os.path.exists(loc)
+
+    other.communicate('\n')
+
+    assert artifacts.gc(0) == (1, 1024)
+    assert not os.path.exists(loc)
+
+
+def test_pins_end_with_their_block(tmp_path):
+    url = 'https://example.com/used.tar.gz'
+
+    with artifacts.pinned():
+        loc = stored(tmp_path, url)
+
+        # Not even this process evicts what it is using
+        assert artifacts.lookup(url) == loc
+        assert artifacts.gc(0) == (0, 0)
+
+    assert artifacts.gc(0) == (1, 1024)
+    assert artifacts.lookup(url) is None
+
+
+def test_other_threads_pins_are_kept(tmp_path):
+    loc = stored(tmp_path, 'https://example.com/thread.tar.gz')
+    pinned = threading.Event()
+    done = threading.Event()
+
+    def use():
+        with artifacts.pinned():
+            artifacts.lookup('https://example.com/thread.tar.gz')
+            pinned.set()
+            done.wait()
+
+    thread = threading.Thread(target=use)
+    thread.start()
+    pinned.wait()
+
+    assert artifacts.gc(0) == (0, 0)
+
+    done.set()
+    thread.join()
+
+    assert artifacts.gc(0) == (1, 1024)
+    assert not os.path.exists(loc)
+
+
+def test_gc_forgets_validators_of_deleted_artifacts(tmp_path):
+    url = 'https://example.com/validated.tar.gz'
+    stored(tmp_path, url)
+    artifacts._set_validators(url, {'etag': '"v1"'})
+
+    assert artifacts._get_validators(url) == {'etag': '"v1"', 'last_modified': None}
+
+    artifacts.gc(0)
+
+    assert artifacts._get_validators(url) is None
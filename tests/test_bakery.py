@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+import subprocess
+
+import bakery
+import catalog
+import pytest
+
+
+def git(cwd, *args):
+    subprocess.run(['git', '-c', 'user.name=t', '-c', 'user.email=t@t', *args], cwd=cwd,
+                   check=True, capture_output=True)
+
+
+def publish(origin, package, version, desc):
+    (origin / package).mkdir(exist_ok=True)
+    (origin / package / f'{package}.toml').write_text(
+        f'name = "{package}"\ndesc = "{desc}"\nversion = "{version}"\ntypes = ["binary"]\n'
+        f'[binary]\ntype = "zip"\nurl = "https://example.com/{package}.zip"\n')
+
+
+@pytest.fixture
+def origin(tmp_path):
+    """A bakery's repo with the packages `kept`, `changed` and `removed`, added as `local`"""
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git(origin, 'init', '-q', '-b', 'master')
+    (origin / '_toaster.toml').write_text('name = "local"\nmaintainer = "t"\ndescription = "Test bakery"\n')
+
+    for package in ('kept', 'changed', 'removed'):
+        publish(origin, package, '1.0', f'The {package} package')
+
+    git(origin, 'add', '.')
+    git(origin, 'commit', '-q', '-m', 'first')
+
+    with open(os.path.join(bakery.toaster_loc, 'bakery.json'), 'w') as f:
+        json.dump({}, f)
+
+    bakery.add_bakery('local', str(origin))
+
+    yield origin
+
+    catalog.remove_bakery('local')
+    shutil.rmtree(os.path.join(bakery.toaster_loc, 'bakery', 'local'))
+    os.remove(os.path.join(bakery.toaster_loc, 'bakery.json'))
+
+
+def test_refreshes_only_rescan_what_changed(origin, monkeypatch):
+    bakery.refresh_bakeries(jobs=1)
+
+    assert bakery.get_all_packages() == {'local': ['changed', 'kept', 'removed']}
+
+    publish(origin, 'changed', '2.0', 'The package that changed')
+    publish(origin, 'added', '1.0', 'The added package')
+    git(origin, 'rm', '-q', '-r', 'removed')
+    git(origin, 'add', '.')
+    git(origin, 'commit', '-q', '-m', 'second')
+
+    scanned = []
+    scan_package = bakery._scan_package
+    monkeypatch.setattr(bakery, '_scan_package', lambda repo_dir, package: scanned.append(package) or
+                        scan_package(repo_dir, package))
+
+    bakery.refresh_bakeries(jobs=1)
+
+    assert sorted(scanned) == ['added', 'changed']
+    assert bakery.get_all_packages() == {'local': ['added', 'changed', 'kept']}
+    assert catalog.find_package('changed')['version'] == '2.0'
+    assert catalog.find_spec('changed', 'local').version == '2.0'
+    assert catalog.find_package('removed') is None
+    assert catalog.find_package('kept')['version'] == '1.0'
+
+    # The search index follows along
+    assert catalog.search_packages('removed', fuzzy=False)[0] == 0
+    assert [p['name'] for p in catalog.search_packages('added')[1]] == ['added']
+    assert [p['name'] for p in catalog.search_packages('changed')[1]] == ['changed']
@@ -0,0 +1,85 @@
+import os
+
+import bottles
+import pytest
+import spec
+
+TOML = {'name': 'pp', 'version': '1.0', 'types': ['build'],
+        'build': {'repo': 'https://example.com/pp.git', 'scripts': [['make']]}}
+
+
+@pytest.fixture(autouse=True)
+def bottles_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(bottles, 'bottles_dir', str(tmp_path / 'bottles'))
+
+
+def build(package_dir, data=b'built\n'):
+    os.makedirs(os.path.join(package_dir, 'bin'))
+
+    with open(os.path.join(package_dir, 'bin', 'pp'), 'wb') as f:
+        f.write(data)
+
+    os.symlink('pp', os.path.join(package_dir, 'bin', 'alias'))
+
+    return package_dir
+
+
+def test_keys_depend_on_the_prefix_builds_are_made_in():
+    package_spec = spec.resolve(TOML)
+    key = bottles.key(package_spec, 'abc', '/home/.toaster/packages/pp')
+
+    assert key == bottles.key(package_spec, 'abc', '/home/.toaster/packages/pp')
+    assert key != bottles.key(package_spec, 'def', '/home/.toaster/packages/pp')
+    # An update's build points into its generation, so it can't be poured anywhere else
+    assert key != bottles.key(package_spec, 'abc', '/home/.toaster/packages/.versions/pp/2')
+
+
+def test_bottles_are_poured_as_they_were_packed(tmp_path):
+    package_spec = spec.resolve(TOML)
+    bottle = bottles.key(package_spec, 'abc', str(tmp_path / 'pp'))
+    bottles.pack(bottle, build(str(tmp_path / 'pp')), package_spec, 'abc')
+
+    assert bottles.list_bottles()[bottle]['prefix'] == str(tmp_path / 'pp')
+    assert bottles.pour(bottle, str(tmp_path / 'poured'))
+    assert (tmp_path / 'poured' / 'bin' / 'pp').read_bytes() == b'built\n'
+    assert os.readlink(tmp_path / 'poured' / 'bin' / 'alias') == 'pp'
+
+    assert not bottles.pour(None, str(tmp_path / 'unbottled'))
+    assert not bottles.pour('0' * 64, str(tmp_path / 'unbottled'))
+    assert not os.path.exists(tmp_path / 'unbottled')
+
+
+def test_builds_with_links_out_of_them_are_not_packed(tmp_path):
+    package_spec = spec.resolve(TOML)
+    package_dir = build(str(tmp_path / 'pp'))
+    os.symlink('/etc/passwd', os.path.join(package_dir, 'bin', 'passwd'))
+
+    bottles.pack('a' * 64, package_dir, package_spec, 'abc')
+
+    assert not bottles.list_bottles()
+
+
+def test_broken_bottles_are_deleted_instead_of_poured(tmp_path):
+    package_spec = spec.resolve(TOML)
+    bottles.pack('a' * 64, build(str(tmp_path / 'pp')), package_spec, 'abc')
+
+    with open(bottles.bottle_loc('a' * 64), 'r+b') as f:
+        f.truncate(100)
+
+    assert not bottles.pour('a' * 64, str(tmp_path / 'poured'))
+    assert not os.path.exists(tmp_path / 'poured')
+    assert not bottles.list_bottles()
+
+
+def test_gc_deletes_the_least_recently_poured_bottles(tmp_path):
+    package_spec = spec.resolve(TOML)
+
+    for n, bottle in enumerate(['a' * 64, 'b' * 64, 'c' * 64]):
+        bottles.pack(bottle, build(str(tmp_path / bottle), os.urandom(4096)), package_spec, 'abc')
+        os.utime(bottles.bottle_loc(bottle), (n, n))
+
+    bottles.pour('a' * 64, str(tmp_path / 'poured'))
+    sizes = bottles.usage()
+
+    assert bottles.gc(sizes['a' * 64] + sizes['c' * 64]) == sizes['b' * 64]
+    assert sorted(bottles.list_bottles()) == ['a' * 64, 'c' * 64]
@@ -0,0 +1,61 @@
+import json
+import os
+import pickle
+import shutil
+
+import catalog
+import pytest
+
+
+@pytest.fixture
+def upgraded(monkeypatch):
+    """A home from before the catalog, with a cloned bakery listed in bakery.json"""
+    repo_dir = os.path.join(catalog.toaster_loc, 'bakery', 'old')
+    os.makedirs(os.path.join(repo_dir, 'hello'))
+    os.makedirs(os.path.join(repo_dir, '.git'))
+
+    with open(os.path.join(repo_dir, 'hello', 'hello.toml'), 'w') as f:
+        f.write('name = "hello"\ndesc = "Says hello"\nversion = "1.0"\ntypes = ["binary"]\n'
+                '[binary]\ntype = "zip"\nurl = "https://example.com/hello.zip"\n')
+
+    with open(os.path.join(catalog.toaster_loc, 'bakery.json'), 'w') as f:
+        json.dump({'old': {'repo': 'https://example.com/old.git', 'packages': ['hello']}}, f)
+
+    monkeypatch.setattr(catalog, '_clones_checked', False)
+    monkeypatch.setattr(catalog, '_memory', None)
+
+    yield
+
+    catalog.remove_bakery('old')
+    shutil.rmtree(os.path.join(catalog.toaster_loc, 'bakery'))
+    os.remove(os.path.join(catalog.toaster_loc, 'bakery.json'))
+
+
+def test_cloned_bakeries_are_found_before_a_refresh(upgraded):
+    package = catalog.find_package('hello')
+
+    assert package['bakery'] == 'old'
+    assert package['version'] == '1.0'
+    assert catalog.find_spec('hello', 'old').kind == 'binary'
+    assert catalog.search_packages('says')[:1] == (1,)
+
+
+def test_clones_are_only_looked_for_once(upgraded, monkeypatch):
+    catalog.all_packages()
+    monkeypatch.setattr(catalog, 'has_bakery', None)
+
+    assert catalog.all_packages() == {'old': ['hello']}
+
+
+def test_specs_of_other_schemas_are_scanned_again(upgraded, monkeypatch):
+    conn = catalog.get_catalog()
+    hello = catalog.find_spec('hello', 'old')
+
+    # Stored by an older toaster
+    with conn:
+        conn.execute('UPDATE specs SET spec = ?', (pickle.dumps(hello),))
+
+    monkeypatch.setattr(catalog, '_clones_checked', False)
+    monkeypatch.setattr(catalog, '_memory', None)
+
+    assert catalog.find_spec('hello', 'old') == hello
@@ -0,0 +1,187 @@
+import json
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import daemon
+import pytest
+
+TOASTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'toaster')
+
+
+@pytest.fixture
+def toasterd(tmp_path):
+    os.makedirs(tmp_path / '.toaster' / 'etc')
+    loc = str(tmp_path / '.toaster' / 'toasterd.sock')
+    process = subprocess.Popen([sys.executable, os.path.join(TOASTER, 'daemon.py')],
+                               env={**os.environ, 'HOME': str(tmp_path)}, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+
+    while not os.path.exists(loc):
+        assert time.monotonic() < deadline and process.poll() is None
+        time.sleep(0.05)
+
+    yield loc
+
+    process.kill()
+    process.wait()
+
+
+def connect(loc):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(loc)
+    sock.settimeout(10)
+
+    return sock
+
+
+def test_slow_request_does_not_block_others(toasterd):
+    slow = connect(toasterd)
+    slow.sendall(b'{"control"')
+
+    with connect(toasterd) as sock:
+        start = time.monotonic()
+        sock.sendall(b'{"control": "status"}\n')
+        reply = json.loads(sock.makefile().readline())
+
+    assert reply['pid'] and time.monotonic() - start < 1
+    slow.close()
+
+
+def test_command_output_reaches_cli(toasterd):
+    with connect(toasterd) as sock:
+        sock.sendall(json.dumps({'args': ['--help'], 'cwd': '/', 'env': dict(os.environ),
+                                 'color': False}).encode() + b'\n')
+        output = b''
+
+        while True:
+            kind, size = daemon._HEADER.unpack(daemon._recv_exactly(sock, daemon._HEADER.size))
+            data = daemon._recv_exactly(sock, size)
+
+            if kind == daemon.EXIT:
+                break
+
+            output += data
+
+    assert int(data) == 0
+    assert b'Usage: toaster' in output
+
+
+class _Server:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.clients = set()
+
+    def hang_up(self, client):
+        pass
+
+
+def test_client_output_waits_instead_of_blocking():
+    server = _Server()
+    ours, theirs = socket.socketpair()
+    client = daemon._Client(server, ours)
+    client.inbox = None
+    data = os.urandom(8 * 1024 * 1024)
+
+    start = time.monotonic()
+    client.write(data)
+    client.finish()
+
+    # Far more than a socket buffer holds, the rest waits for the selector
+    assert time.monotonic() - start < 1
+    assert client.outbox and not client.closed
+
+    received = b''
+    theirs.setblocking(False)
+
+    while not client.closed:
+        for key, events in server.selector.select(timeout=1):
+            key.data.ready(events)
+
+        try:
+            received += theirs.recv(1024 * 1024)
+        except BlockingIOError:
+            pass
+
+    theirs.setblocking(True)
+
+    while chunk := theirs.recv(1024 * 1024):
+        received += chunk
+
+    theirs.close()
+
+    assert received == data
+    assert not server.clients and not server.selector.get_map()
+
+
+@pytest.mark.parametrize('args, command', [
+    (['install', 'x'], 'install'),
+    (['--profile', 'install', 'x'], 'install'),
+    (['--profile-output', 'install.json', 'remove', 'x'], 'remove'),
+    (['--profile-output=install.json', '--profile', 'update'], 'update'),
+    (['--', 'link', 'x'], 'link'),
+    (['--help'], None),
+])
+def test_commands_are_found_after_toasters_own_options(args, command):
+    assert daemon._command(args) == command
+
+
+def serve_until(server, done):
+    deadline = time.monotonic() + 10
+
+    while not done():
+        assert time.monotonic() < deadline
+
+        for key, events in server.selector.select(timeout=0.1):
+            key.data.ready(events)
+
+
+def test_commands_nobody_waits_for_are_interrupted(monkeypatch):
+    server = daemon.Server()
+    running = subprocess.Popen(['sleep', '30'], start_new_session=True)
+    jobs = {}
+
+    # Like Server.handle, without forking
+    def handle(client, request):
+        key = tuple(request['args'])
+
+        if key in jobs:
+            jobs[key].attach(client)
+            return
+
+        jobs[key] = daemon._Job(request, client, queued=True)
+
+        if server.running:
+            server.queue.append(jobs[key])
+        else:
+            jobs[key].pid = running.pid
+            server.running[running.pid] = jobs[key]
+
+    monkeypatch.setattr(server, 'handle', handle)
+    clis = []
+
+    for args in (['install', 'x'], ['install', 'x'], ['remove', 'y']):
+        ours, theirs = socket.socketpair()
+        daemon._Client(server, ours)
+        theirs.sendall(json.dumps({'args': args}).encode() + b'\n')
+        clis.append(theirs)
+
+    serve_until(server, lambda: sum(len(job.clients) for job in jobs.values()) == 3)
+
+    # Like pressing Ctrl-C in every CLI, the command keeps running while any CLI still waits for it
+    clis[0].close()
+    serve_until(server, lambda: len(server.clients) == 2)
+
+    assert running.poll() is None
+
+    for theirs in clis[1:]:
+        theirs.close()
+
+    serve_until(server, lambda: not server.clients)
+
+    assert running.wait(timeout=10) == -signal.SIGINT
+    assert not server.queue
@@ -0,0 +1,240 @@
+import http.server
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import config
+import downloads
+import pytest
+import requests
+
+TOASTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'toaster')
+
+DATA = os.urandom(1024 * 1024)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA with ranges and an ETag, like a CDN would"""
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length, extra=()):
+        self.send_response(status)
+        self.send_header('ETag', '"data"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(length))
+
+        for name, value in extra:
+            self.send_header(name, value)
+
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(DATA))
+
+    def do_GET(self):
+        server = self.server
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+
+        if not match:
+            server.ranges.append(None)
+            self._headers(200, len(DATA))
+            self._send(DATA)
+            return
+
+        start = int(match[1])
+        end = int(match[2]) if match[2] else len(DATA) - 1
+        server.ranges.append((start, end))
+
+        if start >= len(DATA):
+            self._headers(416, 0, [('Content-Range', f'bytes */{len(DATA)}')])
+            return
+
+        end = min(end, len(DATA) - 1)
+        self._headers(206, end + 1 - start, [('Content-Range', f'bytes {start}-{end}/{len(DATA)}')])
+        self._send(DATA[start:end + 1])
+
+    def _send(self, data):
+        server = self.server
+
+        with server.lock:
+            fail = server.fail > 0
+            server.fail -= 1
+
+        # Drop the connection half way through, like a network failure
+        if fail:
+            data = data[:len(data) // 2]
+
+        for i in range(0, len(data), 16 * 1024):
+            self.wfile.write(data[i:i + 16 * 1024])
+            self.wfile.flush()
+
+            if server.slow:
+                time.sleep(0.02)
+
+        if fail:
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+
+@pytest.fixture
+def server(tmp_path):
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.ranges = []
+    httpd.fail = 0
+    httpd.slow = False
+    httpd.lock = threading.Lock()
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(config, '_config', {
+        'download_segments': 4, 'download_segment_min_size': 64 * 1024})
+    monkeypatch.setattr(downloads, 'CHUNK_SIZE', 16 * 1024)
+
+
+def url(server):
+    return f'http://127.0.0.1:{server.server_port}/file'
+
+
+def test_segmented_download(server, tmp_path):
+    loc = tmp_path / 'file'
+    validators = downloads.download_file(url(server), str(loc))
+
+    assert loc.read_bytes() == DATA
+    assert validators['etag'] == '"data"'
+    assert len(server.ranges) == 4
+    assert not os.path.exists(f'{loc}.part.json')
+
+
+def test_segmented_download_resumes(server, tmp_path):
+    loc = tmp_path / 'file'
+    server.fail = 4
+
+    with pytest.raises(requests.RequestException):
+        downloads.download_file(url(server), str(loc))
+
+    with open(f'{loc}.part.json') as f:
+        saved = json.load(f)['segments']
+
+    assert any(s['done'] for s in saved)
+
+    server.ranges.clear()
+    downloads.download_file(url(server), str(loc))
+
+    assert loc.read_bytes() == DATA
+    # Only what was missing was downloaded again
+    assert sorted(server.ranges) == sorted((s['start'] + s['done'], s['end'])
+                                           for s in saved if s['start'] + s['done'] <= s['end'])
+
+
+def test_single_stream_resumes(server, tmp_path):
+    loc = tmp_path / 'file'
+    server.fail = 1
+
+    with pytest.raises(requests.RequestException):
+        downloads.download_file(url(server), str(loc), segments=1)
+
+    partial = os.path.getsize(f'{loc}.part')
+    assert 0 < partial < len(DATA)
+
+    server.ranges.clear()
+    downloads.download_file(url(server), str(loc), segments=1)
+
+    assert loc.read_bytes() == DATA
+    assert server.ranges == [(partial, len(DATA) - 1)]
+
+
+def test_single_stream_complete_part_file(server, tmp_path):
+    """A part file which already has everything gets a 416 when resumed"""
+    loc = tmp_path / 'file'
+    server.fail = 0
+
+    with open(f'{loc}.part', 'wb') as f:
+        f.write(DATA)
+
+    with open(f'{loc}.part.json', 'w') as f:
+        json.dump({'url': url(server), 'size': len(DATA), 'validator': '"data"'}, f)
+
+    downloads.download_file(url(server), str(loc), segments=1)
+
+    assert loc.read_bytes() == DATA
+    assert server.ranges == [(len(DATA), len(DATA) - 1)]
+
+
+def test_killed_download_resumes_intact(server, tmp_path):
+    loc = tmp_path / 'file'
+    server.slow = True
+
+    worker = subprocess.Popen([sys.executable, '-c', f'''
+import sys
+sys.path.insert(0, {TOASTER!r})
+import config, downloads
+config._config = {{'download_segments': 4, 'download_segment_min_size': 64 * 1024}}
+downloads.CHUNK_SIZE = 16 * 1024
+downloads.STATE_SAVE_INTERVAL = 0
+downloads.download_file({url(server)!r}, {str(loc)!r})
+'''], stderr=subprocess.DEVNULL)
+
+    state_loc = f'{loc}.part.json'
+    deadline = time.monotonic() + 30
+
+    # Kill it once some of every segment was saved, but not all of it
+    while time.monotonic() < deadline:
+        try:
+            with open(state_loc) as f:
+                done = [s['done'] for s in json.load(f)['segments']]
+        except (OSError, ValueError, KeyError):
+            done = []
+
+        if done and all(done) and sum(done) < len(DATA) // 2:
+            break
+
+        time.sleep(0.01)
+
+    worker.send_signal(signal.SIGKILL)
+    worker.wait()
+
+    assert not loc.exists()
+
+    server.slow = False
+    downloads.download_file(url(server), str(loc))
+
+    assert loc.read_bytes() == DATA
+
+
+def test_single_stream_restarts_a_part_file_too_big(server, tmp_path, monkeypatch):
+    """A part file bigger than the file gets a 416, and is downloaded again from the start"""
+    loc = tmp_path / 'file'
+    bars = []
+
+    class Bar(downloads.tqdm):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            bars.append(self)
+
+    monkeypatch.setattr(downloads, 'tqdm', Bar)
+
+    with open(f'{loc}.part', 'wb') as f:
+        f.write(DATA + b'stale')
+
+    with open(f'{loc}.part.json', 'w') as f:
+        json.dump({'url': url(server), 'size': len(DATA), 'validator': '"data"'}, f)
+
+    downloads.download_file(url(server), str(loc), segments=1)
+
+    assert loc.read_bytes() == DATA
+    assert server.ranges == [(len(DATA) + 5, len(DATA) - 1), None]
+    assert bars[0].n == len(DATA)
@@ -0,0 +1,146 @@
+import io
+import os
+import tarfile
+
+import pytest
+from extract import extract_tar
+from extract import UnsafeArchive
+
+
+def make_tar(loc, members):
+    """Write a tar whose members are (name, kind, data or link name), all under a top level directory"""
+    with tarfile.open(loc, 'w') as tar:
+        for name, kind, value in members:
+            info = tarfile.TarInfo(f'top/{name}')
+
+            if kind == 'file':
+                info.size = len(value)
+                tar.addfile(info, io.BytesIO(value))
+                continue
+
+            info.type = {'dir': tarfile.DIRTYPE, 'symlink': tarfile.SYMTYPE, 'hardlink': tarfile.LNKTYPE}[kind]
+            info.linkname = f'top/{value}' if kind == 'hardlink' else value or ''
+            info.mode = 0o755
+            tar.addfile(info)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    dest = tmp_path / 'dest'
+    victim = tmp_path / 'victim'
+    victim.write_bytes(b'original')
+
+    return tmp_path, dest, victim
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_extracts_files_links_and_hardlinks(tmp_path, jobs):
+    archive = tmp_path / 'ok.tar'
+    make_tar(archive, [
+        ('bin', 'dir', None),
+        ('bin/tool', 'file', b'tool'),
+        ('bin/alias', 'symlink', 'tool'),
+        ('bin/copy', 'hardlink', 'bin/tool'),
+        ('lib', 'symlink', 'bin'),
+    ])
+
+    extract_tar(str(tmp_path / 'dest'), str(archive), jobs=jobs)
+
+    assert (tmp_path / 'dest/bin/tool').read_bytes() == b'tool'
+    assert os.readlink(tmp_path / 'dest/bin/alias') == 'tool'
+    assert os.path.samefile(tmp_path / 'dest/bin/copy', tmp_path / 'dest/bin/tool')
+    assert (tmp_path / 'dest/lib/tool').read_bytes() == b'tool'
+
+
+def test_symlink_through_earlier_symlink(dirs):
+    tmp_path, dest, victim = dirs
+    archive = tmp_path / 'evil.tar'
+    # a/b is written as dest/b, where `..` leads outside of dest
+    make_tar(archive, [
+        ('a', 'symlink', '.'),
+        ('a/b', 'symlink', '..'),
+        ('h', 'hardlink', 'b/victim'),
+        ('h', 'file', b'attacker'),
+    ])
+
+    with pytest.raises(UnsafeArchive):
+        extract_tar(str(dest), str(archive), jobs=1)
+
+    assert victim.read_bytes() == b'original'
+    assert not os.path.lexists(dest / 'b')
+
+
+def test_hardlink_through_symlinked_directory(dirs):
+    tmp_path, dest, victim = dirs
+    (tmp_path / 'outside').mkdir()
+    (tmp_path / 'outside/victim').write_bytes(b'original')
+    archive = tmp_path / 'evil.tar'
+    make_tar(archive, [
+        ('up', 'symlink', 'sub/../..'),
+        ('h', 'hardlink', 'up/victim'),
+        ('h', 'file', b'attacker'),
+    ])
+
+    with pytest.raises(UnsafeArchive):
+        extract_tar(str(dest), str(archive), jobs=1)
+
+    assert victim.read_bytes() == b'original'
+
+
+def test_file_replacing_hardlink_is_not_written_through(tmp_path):
+    archive = tmp_path / 'twice.tar'
+    make_tar(archive, [
+        ('first', 'file', b'first'),
+        ('second', 'hardlink', 'first'),
+        ('second', 'file', b'second'),
+    ])
+
+    extract_tar(str(tmp_path / 'dest'), str(archive), jobs=1)
+
+    assert (tmp_path / 'dest/first').read_bytes() == b'first'
+    assert (tmp_path / 'dest/second').read_bytes() == b'second'
+
+
+def test_file_replacing_symlink_is_not_written_through(dirs):
+    tmp_path, dest, victim = dirs
+    dest.mkdir()
+    os.symlink(victim, dest / 'f')
+    archive = tmp_path / 'over.tar'
+    make_tar(archive, [('f', 'file', b'attacker')])
+
+    extract_tar(str(dest), str(archive), jobs=1)
+
+    assert victim.read_bytes() == b'original'
+    assert (dest / 'f').read_bytes() == b'attacker'
+
+
+def test_symlink_filled_in_later_is_caught(dirs):
+    tmp_path, dest, victim = dirs
+    archive = tmp_path / 'late.tar'
+    # p resolves inside while q doesn't exist, and outside once q does
+    make_tar(archive, [
+        ('p', 'symlink', 'q/..'),
+        ('q', 'symlink', '.'),
+    ])
+
+    with pytest.raises(UnsafeArchive):
+        extract_tar(str(dest), str(archive), jobs=1)
+
+    assert not os.path.lexists(dest / 'p')
+
+
+@pytest.mark.parametrize('name, kind, value', [
+    ('../escape', 'file', b'x'),
+    ('abs', 'symlink', '/etc/passwd'),
+    ('up', 'symlink', '../..'),
+    ('h', 'hardlink', '../victim'),
+])
+def test_rejects_members_outside(dirs, name, kind, value):
+    tmp_path, dest, victim = dirs
+    archive = tmp_path / 'evil.tar'
+    make_tar(archive, [(name, kind, value)])
+
+    with pytest.raises(UnsafeArchive):
+        extract_tar(str(dest), str(archive), jobs=1)
+
+    assert victim.read_bytes() == b'original'
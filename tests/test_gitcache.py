@@ -0,0 +1,32 @@
+import subprocess
+
+import gitcache
+
+
+def git(cwd, *args):
+    return subprocess.run(['git', '-c', 'user.name=t', '-c', 'user.email=t@t', *args], cwd=cwd,
+                          check=True, capture_output=True, text=True).stdout
+
+
+def test_checkout_survives_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(gitcache, 'mirrors_dir', str(tmp_path / 'mirrors'))
+
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git(origin, 'init', '-q', '-b', 'master')
+    (origin / 'README').write_text('hello\n')
+    git(origin, 'add', 'README')
+    git(origin, 'commit', '-q', '-m', 'first')
+
+    repo_dir = tmp_path / 'work'
+    gitcache.checkout('pkg', str(origin), str(repo_dir))
+
+    assert not (repo_dir / '.git' / 'objects' / 'info' / 'alternates').exists()
+
+    # Another worker's checkout evicting every mirror, including the one this came from
+    gitcache.evict(max_bytes=0)
+    assert not gitcache.usage()
+
+    assert git(repo_dir, 'log', '--format=%s') == 'first\n'
+    git(repo_dir, 'fsck', '--no-progress')
+    assert (repo_dir / 'README').read_text() == 'hello\n'
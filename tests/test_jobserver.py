@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+import jobserver
+
+# Takes every token it can from the jobserver in MAKEFLAGS like make would, and gives them back
+TAKE_TOKENS = '''
+import os
+auth = os.environ['MAKEFLAGS'].split('--jobserver-auth=')[1]
+r, w = map(int, auth.split(','))
+os.set_blocking(r, False)
+tokens = b''
+try:
+    while True:
+        tokens += os.read(r, 1)
+except BlockingIOError:
+    pass
+os.write(w, tokens)
+print(len(tokens))
+'''
+
+
+def free_tokens():
+    r, w = jobserver._open(os.environ[jobserver.ENV].split(':', 1)[1])
+    os.set_blocking(r, False)
+    tokens = b''
+
+    try:
+        while True:
+            tokens += os.read(r, 1)
+    except BlockingIOError:
+        pass
+    finally:
+        os.set_blocking(r, True)
+
+    os.write(w, tokens)
+
+    return len(tokens)
+
+
+def test_builds_share_the_jobservers_tokens():
+    with jobserver.running(3):
+        fifo = os.environ[jobserver.ENV].split(':', 1)[1]
+
+        assert free_tokens() == 3
+
+        with jobserver.slot() as (jobs, env, fds):
+            r, w = fds
+
+            assert jobs == 3
+            assert env['MAKEFLAGS'] == f'-j3 --jobserver-auth={r},{w}'
+            # The slot is the build's implicit job, make can take the other two
+            assert subprocess.run([sys.executable, '-c', TAKE_TOKENS], env={**os.environ, **env},
+                                  pass_fds=fds, capture_output=True, text=True).stdout == '2\n'
+
+            with jobserver.slot():
+                assert free_tokens() == 1
+
+            # Nested blocks share it
+            with jobserver.running(8):
+                assert os.environ[jobserver.ENV] == f'3:{fifo}'
+
+        assert free_tokens() == 3
+
+    assert jobserver.ENV not in os.environ
+    assert not os.path.exists(fifo)
+
+
+def test_builds_without_a_jobserver_use_build_jobs(monkeypatch):
+    monkeypatch.setattr(jobserver, 'get_config', lambda key: 5)
+
+    with jobserver.slot() as (jobs, env, fds):
+        assert (jobs, env, fds) == (5, {'MAKEFLAGS': '-j5'}, ())
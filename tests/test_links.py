@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import installed
+import links
+import pytest
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    """Make packages with executables in bin, on a PATH which has a `taken` command"""
+    path_dir = tmp_path / 'path'
+    path_dir.mkdir()
+    (path_dir / 'taken').write_text('#!/bin/sh\n')
+    (path_dir / 'taken').chmod(0o755)
+    monkeypatch.setenv('PATH', str(path_dir))
+    made = []
+
+    def package(name, *binaries):
+        package_dir = tmp_path / name
+        (package_dir / 'bin').mkdir(parents=True)
+
+        for binary in binaries:
+            (package_dir / 'bin' / binary).write_text('#!/bin/sh\n')
+
+        made.append(name)
+
+        return str(package_dir)
+
+    yield package
+
+    for name in made:
+        links.unlink_package(name)
+
+
+def bin_link(name):
+    return os.path.join(links.bin_dir, name)
+
+
+def test_conflicts_are_not_linked_unless_forced(package):
+    first = package('first', 'shared', 'first')
+    second = package('second', 'shared', 'taken', 'second')
+
+    assert links.link_package('first', first, ['bin']) == []
+    assert sorted(links.link_package('second', second, ['bin'])) == ['shared', 'taken']
+
+    assert os.readlink(bin_link('shared')) == os.path.join(first, 'bin', 'shared')
+    assert not os.path.lexists(bin_link('taken'))
+    assert sorted(installed.get_links('second')) == ['second']
+
+    assert links.link_package('second', second, ['bin'], force=True) == []
+    assert os.readlink(bin_link('shared')) == os.path.join(second, 'bin', 'shared')
+    assert installed.get_links()['shared'][0] == 'second'
+
+    # Linking again finds its own links instead of conflicts
+    assert links.link_package('second', second, ['bin']) == []
+
+
+def test_packages_are_unlinked_by_their_recorded_links(package):
+    first = package('first', 'first')
+    second = package('second', 'second')
+    links.link_package('first', first, ['bin'])
+    links.link_package('second', second, ['bin'])
+
+    # Even once the package's files are gone
+    shutil.rmtree(first)
+    links.unlink_package('first')
+
+    assert not os.path.lexists(bin_link('first'))
+    assert 'first' not in installed.get_links()
+    assert os.path.islink(bin_link('second'))
+
+
+def test_links_made_before_they_were_recorded_are_found_by_target(package):
+    old = package('old', 'old')
+    os.symlink(os.path.join(old, 'bin', 'old'), bin_link('old'))
+
+    links.unlink_package('old', old, ['bin'])
+
+    assert not os.path.lexists(bin_link('old'))
+
+
+def test_prune_removes_links_to_files_which_are_gone(package):
+    updated = package('updated', 'kept', 'dropped')
+    links.link_package('updated', updated, ['bin'])
+    os.remove(os.path.join(updated, 'bin', 'dropped'))
+
+    links.prune('updated')
+
+    assert sorted(installed.get_links('updated')) == ['kept']
+    assert not os.path.lexists(bin_link('dropped'))
+    assert os.path.islink(bin_link('kept'))
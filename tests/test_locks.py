@@ -0,0 +1,87 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import locks
+
+TOASTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'toaster')
+
+
+def run(code):
+    """Start a python process which can import toaster's modules"""
+    return subprocess.Popen([sys.executable, '-c', f'import sys; sys.path.insert(0, {TOASTER!r})\n{code}'],
+                            stdout=subprocess.PIPE, text=True)
+
+
+def test_killed_writer_does_not_break_readers():
+    writer = run("import locks, time\nwith locks.exclusive('killed'):\n    print('locked', flush=True)\n    time.sleep(60)")
+    assert writer.stdout.readline().strip() == 'locked'
+    os.kill(writer.pid, signal.SIGKILL)
+    writer.wait()
+
+    # The dead writer's PID is still in the lock file
+    assert open(locks.lock_loc('killed')).read() == str(writer.pid)
+
+    with locks.shared('killed'):
+        waiter = run("import locks, time\nwith locks.exclusive('killed'):\n    print(time.time(), flush=True)")
+        time.sleep(1)
+        released = time.time()
+
+    # After it said it was waiting for the reader
+    got = float(waiter.communicate()[0].splitlines()[-1])
+
+    assert got >= released
+
+
+def test_threads_share_readers_but_not_with_a_writer():
+    events = []
+    writing = threading.Event()
+
+    def write():
+        with locks.exclusive('threads'):
+            writing.set()
+            events.append('write start')
+            time.sleep(0.3)
+            events.append('write end')
+
+    def read():
+        writing.wait()
+
+        with locks.shared('threads'):
+            events.append('read')
+
+    threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(3)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert events == ['write start', 'write end', 'read', 'read', 'read']
+
+
+def test_readers_run_together_and_nest():
+    inside = []
+    both = threading.Barrier(2, timeout=5)
+
+    def read():
+        with locks.shared('readers'), locks.shared('readers'):
+            inside.append(1)
+            both.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(2)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(inside) == 2
+
+    with locks.exclusive('readers'), locks.shared('readers'), locks.exclusive('readers'):
+        pass
@@ -0,0 +1,83 @@
+import os
+import shutil
+
+import cli
+import installed
+import links
+import manifest
+import pytest
+from click.testing import CliRunner
+
+
+@pytest.fixture
+def package():
+    """A binary package with a file, a script and a link in it, recorded in the manifests"""
+    package_dir = os.path.join(manifest.toaster_loc, 'binaries', 'tool')
+    os.makedirs(os.path.join(package_dir, 'bin'))
+
+    with open(os.path.join(package_dir, 'README'), 'w') as f:
+        f.write('hello\n')
+
+    with open(os.path.join(package_dir, 'bin', 'tool'), 'w') as f:
+        f.write('#!/bin/sh\n')
+
+    os.chmod(os.path.join(package_dir, 'bin', 'tool'), 0o755)
+    os.symlink('tool', os.path.join(package_dir, 'bin', 'tool2'))
+
+    links.link_package('tool', package_dir, ['bin'])
+    manifest.record('tool', package_dir, '1.0')
+
+    yield package_dir
+
+    links.unlink_package('tool')
+    installed.forget_package('tool')
+    shutil.rmtree(package_dir)
+
+
+def test_record_lists_files_and_links(package):
+    row = installed.get_package('tool')
+    files = {f['path']: f for f in installed.get_files('tool')}
+
+    assert (row['kind'], row['location'], row['version']) == ('binary', package, '1.0')
+    assert sorted(files) == ['README', 'bin/tool', 'bin/tool2']
+    assert files['bin/tool']['mode'] == 0o755
+    assert (files['bin/tool2']['type'], files['bin/tool2']['hash']) == ('l', 'tool')
+
+
+def test_verify_finds_every_kind_of_change(package):
+    assert manifest.verify('tool') == []
+
+    with open(os.path.join(package, 'README'), 'w') as f:
+        f.write('howdy\n')
+
+    os.chmod(os.path.join(package, 'bin', 'tool'), 0o700)
+    os.remove(os.path.join(package, 'bin', 'tool2'))
+    os.symlink('../README', os.path.join(package, 'bin', 'tool2'))
+
+    assert sorted(manifest.verify('tool')) == [
+        ('README', 'modified'),
+        ('bin/tool', 'permissions changed'),
+        ('bin/tool2', 'link changed'),
+    ]
+
+    # Same size, so only hashing tells
+    assert sorted(manifest.verify('tool', quick=True)) == [('bin/tool', 'permissions changed'), ('bin/tool2', 'link changed')]
+
+    os.remove(os.path.join(package, 'README'))
+
+    assert ('README', 'missing') in manifest.verify('tool')
+    assert manifest.verify('missing') is None
+
+
+def test_owner_of_package_files_and_links(package):
+    bin_link = os.path.join(manifest.toaster_loc, 'bin', 'tool')
+
+    assert manifest.owner(os.path.join(package, 'bin', 'tool')) == ('tool', 'bin/tool')
+    assert manifest.owner(bin_link) == ('tool', 'tool')
+    assert manifest.owner(os.path.join(package, 'unknown')) is None
+    assert manifest.owner(os.path.join(manifest.toaster_loc, 'bin', 'unknown')) is None
+
+    result = CliRunner().invoke(cli.cli, ['owns', bin_link, os.path.join(package, 'nope')])
+
+    assert f'{bin_link} is owned by tool' in result.output
+    assert 'nope is not owned by any package.' in result.output
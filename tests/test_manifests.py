@@ -0,0 +1,51 @@
+import os
+
+import manifests
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(manifests, 'cache_dir', str(tmp_path / 'manifests'))
+    manifests.clear()
+
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_gc_deletes_what_was_saved_for_removed_and_changed_tomls(tmp_path):
+    kept = write(tmp_path / 'kept.toml', 'name = "kept"\n')
+    removed = write(tmp_path / 'removed.toml', 'name = "removed"\n')
+    changed = write(tmp_path / 'changed.toml', 'name = "changed"\n')
+
+    for path in (kept, removed, changed):
+        manifests.load(path)
+
+    os.remove(removed)
+    write(tmp_path / 'changed.toml', 'name = "changed again"\n')
+
+    saved, size = manifests.usage()
+    assert saved == 3
+
+    freed = manifests.gc()
+
+    assert manifests.usage() == (1, size - freed)
+    assert os.path.exists(manifests._disk_loc(kept))
+
+    # What gc kept is still loaded from the disk
+    manifests.clear()
+    disk_hits = manifests.stats()['disk_hits']
+    assert manifests.load(kept) == {'name': 'kept'}
+    assert manifests.stats()['disk_hits'] == disk_hits + 1
+
+
+def test_files_saved_for_another_path_are_not_used(tmp_path):
+    path = write(tmp_path / 'a.toml', 'name = "a"\n')
+    st = os.stat(path)
+
+    manifests._save_to_disk('/elsewhere/a.toml', (st.st_mtime_ns, st.st_size), {'name': 'other'})
+    os.replace(manifests._disk_loc('/elsewhere/a.toml'), manifests._disk_loc(path))
+
+    assert manifests.load(path) == {'name': 'a'}
@@ -0,0 +1,222 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import artifacts
+import bottles
+import installed
+import packages
+import pytest
+import spec
+from exceptions import DependedOnError
+from exceptions import DependencyFailed
+from exceptions import NotFound
+from extract import UnsafeArchive
+
+
+def make_tar(loc, members):
+    """Write a tar of (name, data or None for a symlink to /etc) under a top level directory"""
+    with tarfile.open(loc, 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(f'top/{name}')
+
+            if data is None:
+                info.type = tarfile.SYMTYPE
+                info.linkname = '/etc'
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0o755
+                tar.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture
+def binary(tmp_path, monkeypatch):
+    """Publish binary packages from a local bakery and store their archives, returns their TOML and Spec"""
+    monkeypatch.setattr(packages, '_find_package', lambda package: 'local')
+    monkeypatch.setattr(packages, 'find_spec', lambda package, bakery: None)
+    published = []
+
+    def binary(name, members, version='1.0', dependencies=()):
+        url = f'https://example.com/{name}-{version}.tar'
+        archive = tmp_path / f'{name}-{version}.tar'
+        make_tar(archive, members)
+        artifacts.add(str(archive), url)
+
+        toml_dir = os.path.join(packages.toaster_loc, 'bakery', 'local', name)
+        os.makedirs(toml_dir, exist_ok=True)
+        toml_loc = os.path.join(toml_dir, f'{name}.toml')
+
+        with open(toml_loc, 'w') as f:
+            f.write(f'name = "{name}"\nversion = "{version}"\ntypes = ["binary"]\n'
+                    f'dependencies = {list(dependencies)!r}\n[binary]\ntype = "tar"\nurl = "{url}"\n')
+
+        published.append(name)
+
+        return toml_loc, spec.load(toml_loc, name)
+
+    yield binary
+
+    for name in reversed(published):
+        if packages.is_installed(name):
+            packages.remove_package(name)
+
+    shutil.rmtree(os.path.join(packages.toaster_loc, 'bakery', 'local'))
+
+
+def git(cwd, *args):
+    subprocess.run(['git', '-c', 'user.name=t', '-c', 'user.email=t@t', *args], cwd=cwd,
+                   check=True, capture_output=True)
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+    """Publish versions of a build package from a local bakery, whose build bakes its prefix into bin/pp"""
+    monkeypatch.setattr(packages, '_find_package', lambda package: 'local')
+    monkeypatch.setattr(bottles, 'bottles_dir', str(tmp_path / 'bottles'))
+
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git(origin, 'init', '-q', '-b', 'master')
+
+    toml_dir = os.path.join(packages.toaster_loc, 'bakery', 'local', 'pp')
+    os.makedirs(toml_dir)
+    toml_loc = os.path.join(toml_dir, 'pp.toml')
+
+    def build(version):
+        (origin / 'VERSION').write_text(f'{version}\n')
+        git(origin, 'add', 'VERSION')
+        git(origin, 'commit', '-q', '-m', version)
+
+        with open(toml_loc, 'w') as f:
+            f.write(f'name = "pp"\nversion = "{version}"\ntypes = ["build"]\n[build]\nrepo = "{origin}"\n'
+                    'format_scripts = true\nscripts = [["sh", "-c", "echo {prefix} > {prefix}/bin/pp"]]\n')
+
+        return toml_loc, spec.load(toml_loc, 'pp')
+
+    yield build
+
+    if packages.is_installed('pp'):
+        packages.remove_package('pp')
+
+    shutil.rmtree(os.path.dirname(toml_dir))
+
+
+def install(package, toml_loc, package_spec):
+    packages._fetch_package(package, package_spec)
+    packages._install_fetched(package, toml_loc, package_spec)
+
+
+def test_failed_installs_leave_nothing_behind(binary):
+    toml_loc, package_spec = binary('unsafe', [('bin/unsafe', b'#!/bin/sh\n'), ('bin/escape', None)])
+
+    with pytest.raises(UnsafeArchive):
+        packages._install_fetched('unsafe', toml_loc, package_spec)
+
+    assert not os.path.lexists(os.path.join(packages.toaster_loc, 'binaries', 'unsafe'))
+    assert not os.path.exists(os.path.join(packages.toaster_loc, 'package_data', 'unsafe.toml'))
+    assert not packages.is_installed('unsafe')
+
+    with pytest.raises(NotFound):
+        packages.remove_package('unsafe')
+
+    # Once the archive is fixed it can be installed and removed like any other package
+    toml_loc, package_spec = binary('unsafe', [('bin/unsafe', b'#!/bin/sh\n')], '1.1')
+    packages._install_fetched('unsafe', toml_loc, package_spec)
+
+    assert installed.get_package('unsafe')['version'] == '1.1'
+
+    packages.remove_package('unsafe')
+
+    assert not packages.is_installed('unsafe')
+
+
+def test_bottles_of_updates_are_not_poured_into_fresh_installs(build):
+    package_dir = os.path.join(packages.toaster_loc, 'packages', 'pp')
+
+    install('pp', *build('1.0'))
+    v2 = build('2.0')
+    packages.update_package('pp')
+    packages.remove_package('pp')
+
+    # The update's build was bottled with its generation as the prefix
+    install('pp', *v2)
+
+    with open(os.path.join(package_dir, 'bin', 'pp')) as f:
+        assert f.read() == f'{package_dir}\n'
+
+
+def test_updates_can_be_rolled_back_and_removed(build):
+    package_dir = os.path.join(packages.toaster_loc, 'packages', 'pp')
+    versions = os.path.join(packages.toaster_loc, 'packages', '.versions', 'pp')
+    bin_link = os.path.join(packages.toaster_loc, 'bin', 'pp')
+
+    install('pp', *build('1.0'))
+    build('2.0')
+    packages.update_package('pp')
+
+    # The installed version became generation 1 and the update was built into 2
+    assert os.readlink(package_dir) == os.path.join('.versions', 'pp', '2')
+    assert os.readlink(os.path.join(versions, 'previous')) == '1'
+    assert sorted(os.listdir(versions)) == ['1', '1.toml', '2', '2.toml', 'previous']
+    assert installed.get_package('pp')['version'] == '2.0'
+    assert os.path.realpath(bin_link) == os.path.join(versions, '2', 'bin', 'pp')
+
+    assert packages.rollback_package('pp') == '1.0'
+    assert os.readlink(package_dir) == os.path.join('.versions', 'pp', '1')
+    assert os.readlink(os.path.join(versions, 'previous')) == '2'
+    assert installed.get_package('pp')['version'] == '1.0'
+    assert spec.load(os.path.join(packages.toaster_loc, 'package_data', 'pp.toml')).version == '1.0'
+    assert os.path.realpath(bin_link) == os.path.join(versions, '1', 'bin', 'pp')
+
+    # Rolling back again goes forward
+    assert packages.rollback_package('pp') == '2.0'
+
+    build('3.0')
+    packages.update_package('pp')
+
+    # Only the current and previous generations are kept
+    assert os.readlink(package_dir) == os.path.join('.versions', 'pp', '3')
+    assert sorted(os.listdir(versions)) == ['2', '2.toml', '3', '3.toml', 'previous']
+
+    packages.remove_package('pp')
+
+    assert not os.path.lexists(package_dir)
+    assert not os.path.exists(versions)
+    assert not os.path.lexists(bin_link)
+    assert not packages.is_installed('pp')
+
+
+def test_failed_dependencies_only_stop_their_dependants(binary):
+    tool = [('bin/tool', b'#!/bin/sh\n')]
+    binary('broken', [('bin/escape', None)])
+    binary('needs-broken', tool, dependencies=['broken'])
+    binary('lib', [('lib/lib.so', b'lib')])
+    binary('needs-lib', tool, dependencies=['lib'])
+
+    errors = packages.install_packages(['needs-broken', 'needs-lib'], jobs=4)
+
+    assert isinstance(errors['needs-broken'], DependencyFailed)
+    assert errors['needs-broken'].args == (('install', 'broken'),)
+    assert errors['needs-lib'] is None
+    assert not packages.is_installed('broken') and not packages.is_installed('needs-broken')
+    assert packages.is_installed('lib') and packages.is_installed('needs-lib')
+
+
+def test_version_requirements_still_count_as_dependants(binary):
+    binary('foo', [('lib/foo.so', b'foo')], version='2.5')
+    binary('app', [('bin/app', b'#!/bin/sh\n')], dependencies=['foo>=2.5'])
+
+    assert packages.install_packages(['app']) == {'app': None}
+    assert packages.get_dependants('foo') == ['app']
+
+    with pytest.raises(DependedOnError):
+        packages.remove_package('foo')
+
+    # Built again from the TOMLs in package_data, like after upgrading from a toaster without the index
+    installed.rebuild({})
+    assert packages.get_dependants('foo') == []
+    packages.rebuild_dependency_index()
+    assert packages.get_dependants('foo') == ['app']
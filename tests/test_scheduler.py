@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+from exceptions import DependencyFailed
+from scheduler import run_graph
+
+
+def ok(ran, t):
+    ran.append(t)
+
+
+def fail(ran, t):
+    ran.append(t)
+    raise ValueError(t)
+
+
+def test_failures_skip_everything_depending_on_them():
+    ran = []
+    tasks = {
+        'a': (fail, (ran, 'a'), []),
+        'b': (ok, (ran, 'b'), ['a']),
+        'c': (ok, (ran, 'c'), ['b']),
+        'd': (ok, (ran, 'd'), ['b', 'e']),
+        'e': (ok, (ran, 'e'), []),
+    }
+
+    results = run_graph(tasks, 2)
+
+    assert isinstance(results['a'], ValueError)
+    assert [(t, results[t].args) for t in 'bcd'] == [('b', ('a',)), ('c', ('b',)), ('d', ('b',))]
+    assert all(isinstance(results[t], DependencyFailed) for t in 'bcd')
+    assert results['e'] is None
+    assert sorted(ran) == ['a', 'e']
+
+
+def test_independent_branches_finish_while_another_fails():
+    ran = []
+    failed = threading.Event()
+
+    def slow(ran, t):
+        # Still running when the other branch fails
+        assert failed.wait(10)
+        ran.append(t)
+
+    def fail_now(ran, t):
+        try:
+            fail(ran, t)
+        finally:
+            failed.set()
+
+    tasks = {
+        'slow': (slow, (ran, 'slow'), []),
+        'after-slow': (ok, (ran, 'after-slow'), ['slow']),
+        'broken': (fail_now, (ran, 'broken'), []),
+        'after-broken': (ok, (ran, 'after-broken'), ['broken']),
+    }
+
+    results = run_graph(tasks, 2)
+
+    assert results['slow'] is None and results['after-slow'] is None
+    assert isinstance(results['after-broken'], DependencyFailed)
+    assert sorted(ran) == ['after-slow', 'broken', 'slow']
+
+
+def test_cycles_are_reported_instead_of_waiting_forever():
+    ran = []
+    tasks = {
+        'a': (ok, (ran, 'a'), ['c']),
+        'b': (ok, (ran, 'b'), ['a']),
+        'c': (ok, (ran, 'c'), ['b']),
+        'after': (ok, (ran, 'after'), ['a']),
+        'free': (ok, (ran, 'free'), []),
+    }
+
+    results = run_graph(tasks, 2)
+
+    assert all(isinstance(results[t], DependencyFailed) for t in ('a', 'b', 'c', 'after'))
+    assert results['free'] is None
+    assert ran == ['free']
+
+
+def test_unknown_pools_are_refused():
+    with pytest.raises(ValueError):
+        run_graph({}, 1, 'fiber')
@@ -0,0 +1,57 @@
+import catalog
+import pytest
+import search
+
+
+@pytest.fixture(autouse=True)
+def empty_catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, 'catalog_loc', str(tmp_path / 'catalog.db'))
+    monkeypatch.setattr(catalog, '_clones_checked', True)
+    monkeypatch.setattr(catalog, '_memory', None)
+
+
+def package(name, desc=''):
+    return {'name': name, 'version': '1.0', 'types': ['binary'], 'dependencies': [], 'desc': desc}
+
+
+def test_prefixes_match_every_package_with_their_terms(monkeypatch):
+    monkeypatch.setattr(search, '_MAX_PREFIX_TERMS', 3)
+    catalog.write_bakeries({'main': (0, [package(f'tool{i}', 'shared library') for i in range(200)]
+                                     + [package('other', 'shares things')], None)})
+
+    total, results, truncated = catalog.search_packages('sha', limit=5)
+
+    assert total == 201
+    assert len(results) == 5
+    assert truncated == []
+
+
+def test_prefixes_with_too_many_terms_say_so(monkeypatch):
+    monkeypatch.setattr(search, '_MAX_PREFIX_TERMS', 3)
+    catalog.write_bakeries({'main': (0, [package(f'lib{word}') for word in 'abcdef'], None)})
+
+    total, results, truncated = catalog.search_packages('lib', limit=20)
+
+    assert truncated == ['lib']
+    assert [r['name'] for r in results] == ['liba', 'libb', 'libc']
+    assert total == 3
+
+    total, _, truncated = catalog.search_packages('libf')
+
+    assert (total, truncated) == (1, [])
+
+
+def test_removed_packages_leave_no_postings_when_terms_changed(monkeypatch):
+    catalog.write_bakeries({'main': (0, [package('foo', 'alpha beta'), package('bar', 'alpha')], None)})
+
+    # Splitting text into terms changed since foo was indexed
+    monkeypatch.setattr(search, 'terms', lambda p: {(p['name'], 0)})
+    catalog.write_bakeries({'main': (0, [], ['foo'])})
+
+    conn = catalog.get_catalog()
+    left = {(row['term'], row['document']) for row in conn.execute('SELECT * FROM terms')}
+    bar = conn.execute("SELECT id FROM documents WHERE name = 'bar'").fetchone()['id']
+
+    assert left == {('bar', bar), ('alpha', bar)}
+    assert not conn.execute("SELECT 1 FROM grams WHERE term = 'beta'").fetchone()
+    assert conn.execute("SELECT 1 FROM grams WHERE term = 'alpha'").fetchone()
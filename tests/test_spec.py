@@ -0,0 +1,36 @@
+import pickle
+
+import catalog
+import pytest
+import spec
+
+TOML = {'name': 'hello', 'version': '1.0', 'types': ['binary'],
+        'binary': {'type': 'zip', 'url': 'https://example.com/hello.zip'}}
+
+
+def test_stored_specs_round_trip():
+    package_spec = spec.resolve(TOML)
+
+    assert catalog._load_spec(pickle.dumps((spec.SCHEMA, package_spec))) == package_spec
+
+
+def test_specs_with_fewer_fields_are_resolved_again(monkeypatch):
+    package_spec = spec.resolve(TOML)
+
+    # Like a Spec from an older toaster, which didn't have the last field yet
+    monkeypatch.setattr(spec._Frozen, '__reduce__', lambda self: (
+        type(self), tuple(getattr(self, name) for name in self.__slots__[:-1])))
+    old = pickle.dumps((spec.SCHEMA, package_spec))
+    monkeypatch.undo()
+
+    assert catalog._load_spec(old) is None
+
+
+@pytest.mark.parametrize('stored', [
+    (spec.SCHEMA - 1, spec.resolve(TOML)),
+    # From before specs were stored with their schema
+    spec.resolve(TOML),
+    b'garbage',
+])
+def test_specs_from_other_schemas_are_resolved_again(stored):
+    assert catalog._load_spec(pickle.dumps(stored)) is None
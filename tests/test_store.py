@@ -0,0 +1,63 @@
+import errno
+import os
+import shutil
+
+import installed
+import pytest
+import store
+from utils import hash_file
+
+
+@pytest.fixture
+def objects(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'objects_dir', str(tmp_path / 'objects'))
+
+    yield tmp_path
+
+    installed.forget_package('reflinked')
+
+
+def stored(tmp_path, content, mode=0o644):
+    src = tmp_path / content
+    src.write_text(content)
+    os.chmod(src, mode)
+    key = f'{hash_file(str(src))}-{mode:o}'
+
+    os.makedirs(os.path.dirname(store.object_loc(key)), exist_ok=True)
+    shutil.copy2(src, store.object_loc(key))
+
+    return key
+
+
+def test_gc_keeps_reflinked_files_installed_packages_use(objects):
+    used = stored(objects, 'used')
+    unused = stored(objects, 'unused')
+    linked = stored(objects, 'linked')
+    os.link(store.object_loc(linked), objects / 'hardlink')
+
+    # A reflinked copy has a link count of 1 like the object, only the manifest knows it is used
+    installed.set_manifest('reflinked', 'build', str(objects / 'reflinked'), '1',
+                           [('used', 'f', 4, 0o644, used.rsplit('-', 1)[0])])
+
+    assert store.gc() == (1, len('unused'))
+    assert os.path.exists(store.object_loc(used))
+    assert os.path.exists(store.object_loc(linked))
+    assert not os.path.exists(store.object_loc(unused))
+
+
+@pytest.mark.parametrize('err, unsupported', [
+    (errno.EXDEV, True),
+    (errno.EPERM, True),
+    (errno.EMLINK, False),
+    (errno.ENOENT, False),
+])
+def test_only_unsupported_errors_stop_hardlinks(objects, monkeypatch, err, unsupported):
+    def link(src, dst):
+        raise OSError(err, os.strerror(err))
+
+    monkeypatch.setattr(os, 'link', link)
+    monkeypatch.setattr(store, '_no_hardlink', set())
+    (objects / 'src').write_text('data')
+
+    assert not store._link(str(objects / 'src'), str(objects / 'dst'), 'hardlink')
+    assert bool(store._no_hardlink) == unsupported